@@ -5,5 +5,49 @@ __version__ = (0, 1, 1)
 may_create_default = False
 
 
-import mongoengine_privileges.privilegemixin
-from mongoengine_privileges.privilegemixin import PrivilegeMixin, Privilege, PermissionError
+import sys
+
+from mongoengine_privileges.exceptions import PermissionError
+from mongoengine_privileges.privilege import Privilege
+
+__all__ = [ 'PrivilegeMixin', 'Privilege', 'PermissionError', 'requires_fields' ]
+
+# `PrivilegeMixin` pulls in `mongoengine_relational` (and Pyramid); it's imported on first access, so the
+# privilege model and evaluator (`privilege`, `acl`, `events`) can be used without them.
+_lazy_attributes = {
+    'PrivilegeMixin': 'mongoengine_privileges.privilegemixin',
+    'requires_fields': 'mongoengine_privileges.privilegemixin',
+}
+
+# Submodules that are imported on first access as well, so `mongoengine_privileges.privilegemixin` keeps working
+# without importing it explicitly
+_lazy_modules = ( 'privilegemixin', )
+
+
+def __getattr__( name ):
+    if name in _lazy_attributes:
+        import importlib
+        return getattr( importlib.import_module( _lazy_attributes[ name ] ), name )
+    elif name in _lazy_modules:
+        import importlib
+        return importlib.import_module( '{}.{}'.format( __name__, name ) )
+
+    raise AttributeError( 'module {!r} has no attribute {!r}'.format( __name__, name ) )
+
+
+if sys.version_info < ( 3, 7 ):
+    # Module level `__getattr__` isn't supported (PEP 562); replace this module with one that implements it
+    import types
+
+    class LazyModule( types.ModuleType ):
+        def __getattr__( self, name ):
+            value = __getattr__( name )
+            setattr( self, name, value )
+            return value
+
+    _module = sys.modules[ __name__ ]
+    _lazy_module = LazyModule( __name__, __doc__ )
+    _lazy_module.__dict__.update( _module.__dict__ )
+    # Keep a reference to the original module; on Python 2, its globals are cleared once it's garbage collected
+    _lazy_module._module = _module
+    sys.modules[ __name__ ] = _lazy_module
@@ -0,0 +1,395 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from mongoengine import Document
+from bson import DBRef, ObjectId
+
+from . import events
+
+
+def get_principal_id( value ):
+    '''
+    Get the raw id for a (user) principal, without dereferencing it. `value` can be an `ObjectId`, a `DBRef`
+    or a `Document`.
+
+    @param value:
+    @return:
+    @rtype: ObjectId
+    '''
+    if isinstance( value, DBRef ):
+        return value.id
+    elif isinstance( value, Document ):
+        return value.pk
+
+    return value
+
+
+def normalize_user_id( value ):
+    '''
+    Normalize a (stored) `user` value, which can be an ObjectId, a DBRef, a Document or a string, to an ObjectId.
+
+    @param value:
+    @return: an ObjectId, or `value` as is if it can't be normalized
+    '''
+    value = get_principal_id( value )
+
+    if not isinstance( value, ObjectId ) and isinstance( value, basestring ) and ObjectId.is_valid( value ):
+        value = ObjectId( value )
+
+    return value
+
+
+def get_principal_key( principal ):
+    '''
+    Get the canonical key for a principal, as used in `__acl__` and as returned by `effective_principals`:
+    the id (as a string) for users, or the name for groups.
+
+    @param principal: a group name, or a user (an ObjectId, DBRef or Document)
+    @return:
+    @rtype: string
+    '''
+    if isinstance( principal, basestring ):
+        return principal
+
+    principal = get_principal_id( principal )
+    return str( principal ) if principal is not None else None
+
+
+def get_privilege_key( privilege ):
+    '''
+    Get the canonical key for the principal of `privilege` (see `get_principal_key`). For `Privilege` objects,
+    the key is computed once and cached.
+
+    @param privilege: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+    @return:
+    @rtype: string
+    '''
+    if isinstance( privilege, dict ):
+        user = privilege.get( 'user' )
+        return get_principal_key( user ) if user is not None else privilege.get( 'group' )
+
+    return privilege.principal_key
+
+
+# Process-wide versions of ACLs, keyed by `( class name, pk )`. Caches of ACLs (or of decisions derived from
+# them) record the version they were built for, and are discarded when it changes.
+# Bounded by `max_versions`: when full, it's cleared, and Documents without an entry get a version (`_floor`)
+# higher than any version handed out before, so caches of all of them are invalidated once.
+_versions = {}
+_floor = 0
+max_versions = 100000
+
+
+def get_version( cls_name, pk ):
+    return _versions.get( ( cls_name, pk ), _floor )
+
+
+def invalidate( events ):
+    '''
+    Subscriber for privilege change events (see `mongoengine_privileges.events`); bumps the ACL version for every
+    Document in `events`.
+
+    @param events:
+    @type events: list
+    '''
+    global _floor
+
+    for key in set( ( event.cls, event.pk ) for event in events ):
+        if key not in _versions and len( _versions ) >= max_versions:
+            _floor = max( _versions.values() ) + 1
+            _versions.clear()
+
+        _versions[ key ] = _versions.get( key, _floor ) + 1
+
+
+# Invalidate our own caches when privileges change. Registered here (rather than where ACLs are evaluated), so
+# events are handled as soon as the package is imported.
+events.subscribe( invalidate, immediate=True )
+
+
+def compile_roles( roles ):
+    '''
+    Compile role definitions (as found in `meta['roles']`) into a lookup table of `role: frozenset(permissions)`.
+
+    @param roles:
+    @type roles: dict
+    @return:
+    @rtype: dict
+    '''
+    return dict( ( role, frozenset( [ permissions ] if isinstance( permissions, basestring ) else permissions ) )
+        for role, permissions in ( roles or {} ).items() )
+
+
+def expand_permissions( privilege, roles ):
+    '''
+    Get the permissions granted by `privilege`; its explicit `permissions`, plus the permissions for each of its
+    `roles`. For a privilege that only references a single role, the precompiled set for that role is returned
+    as is.
+
+    @param privilege: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+    @type privilege: dict or Privilege
+    @param roles: compiled roles (see `compile_roles`)
+    @type roles: dict
+    @return:
+    @rtype: frozenset
+    '''
+    permissions = privilege.get( 'permissions' ) or ()
+    privilege_roles = privilege.get( 'roles' ) or ()
+
+    if not privilege_roles:
+        return frozenset( permissions )
+    elif len( privilege_roles ) == 1 and not permissions:
+        return roles.get( privilege_roles[ 0 ], frozenset() )
+
+    return frozenset( permissions ).union( *[ roles.get( role, () ) for role in privilege_roles ] )
+
+
+class CompiledACL( object ):
+    '''
+    An index of `permission: frozenset(principals)` for a Document's privileges, with roles expanded. Checking a
+    permission for a set of principals is a few dict lookups and set intersection tests, with the same result
+    as evaluating `__acl__` with an `ACLAuthorizationPolicy`; since `__acl__` lists all `Deny` entries before
+    any `Allow` entry, the first matching entry is a `Deny` if any principal has been denied the permission.
+    '''
+
+    __slots__ = ( 'allowed', 'denied', 'allowed_by_principal', 'denied_by_principal', 'compiled_at', 'valid_until' )
+
+    def __init__( self, privileges, roles=None, now=None ):
+        '''
+        @param privileges: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+        @type privileges: list
+        @param roles: compiled roles (see `compile_roles`)
+        @type roles: dict
+        @param now: privileges that have expired at `now` are left out. The compiled ACL is valid from `now`
+            (`compiled_at`) until `valid_until`, the first time any of the remaining privileges expires (or `None`).
+        @type now: datetime
+        '''
+        roles = roles or {}
+        now = now or datetime.utcnow()
+        allowed, denied = {}, {}
+        allowed_by_principal, denied_by_principal = {}, {}
+        self.compiled_at = now
+        self.valid_until = None
+
+        for priv in privileges:
+            principal = get_privilege_key( priv )
+            expires = priv.get( 'expires' )
+
+            if expires is not None:
+                if expires <= now:
+                    continue
+                elif self.valid_until is None or expires < self.valid_until:
+                    self.valid_until = expires
+
+            if principal:
+                for index, by_principal, permissions in (
+                        ( allowed, allowed_by_principal, expand_permissions( priv, roles ) ),
+                        ( denied, denied_by_principal, frozenset( priv.get( 'denied' ) or () ) ) ):
+                    if permissions:
+                        by_principal[ principal ] = by_principal.get( principal, frozenset() ).union( permissions )
+
+                        for permission in permissions:
+                            index.setdefault( permission, set() ).add( principal )
+
+        self.allowed = dict( ( permission, frozenset( principals ) ) for permission, principals in allowed.items() )
+        self.denied = dict( ( permission, frozenset( principals ) ) for permission, principals in denied.items() )
+        self.allowed_by_principal = allowed_by_principal
+        self.denied_by_principal = denied_by_principal
+
+    def permits( self, principals, permission ):
+        '''
+        @param principals: the effective principals for the current request
+        @type principals: frozenset
+        @param permission:
+        @type permission: string
+        @return:
+        @rtype: bool
+        '''
+        denied = self.denied.get( permission )
+
+        if denied and not denied.isdisjoint( principals ):
+            return False
+
+        allowed = self.allowed.get( permission )
+        return bool( allowed ) and not allowed.isdisjoint( principals )
+
+    def is_valid_at( self, now ):
+        return self.compiled_at <= now and ( self.valid_until is None or now < self.valid_until )
+
+    def get_permissions( self, principals ):
+        '''
+        Get all permissions granted to any of `principals` (and not denied to any of them).
+
+        @param principals: the effective principals for the current request
+        @type principals: frozenset
+        @return:
+        @rtype: frozenset
+        '''
+        allowed = frozenset().union( *[ self.allowed_by_principal[ principal ] for principal in principals if principal in self.allowed_by_principal ] )
+
+        if self.denied_by_principal:
+            allowed = allowed.difference( *[ self.denied_by_principal[ principal ] for principal in principals if principal in self.denied_by_principal ] )
+
+        return allowed
+
+
+class ACLCache( object ):
+    '''
+    Authorization state cached on a Document: its `CompiledACL` (compiled on demand), and a bounded set of denied
+    `( principals, permission )` pairs, so repeated denials don't pay for a full evaluation. It's valid for a
+    specific `privileges` value and ACL version only.
+
+    `snapshot_generation` is the generation of this Document's slot in the `SnapshotStore` (if any) when the
+    cache was created; see `mongoengine_privileges.snapshot`.
+    '''
+
+    __slots__ = ( 'privileges', 'length', 'version', 'acl', 'denied', 'snapshot_generation' )
+
+    max_denied = 64
+
+    def __init__( self, privileges, version ):
+        self.privileges = privileges
+        self.length = len( privileges or () )
+        self.version = version
+        self.acl = None
+        self.denied = set()
+        self.snapshot_generation = None
+
+    def is_valid( self, privileges, version ):
+        return self.privileges is privileges and self.length == len( privileges or () ) and self.version == version
+
+    def reset( self ):
+        '''
+        Discard the compiled ACL and cached denials.
+        '''
+        self.acl = None
+        self.denied.clear()
+
+    def is_denied( self, principals, permission, now ):
+        '''
+        Check if `permission` has been denied to `principals` by the compiled ACL, which must still be valid at
+        `now`; a denial may be lifted when a (denying) privilege expires.
+
+        @param principals:
+        @type principals: frozenset
+        @param permission:
+        @type permission: string
+        @param now:
+        @type now: datetime
+        @return:
+        @rtype: bool
+        '''
+        return self.acl is not None and self.acl.is_valid_at( now ) and ( principals, permission ) in self.denied
+
+    def add_denied( self, principals, permission ):
+        if len( self.denied ) >= self.max_denied:
+            self.denied.clear()
+
+        self.denied.add( ( principals, permission ) )
+
+
+class RequestState( object ):
+    '''
+    Authorization state that's computed once per request (for a given user).
+    '''
+
+    __slots__ = ( 'user', 'principals', 'uses_acl', 'now' )
+
+    def __init__( self, request ):
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from pyramid.interfaces import IAuthorizationPolicy
+        from pyramid.security import effective_principals
+
+        # A single timestamp to evaluate expiring privileges against
+        self.now = datetime.utcnow()
+        self.user = getattr( request, 'user', None )
+        self.principals = frozenset( str( principal ) for principal in effective_principals( request ) )
+        policy = request.registry.queryUtility( IAuthorizationPolicy )
+        self.uses_acl = isinstance( policy, ACLAuthorizationPolicy )
+
+
+class RequestCache( object ):
+    '''
+    Authorization state for the Documents used during a request, keyed by `( class name, pk )`: their `ACLCache`s,
+    and the decisions made by `may`. It's kept alongside the request's `DocumentCache` (`request.cache`), so it's
+    shared by all instances of the same Document; for example, one that's been fetched through a relation.
+    '''
+
+    __slots__ = ( 'acls', 'decisions' )
+
+    def __init__( self ):
+        self.acls = {}
+        self.decisions = {}
+
+    def get_acl_cache( self, key, version ):
+        '''
+        @return: the `ACLCache` for `key`, if it's for `version`
+        @rtype: ACLCache
+        '''
+        cache = self.acls.get( key )
+        return cache if cache is not None and cache.version == version else None
+
+    def set_acl_cache( self, key, cache ):
+        '''
+        Store the `ACLCache` for `key`, discarding previous decisions for it.
+        '''
+        self.acls[ key ] = cache
+        self.decisions.pop( key, None )
+
+    def get_decision( self, key, principals, permission ):
+        '''
+        @return: the decision for `permission`, or `None` if it hasn't been made yet
+        @rtype: bool
+        '''
+        decisions = self.decisions.get( key )
+        return decisions.get( ( principals, permission ) ) if decisions else None
+
+    def set_decision( self, key, principals, permission, result ):
+        self.decisions.setdefault( key, {} )[ ( principals, permission ) ] = result
+
+
+def get_request_cache( request ):
+    '''
+    Get the `RequestCache` for `request`. It's stored on the request's `DocumentCache`; `None` is returned if
+    the request doesn't have one.
+
+    @param request:
+    @type request: pyramid.request.Request
+    @return:
+    @rtype: RequestCache
+    '''
+    document_cache = getattr( request, 'cache', None )
+
+    if document_cache is None:
+        return None
+
+    cache = getattr( document_cache, '_privileges_cache', None )
+
+    if cache is None:
+        cache = RequestCache()
+
+        try:
+            document_cache._privileges_cache = cache
+        except AttributeError:
+            return None
+
+    return cache
+
+
+def get_request_state( request ):
+    '''
+    Get the `RequestState` for `request`. It's stored on the request, and recomputed when `request.user` changes.
+
+    @param request:
+    @type request: pyramid.request.Request
+    @return:
+    @rtype: RequestState
+    '''
+    state = getattr( request, '_privileges_state', None )
+
+    if state is None or state.user is not getattr( request, 'user', None ):
+        state = request._privileges_state = RequestState( request )
+
+    return state
@@ -0,0 +1,245 @@
+'''
+Audit log of authorization decisions.
+
+Records are put on a bounded in-memory queue, and written to a sink in batches by a background thread, so
+auditing doesn't add write latency to requests. When the queue is full, records are dropped (and counted) unless
+`block` is set; allowed and denied decisions can be sampled separately. Records still queued when the interpreter
+exits are written (waiting at most `exit_timeout` seconds).
+
+    from mongoengine_privileges import audit
+    audit.set_audit_logger( audit.AuditLogger( audit.MongoSink( db.audit_log ), allowed_sample_rate=0.1 ) )
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+log = logging.getLogger( __name__ )
+
+_logger = None
+
+# Put on the queue of an `AuditLogger` to stop its writer, once the records queued before it have been written
+_stop = object()
+
+
+def set_audit_logger( logger ):
+    '''
+    Set the `AuditLogger` that receives authorization decisions. Pass `None` to disable auditing.
+    '''
+    global _logger
+    _logger = logger
+
+
+def record( action, doc, request, permission, allowed, pk=None ):
+    '''
+    Record an authorization decision, if an `AuditLogger` has been set.
+
+    @param action: `may`, `save`, `update`, `delete`, `grant`, `revoke` or `deny`
+    @type action: string
+    @param doc: the Document (or Document class)
+    @param request:
+    @type request: pyramid.request.Request
+    @param permission:
+    @type permission: string
+    @param allowed:
+    @type allowed: bool
+    @param pk: the pk of the Document, if `doc` is a Document class (for decisions made in bulk)
+    '''
+    if _logger is not None:
+        _logger.record( action, doc, request, permission, allowed, pk=pk )
+
+
+class MongoSink( object ):
+    '''
+    Writes audit records to a MongoDB collection.
+    '''
+
+    def __init__( self, collection ):
+        self.collection = collection
+
+    def write( self, records ):
+        self.collection.insert_many( records, ordered=False )
+
+
+class FileSink( object ):
+    '''
+    Appends audit records to a file, as JSON lines.
+    '''
+
+    def __init__( self, path ):
+        self.path = path
+
+    def write( self, records ):
+        with open( self.path, 'a' ) as f:
+            for item in records:
+                f.write( json.dumps( item, default=str ) + '\n' )
+
+
+class AuditLogger( object ):
+    '''
+    Buffers audit records, and writes them to `sink` in batches from a background thread.
+    '''
+
+    def __init__( self, sink, max_queue_size=10000, batch_size=100, flush_interval=1.0, allowed_sample_rate=1.0,
+            denied_sample_rate=1.0, block=False, block_timeout=0.1, exit_timeout=5.0 ):
+        '''
+        @param sink: an object implementing `write( records )`
+        @param max_queue_size: the maximum number of records waiting to be written
+        @type max_queue_size: int
+        @param batch_size: the maximum number of records written at once
+        @type batch_size: int
+        @param flush_interval: the maximum time (in seconds) a record waits before being written
+        @type flush_interval: float
+        @param allowed_sample_rate: the fraction of allowed decisions that's recorded
+        @type allowed_sample_rate: float
+        @param denied_sample_rate: the fraction of denied decisions that's recorded
+        @type denied_sample_rate: float
+        @param block: when the queue is full, wait for (at most) `block_timeout` seconds instead of dropping a record
+        @type block: bool
+        @param block_timeout:
+        @type block_timeout: float
+        @param exit_timeout: the maximum time (in seconds) to wait for queued records to be written at exit
+        @type exit_timeout: float
+        '''
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.allowed_sample_rate = allowed_sample_rate
+        self.denied_sample_rate = denied_sample_rate
+        self.block = block
+        self.block_timeout = block_timeout
+        self.exit_timeout = exit_timeout
+
+        self.queue = queue.Queue( max_queue_size )
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+        atexit.register( self._flush_at_exit )
+
+    def record( self, action, doc, request, permission, allowed, pk=None ):
+        sample_rate = self.allowed_sample_rate if allowed else self.denied_sample_rate
+
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return
+
+        user = getattr( request, 'user', None )
+        item = {
+            'time': datetime.utcnow(),
+            'action': action,
+            'document': doc.__name__ if isinstance( doc, type ) else doc.__class__.__name__,
+            'pk': pk if pk is not None or isinstance( doc, type ) else getattr( doc, 'pk', None ),
+            'user': getattr( user, 'pk', None ),
+            'permission': permission,
+            'allowed': bool( allowed )
+        }
+
+        self._ensure_thread()
+
+        try:
+            if self.block:
+                self.queue.put( item, timeout=self.block_timeout )
+            else:
+                self.queue.put_nowait( item )
+        except queue.Full:
+            self._count( 'dropped', 1 )
+
+    def flush( self ):
+        '''
+        Block until all queued records have been written.
+        '''
+        self._ensure_thread()
+        self.queue.join()
+
+    def _flush_at_exit( self ):
+        '''
+        Write the records that are still queued, and stop the writer (waiting at most `exit_timeout` seconds).
+        '''
+        if self._pid != os.getpid() and not self.queue.unfinished_tasks:
+            return
+
+        self._ensure_thread()
+
+        try:
+            self.queue.put( _stop, timeout=self.exit_timeout )
+        except queue.Full:
+            pass
+
+        self._thread.join( self.exit_timeout )
+
+        if self._thread.is_alive():
+            log.warning( '{} audit records were not written at exit'.format( self.queue.unfinished_tasks ) )
+
+    def _count( self, counter, value ):
+        with self._counter_lock:
+            setattr( self, counter, getattr( self, counter ) + value )
+
+    def _ensure_thread( self ):
+        # (Re)start the writer; threads don't survive a fork
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread( target=self._run, name='mongoengine_privileges.audit' )
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run( self ):
+        stopping = False
+
+        while not stopping:
+            try:
+                item = self.queue.get( timeout=self.flush_interval )
+            except queue.Empty:
+                continue
+
+            if item is _stop:
+                self.queue.task_done()
+                break
+
+            # Collect a batch, waiting at most `flush_interval` for it to fill up
+            records = [ item ]
+            deadline = time.time() + self.flush_interval
+
+            while len( records ) < self.batch_size:
+                remaining = deadline - time.time()
+
+                try:
+                    item = self.queue.get( timeout=remaining ) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if item is _stop:
+                    self.queue.task_done()
+                    stopping = True
+                    break
+
+                records.append( item )
+
+            try:
+                self.sink.write( records )
+                self._count( 'written', len( records ) )
+            except Exception:
+                self._count( 'failed', len( records ) )
+                log.exception( 'Failed to write {} audit records'.format( len( records ) ) )
+            finally:
+                for i in range( len( records ) ):
+                    self.queue.task_done()
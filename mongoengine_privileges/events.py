@@ -0,0 +1,227 @@
+'''
+Privilege change events.
+
+Changes to privileges are emitted as `PrivilegeChange` tuples once they've been persisted, so caches of ACLs
+(in this process or elsewhere) can be invalidated. Changes are coalesced per request and published in a batch
+when the request finishes (or right away when no request is available).
+
+Subscribers registered using `subscribe` are called in-process for every batch; a `publisher` (set using
+`set_publisher`) can forward batches to other processes. Subscribers registered with `immediate=True` (such as
+the invalidation of our own ACL caches) are called for each change as soon as it's been persisted instead, so
+the rest of the request (and concurrent requests) don't see stale ACLs until the batch is published.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import namedtuple, OrderedDict
+
+
+# A change in privileges for a single principal on a Document. `added` and `removed` are frozensets of
+# permission names; roles are included as `role:<name>`, and denied permissions as `deny:<name>`.
+PrivilegeChange = namedtuple( 'PrivilegeChange', [ 'cls', 'pk', 'principal', 'added', 'removed' ] )
+
+ROLE_PREFIX = 'role:'
+DENY_PREFIX = 'deny:'
+
+_subscribers = []
+_immediate_subscribers = []
+_publisher = None
+
+
+def subscribe( subscriber, immediate=False ):
+    '''
+    Register an in-process subscriber; `subscriber` is called with a list of `PrivilegeChange`s for every batch.
+
+    @param subscriber:
+    @type subscriber: callable
+    @param immediate: if True, changes made in this process are passed to `subscriber` as soon as they're added
+        to a `ChangeBatch`, rather than when the batch is published. Batches published using `publish` directly
+        (for example, received from other processes) are passed to it as usual.
+    @type immediate: bool
+    '''
+    if subscriber not in _subscribers:
+        _subscribers.append( subscriber )
+
+    if immediate and subscriber not in _immediate_subscribers:
+        _immediate_subscribers.append( subscriber )
+
+
+def unsubscribe( subscriber ):
+    if subscriber in _subscribers:
+        _subscribers.remove( subscriber )
+
+    if subscriber in _immediate_subscribers:
+        _immediate_subscribers.remove( subscriber )
+
+
+def set_publisher( publisher ):
+    '''
+    Set the publisher that forwards batches of changes to other processes. It should implement `publish( events )`.
+    Pass `None` to disable publishing.
+    '''
+    global _publisher
+    _publisher = publisher
+
+
+def publish( events ):
+    '''
+    Publish a batch of `PrivilegeChange`s to in-process subscribers and to the publisher.
+
+    @param events:
+    @type events: list
+    '''
+    _publish( events )
+
+
+def _publish( events, notified=() ):
+    if not events:
+        return
+
+    for subscriber in list( _subscribers ):
+        if subscriber not in notified:
+            subscriber( events )
+
+    if _publisher is not None:
+        _publisher.publish( events )
+
+
+def diff_privileges( before, after ):
+    '''
+    Compute the changes between two states of privileges, as returned by `get_privilege_state`.
+
+    @param before:
+    @type before: dict
+    @param after:
+    @type after: dict
+    @return: a list of `( principal, added, removed )` tuples
+    @rtype: list
+    '''
+    changes = []
+
+    for principal in set( before ).union( after ):
+        previous = before.get( principal, frozenset() )
+        current = after.get( principal, frozenset() )
+
+        if previous != current:
+            changes.append( ( principal, current - previous, previous - current ) )
+
+    return changes
+
+
+def get_privilege_state( privileges ):
+    '''
+    Get a compact representation of privilege data (see `PrivilegeMixin.get_raw_privileges`), as a dict
+    of `principal: frozenset(permissions and roles)`.
+
+    @param privileges:
+    @type privileges: list
+    @return:
+    @rtype: dict
+    '''
+    from .acl import get_privilege_key
+
+    state = {}
+
+    for priv in privileges:
+        principal = get_privilege_key( priv )
+
+        if principal:
+            values = set( priv.get( 'permissions' ) or () )
+            values.update( ROLE_PREFIX + role for role in priv.get( 'roles' ) or () )
+            values.update( DENY_PREFIX + permission for permission in priv.get( 'denied' ) or () )
+            state[ principal ] = state.get( principal, frozenset() ).union( values )
+
+    return state
+
+
+class ChangeBatch( object ):
+    '''
+    Collects `PrivilegeChange`s, coalescing multiple changes for the same principal on the same Document.
+    '''
+
+    def __init__( self ):
+        self.changes = OrderedDict()
+
+    def __len__( self ):
+        return len( self.changes )
+
+    def add( self, change ):
+        '''
+        Add a change that has been persisted. Immediate subscribers are notified right away; the change is
+        published to other subscribers when this batch is flushed.
+
+        @param change:
+        @type change: PrivilegeChange
+        '''
+        for subscriber in list( _immediate_subscribers ):
+            subscriber( [ change ] )
+
+        key = ( change.cls, change.pk, change.principal )
+        previous = self.changes.get( key )
+
+        if previous:
+            added = ( previous.added - change.removed ) | change.added
+            removed = ( previous.removed - change.added ) | ( change.removed - previous.added )
+            change = change._replace( added=added, removed=removed )
+
+        if change.added or change.removed:
+            self.changes[ key ] = change
+        else:
+            self.changes.pop( key, None )
+
+    def flush( self ):
+        '''
+        Publish the collected changes (to subscribers that haven't been notified of them yet), and clear this batch.
+        '''
+        events = list( self.changes.values() )
+        self.changes.clear()
+        _publish( events, notified=list( _immediate_subscribers ) )
+
+
+def get_batch( request ):
+    '''
+    Get the `ChangeBatch` for `request`. It's published automatically when the request finishes.
+
+    @param request:
+    @type request: pyramid.request.Request
+    @return:
+    @rtype: ChangeBatch
+    '''
+    batch = getattr( request, '_privilege_changes', None )
+
+    if batch is None:
+        batch = request._privilege_changes = ChangeBatch()
+
+        if hasattr( request, 'add_finished_callback' ):
+            request.add_finished_callback( lambda request: batch.flush() )
+
+    return batch
+
+
+def flush( request ):
+    '''
+    Publish the changes collected for `request` right away.
+    '''
+    batch = getattr( request, '_privilege_changes', None )
+    batch is not None and batch.flush()
+
+
+class InMemoryTransport( object ):
+    '''
+    A publisher that keeps published events in memory, and delivers them to its own subscribers (standing in
+    for other processes). Useful for testing.
+    '''
+
+    def __init__( self ):
+        self.events = []
+        self.subscribers = []
+
+    def subscribe( self, subscriber ):
+        self.subscribers.append( subscriber )
+
+    def publish( self, events ):
+        self.events.extend( events )
+
+        for subscriber in self.subscribers:
+            subscriber( events )
@@ -2,7 +2,12 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import logging
-import collections
+import sys
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 
 log = logging.getLogger(__name__)
 
@@ -15,24 +20,40 @@ class ApplicationException( Exception ):
             self.code = code
 
 class PermissionError( ApplicationException ):
-    def __init__( self, request, attribute_name, permission='?', **kwargs ):
-        # Determine the name of the class throwing the error
-        import inspect
-        frame, module, line, function, context, index = inspect.stack()[1]
-        self_argument = frame.f_code.co_varnames[ 0 ]  # This *should* be 'self'.
-        instance = frame.f_locals[ self_argument ]
-        class_name = instance.__class__.__name__
-
-        if not isinstance( attribute_name,  basestring ) and isinstance( attribute_name, collections.Iterable ):
+    def __init__( self, request, attribute_name, permission='?', instance=None, document_class=None, **kwargs ):
+        '''
+        @param request:
+        @param attribute_name: the attribute(s) (or action) that required `permission`
+        @param permission:
+        @param instance: the Document `permission` was denied on; defaults to the first of `objects`
+        @param document_class: the class of the Document; defaults to the class of `instance`
+        @param objects: the Documents `permission` was denied on; defaults to `[ instance ]`
+        '''
+        if 'objects' in kwargs:
+            self.objects = kwargs[ 'objects' ]
+            if instance is None and self.objects:
+                instance = self.objects[ 0 ]
+
+        if instance is None:
+            # Not given; determine the instance throwing the error from the caller's frame. Only the caller's
+            # frame is needed; unlike `inspect.stack()`, this doesn't read source files for every frame on the stack.
+            frame = sys._getframe( 1 )
+            self_argument = frame.f_code.co_varnames[ 0 ]  # This *should* be 'self'.
+            instance = frame.f_locals[ self_argument ]
+
+        if 'objects' not in kwargs:
+            self.objects = [ instance ]
+
+        if document_class is None:
+            document_class = instance.__class__
+        class_name = document_class.__name__
+
+        if not isinstance( attribute_name,  basestring ) and isinstance( attribute_name, Iterable ):
             if len( attribute_name ) == 1:
                 attribute_name = list( attribute_name )[ 0 ]
             else:
                 attribute_name = '(' + ', '.join( attribute_name ) + ')'
-        if 'objects' in kwargs:
-            self.objects = kwargs[ 'objects' ]
-        else:
-            self.objects = [ instance ]
 
         message = "Permission denied; `{}` required for {}.{}".format( permission, class_name, attribute_name )
-        log.info( 'PermissionError for user id="{}" on {} id="{}". Message="{}"'.format( request.user.id, class_name, instance.id, message ) )
+        log.info( 'PermissionError for user id="{}" on {} id="{}". Message="{}"'.format( request.user.id, class_name, getattr( instance, 'id', None ), message ) )
         super( PermissionError, self ).__init__( message, code=100 )
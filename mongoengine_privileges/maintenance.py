@@ -0,0 +1,683 @@
+'''
+Maintenance for `privileges` stored in collections of `PrivilegeMixin` documents.
+
+Operates on the raw documents (using pymongo), so it can run without the Document classes being importable,
+for example from the command line:
+
+    mongoengine-privileges-compact --db mydb directory file --dry-run
+
+Large collections can be processed in parallel by `rebuild_privileges`, which partitions a collection by `_id`
+ranges and processes them in a pool of worker processes (with checkpointing, so an interrupted run can be
+resumed):
+
+    mongoengine-privileges-compact --db mydb file --processes 8 --checkpoint file.checkpoint
+
+Since these functions bypass `PrivilegeMixin`, they clear the configured `SnapshotStore` (see
+`mongoengine_privileges.snapshot`) after modifying privileges; from the command line, pass the path of the
+store with `--snapshot-store`.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from .acl import normalize_user_id
+from . import snapshot
+
+log = logging.getLogger( __name__ )
+
+
+def get_collection( collection ):
+    '''
+    @param collection: a pymongo Collection, or a Document class
+    @return:
+    @rtype: pymongo.collection.Collection
+    '''
+    return collection._get_collection() if hasattr( collection, '_get_collection' ) else collection
+
+
+def clear_snapshots():
+    '''
+    Clear the configured `SnapshotStore` (if any), after privileges have been modified directly in the database.
+    '''
+    store = snapshot.get_snapshot_store()
+    store is not None and store.clear()
+
+
+def compact_privilege_list( privileges, stats=None ):
+    '''
+    Compact a list of raw privileges: `user` values are normalized, privileges for the same principal (and
+    expiry) are merged, and privileges without any permissions, roles or denied permissions are dropped.
+
+    @param privileges: raw privileges (a list of dicts)
+    @type privileges: list
+    @param stats: a dict of counters to update (`merged`, `dropped` and `normalized`)
+    @type stats: dict
+    @return:
+    @rtype: list
+    '''
+    stats = stats if stats is not None else {}
+    compacted = OrderedDict()
+
+    for priv in privileges or ():
+        priv = dict( priv )
+
+        if priv.get( 'user' ) is not None:
+            user = normalize_user_id( priv[ 'user' ] )
+            if user is not priv[ 'user' ]:
+                stats[ 'normalized' ] = stats.get( 'normalized', 0 ) + 1
+            priv[ 'user' ] = user
+            key = ( 'user', user, priv.get( 'expires' ) )
+        else:
+            key = ( 'group', priv.get( 'group' ), priv.get( 'expires' ) )
+
+        existing = compacted.get( key )
+
+        if existing is None:
+            compacted[ key ] = priv
+        else:
+            stats[ 'merged' ] = stats.get( 'merged', 0 ) + 1
+            for name in ( 'permissions', 'roles', 'denied' ):
+                values = existing.get( name ) or []
+                additional = [ value for value in priv.get( name ) or () if value not in values ]
+                if additional:
+                    existing[ name ] = values + additional
+
+    result = []
+
+    for priv in compacted.values():
+        if priv.get( 'permissions' ) or priv.get( 'roles' ) or priv.get( 'denied' ):
+            result.append( priv )
+        else:
+            stats[ 'dropped' ] = stats.get( 'dropped', 0 ) + 1
+
+    return result
+
+
+# The fields of a raw privilege; see `get_privileges_filter`
+PRIVILEGE_FIELDS = ( 'user', 'group', 'permissions', 'roles', 'denied', 'expires' )
+
+
+def get_privileges_filter( doc_id, privileges ):
+    '''
+    Get a filter that matches the document identified by `doc_id` only if its `privileges` are still equal to
+    `privileges`, regardless of the order of the keys in each privilege (which isn't preserved when documents
+    are decoded into dicts, on Python 2). Each field is matched by its path; known fields that are missing
+    from a privilege must still be missing.
+
+    @param doc_id:
+    @param privileges: raw privileges (a list of dicts)
+    @type privileges: list
+    @return:
+    @rtype: dict
+    '''
+    query = { '_id': doc_id, 'privileges': { '$size': len( privileges ) } }
+
+    def add( path, value ):
+        if isinstance( value, dict ):
+            query[ path ] = { '$type': 'object' }
+            for key, item in value.items():
+                add( '{}.{}'.format( path, key ), item )
+        else:
+            query[ path ] = value
+
+    for index, priv in enumerate( privileges ):
+        for name in PRIVILEGE_FIELDS:
+            if name not in priv:
+                query[ 'privileges.{}.{}'.format( index, name ) ] = { '$exists': False }
+        for name, value in priv.items():
+            add( 'privileges.{}.{}'.format( index, name ), value )
+
+    return query
+
+
+class CompactionReport( object ):
+    '''
+    Progress and results for `compact_privileges`.
+    '''
+
+    def __init__( self, dry_run=False ):
+        self.dry_run = dry_run
+        self.scanned = 0
+        self.modified = 0
+        self.written = 0
+        self.conflicts = 0
+        self.batches = 0
+        self.stats = { 'merged': 0, 'dropped': 0, 'normalized': 0 }
+        self.started = time.time()
+
+    @property
+    def elapsed( self ):
+        return time.time() - self.started
+
+    @property
+    def rate( self ):
+        elapsed = self.elapsed
+        return self.scanned / elapsed if elapsed else 0.0
+
+    def as_dict( self ):
+        result = dict( dry_run=self.dry_run, scanned=self.scanned, modified=self.modified, written=self.written,
+            conflicts=self.conflicts, batches=self.batches, elapsed=self.elapsed, rate=self.rate )
+        result.update( self.stats )
+        return result
+
+    def __unicode__( self ):
+        return unicode( '{}scanned={scanned}, modified={modified}, written={written}, conflicts={conflicts}, merged={merged}, '
+            'dropped={dropped}, normalized={normalized} in {elapsed:.1f}s ({rate:.0f} docs/s)'.format( 'DRY RUN: ' if self.dry_run else '', **self.as_dict() ) )
+
+    __str__ = __unicode__
+
+
+def compact_privileges( collection, query=None, batch_size=1000, dry_run=False, progress=None ):
+    '''
+    Stream all documents in `collection` (matching `query`) in batches, and compact their privileges (see
+    `compact_privilege_list`). Modified privileges are written back using a bulk write per batch. Each update
+    only applies if `privileges` hasn't been modified concurrently.
+
+    @param collection: a pymongo Collection, or a Document class
+    @param query: restrict compaction to documents matching `query`
+    @type query: dict
+    @param batch_size:
+    @type batch_size: int
+    @param dry_run: only report what would be changed
+    @type dry_run: bool
+    @param progress: a callable, invoked with the `CompactionReport` after each batch
+    @return:
+    @rtype: CompactionReport
+    '''
+    collection = get_collection( collection )
+    report = CompactionReport( dry_run=dry_run )
+    return process_privileges( collection, compact_privilege_list, query=query, batch_size=batch_size,
+        dry_run=dry_run, report=report, progress=progress )
+
+
+def process_privileges( collection, processor, query=None, batch_size=1000, dry_run=False, report=None, progress=None ):
+    '''
+    Stream the `privileges` of all documents in `collection` (matching `query`), and write back the privileges
+    returned by `processor` where they differ, using a bulk write per batch. Each update only applies if
+    `privileges` hasn't been modified concurrently (see `get_privileges_filter`); updates that don't apply are
+    counted (and logged) as `conflicts`, and can be retried by running again.
+
+    @param collection: a pymongo Collection
+    @param processor: a callable, invoked for each document as `processor( privileges, stats )`; it should return
+        the new (raw) privileges, and can count what it did in the `stats` dict. See `compact_privilege_list`.
+    @param query:
+    @type query: dict
+    @param batch_size:
+    @type batch_size: int
+    @param dry_run:
+    @type dry_run: bool
+    @param report:
+    @type report: CompactionReport
+    @param progress: a callable, invoked with `report` after each batch
+    @return:
+    @rtype: CompactionReport
+    '''
+    from pymongo import UpdateOne
+
+    report = report or CompactionReport( dry_run=dry_run )
+    operations = []
+
+    def flush():
+        if operations and not dry_run:
+            result = collection.bulk_write( operations, ordered=False )
+            report.written += result.modified_count
+            conflicts = len( operations ) - result.matched_count
+
+            if conflicts:
+                report.conflicts += conflicts
+                log.warning( '{}: {} documents were modified concurrently, and have been skipped'.format( collection.name, conflicts ) )
+        report.batches += 1
+        del operations[ : ]
+        progress and progress( report )
+
+    for doc in collection.find( query or {}, { 'privileges': 1 } ).batch_size( batch_size ):
+        report.scanned += 1
+        privileges = doc.get( 'privileges' ) or []
+        processed = processor( privileges, report.stats )
+
+        if processed != privileges:
+            report.modified += 1
+            operations.append( UpdateOne( get_privileges_filter( doc[ '_id' ], privileges ), { '$set': { 'privileges': processed } } ) )
+
+        if report.scanned % batch_size == 0:
+            flush()
+
+    if operations or report.scanned % batch_size:
+        flush()
+
+    report.written and clear_snapshots()
+    return report
+
+
+class PermissionVerifier( object ):
+    '''
+    A processor (see `process_privileges`) that checks privileges against the permissions and roles that are
+    currently defined, for example after changing `meta['permissions']` or `meta['roles']`. Unknown permissions
+    (granted or denied) and roles are counted as `unknown_permissions` and `unknown_roles`; if `fix` is set,
+    they're removed as well.
+    '''
+
+    def __init__( self, permissions, roles=(), fix=False ):
+        '''
+        @param permissions: the known permissions
+        @type permissions: iterable
+        @param roles: the known roles
+        @type roles: iterable
+        @param fix: remove unknown permissions and roles
+        @type fix: bool
+        '''
+        self.permissions = frozenset( permissions )
+        self.roles = frozenset( roles )
+        self.fix = fix
+
+    @classmethod
+    def for_document( cls, document, permissions=(), fix=False ):
+        '''
+        Create a PermissionVerifier for the permissions and roles declared by a `PrivilegeMixin` Document class.
+
+        @param document: a `PrivilegeMixin` Document class
+        @param permissions: additional known permissions (that are checked in application code, for example)
+        @type permissions: iterable
+        @param fix:
+        @type fix: bool
+        @return:
+        @rtype: PermissionVerifier
+        '''
+        roles = document.get_roles()
+        known = set( permissions ).union( document.get_declared_permissions(), *roles.values() )
+        return cls( known, roles, fix=fix )
+
+    def __call__( self, privileges, stats ):
+        result = []
+
+        for priv in privileges or ():
+            fixed = dict( priv )
+
+            for name, known, counter in ( ( 'permissions', self.permissions, 'unknown_permissions' ),
+                    ( 'denied', self.permissions, 'unknown_permissions' ), ( 'roles', self.roles, 'unknown_roles' ) ):
+                values = priv.get( name ) or []
+                unknown = [ value for value in values if value not in known ]
+
+                if unknown:
+                    stats[ counter ] = stats.get( counter, 0 ) + len( unknown )
+                    fixed[ name ] = [ value for value in values if value in known ]
+
+            result.append( fixed if self.fix else priv )
+
+        return result
+
+
+def get_id_ranges( collection, partitions, query=None ):
+    '''
+    Partition the documents in `collection` (matching `query`) into (at most) `partitions` ranges of `_id`s
+    of roughly equal size.
+
+    @param collection: a pymongo Collection
+    @param partitions:
+    @type partitions: int
+    @param query:
+    @type query: dict
+    @return: a list of `( lower, upper )` tuples; `lower` is inclusive and `upper` is exclusive. The first
+        range has no lower bound and the last has no upper bound (`None`).
+    @rtype: list
+    '''
+    total = collection.count_documents( query or {} )
+    bounds = []
+
+    for index in range( 1, partitions ):
+        cursor = collection.find( query or {}, { '_id': 1 } ).sort( '_id', 1 ).skip( total * index // partitions ).limit( 1 )
+        doc = next( iter( cursor ), None )
+
+        if doc is not None and ( not bounds or doc[ '_id' ] != bounds[ -1 ] ):
+            bounds.append( doc[ '_id' ] )
+
+    edges = [ None ] + bounds + [ None ]
+    return list( zip( edges[ : -1 ], edges[ 1 : ] ) )
+
+
+def get_range_query( query, lower, upper ):
+    '''
+    Restrict `query` to documents with an `_id` in the range `[lower, upper)`.
+
+    @return:
+    @rtype: dict
+    '''
+    id_query = {}
+
+    if lower is not None:
+        id_query[ '$gte' ] = lower
+    if upper is not None:
+        id_query[ '$lt' ] = upper
+
+    if not id_query:
+        return query or {}
+
+    return { '$and': [ query, { '_id': id_query } ] } if query else { '_id': id_query }
+
+
+class DatabaseFactory( object ):
+    '''
+    Connects to a MongoDB database. Used by `rebuild_privileges` to give each worker process its own connection.
+    '''
+
+    def __init__( self, host, db ):
+        self.host = host
+        self.db = db
+
+    def __call__( self ):
+        from pymongo import MongoClient
+        return MongoClient( self.host )[ self.db ]
+
+
+# The database connection for this (worker) process
+_worker_state = {}
+
+
+def _init_worker( database_factory ):
+    _worker_state[ 'db' ] = database_factory()
+
+
+def process_partition( task ):
+    '''
+    Process a single `_id` range of a collection in a worker process; see `rebuild_privileges`.
+
+    @param task: a tuple of `( collection name, partition index, lower, upper, query, processor, batch_size, dry_run )`
+    @type task: tuple
+    @return: the results for this partition
+    @rtype: dict
+    '''
+    collection_name, index, lower, upper, query, processor, batch_size, dry_run = task
+    collection = _worker_state[ 'db' ][ collection_name ]
+
+    report = process_privileges( collection, processor, query=get_range_query( query, lower, upper ),
+        batch_size=batch_size, dry_run=dry_run, report=CompactionReport( dry_run=dry_run ) )
+
+    return dict( index=index, pid=os.getpid(), scanned=report.scanned, modified=report.modified,
+        written=report.written, conflicts=report.conflicts, stats=report.stats, elapsed=report.elapsed )
+
+
+class RebuildReport( object ):
+    '''
+    Progress and results for `rebuild_privileges`, in total and per worker process.
+    '''
+
+    def __init__( self, partitions, dry_run=False ):
+        self.partitions = partitions
+        self.dry_run = dry_run
+        self.completed = 0
+        self.skipped = 0
+        self.scanned = 0
+        self.modified = 0
+        self.written = 0
+        self.conflicts = 0
+        self.stats = {}
+        self.workers = {}
+        self.started = time.time()
+
+    @property
+    def elapsed( self ):
+        return time.time() - self.started
+
+    @property
+    def rate( self ):
+        elapsed = self.elapsed
+        return self.scanned / elapsed if elapsed else 0.0
+
+    def add( self, result ):
+        '''
+        Add the results for a partition (see `process_partition`).
+        '''
+        self.completed += 1
+        self.scanned += result[ 'scanned' ]
+        self.modified += result[ 'modified' ]
+        self.written += result[ 'written' ]
+        self.conflicts += result.get( 'conflicts', 0 )
+
+        for name, value in result[ 'stats' ].items():
+            self.stats[ name ] = self.stats.get( name, 0 ) + value
+
+        worker = self.workers.setdefault( result[ 'pid' ], { 'partitions': 0, 'scanned': 0, 'elapsed': 0.0 } )
+        worker[ 'partitions' ] += 1
+        worker[ 'scanned' ] += result[ 'scanned' ]
+        worker[ 'elapsed' ] += result[ 'elapsed' ]
+
+    def get_worker_rates( self ):
+        '''
+        @return: the throughput (in documents per second) for each worker process, keyed by pid
+        @rtype: dict
+        '''
+        return dict( ( pid, worker[ 'scanned' ] / worker[ 'elapsed' ] if worker[ 'elapsed' ] else 0.0 )
+            for pid, worker in self.workers.items() )
+
+    def as_dict( self ):
+        result = dict( dry_run=self.dry_run, partitions=self.partitions, completed=self.completed, skipped=self.skipped,
+            scanned=self.scanned, modified=self.modified, written=self.written, conflicts=self.conflicts,
+            elapsed=self.elapsed, rate=self.rate )
+        result.update( self.stats )
+        return result
+
+    def __unicode__( self ):
+        workers = ', '.join( '{}: {:.0f} docs/s'.format( pid, rate ) for pid, rate in sorted( self.get_worker_rates().items() ) )
+        return unicode( '{}{completed}/{partitions} partitions ({skipped} skipped), scanned={scanned}, modified={modified}, '
+            'written={written}, conflicts={conflicts} in {elapsed:.1f}s ({rate:.0f} docs/s; {workers})'.format(
+            'DRY RUN: ' if self.dry_run else '', workers=workers, **self.as_dict() ) )
+
+    __str__ = __unicode__
+
+
+def load_checkpoint( path ):
+    '''
+    @return: the checkpoint stored at `path`, or `None` if it doesn't exist
+    @rtype: dict
+    '''
+    from bson import json_util
+
+    if not path or not os.path.exists( path ):
+        return None
+
+    with open( path ) as f:
+        return json_util.loads( f.read() )
+
+
+def save_checkpoint( path, checkpoint ):
+    '''
+    Write `checkpoint` to `path`, replacing the previous checkpoint atomically.
+    '''
+    from bson import json_util
+
+    temp_path = '{}.tmp'.format( path )
+
+    with open( temp_path, 'w' ) as f:
+        f.write( json_util.dumps( checkpoint ) )
+
+    os.rename( temp_path, path )
+
+
+def rebuild_privileges( database_factory, collection_name, processor=compact_privilege_list, query=None, partitions=None,
+        processes=None, batch_size=1000, dry_run=False, checkpoint=None, progress=None ):
+    '''
+    Process the `privileges` of all documents in a (large) collection in parallel; see `process_privileges`.
+    The collection is partitioned into `_id` ranges, which are processed by a pool of `processes` worker
+    processes. Each worker connects to the database using `database_factory`.
+
+    If a `checkpoint` path is given, the partitioning and the results for each completed partition are stored
+    there; running again with the same checkpoint skips the partitions that have been completed already. If the
+    run is interrupted (by an exception, or from `progress`), the worker processes are terminated right away.
+
+    @param database_factory: a picklable callable that returns a pymongo Database (see `DatabaseFactory`)
+    @param collection_name:
+    @type collection_name: string
+    @param processor: a picklable callable that processes the privileges for each document; see `process_privileges`
+    @param query: restrict processing to documents matching `query`
+    @type query: dict
+    @param partitions: the number of `_id` ranges; defaults to 4 per process
+    @type partitions: int
+    @param processes: the number of worker processes; defaults to the number of CPUs. With a single process,
+        partitions are processed in the current process.
+    @type processes: int
+    @param batch_size:
+    @type batch_size: int
+    @param dry_run:
+    @type dry_run: bool
+    @param checkpoint: the path of a checkpoint file
+    @type checkpoint: string
+    @param progress: a callable, invoked with the `RebuildReport` after each partition
+    @return:
+    @rtype: RebuildReport
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    state = load_checkpoint( checkpoint )
+
+    if state is None:
+        collection = database_factory()[ collection_name ]
+        ranges = get_id_ranges( collection, partitions or processes * 4, query )
+        state = { 'collection': collection_name, 'query': json.dumps( query or {}, sort_keys=True, default=str ),
+            'ranges': ranges, 'completed': {} }
+    elif state[ 'collection' ] != collection_name or state[ 'query' ] != json.dumps( query or {}, sort_keys=True, default=str ):
+        raise ValueError( 'Checkpoint `{}` is for a different collection or query'.format( checkpoint ) )
+
+    report = RebuildReport( len( state[ 'ranges' ] ), dry_run=dry_run )
+    tasks = []
+
+    for index, ( lower, upper ) in enumerate( state[ 'ranges' ] ):
+        if str( index ) in state[ 'completed' ]:
+            report.skipped += 1
+        else:
+            tasks.append( ( collection_name, index, lower, upper, query, processor, batch_size, dry_run ) )
+
+    pool = None
+
+    if processes == 1:
+        _init_worker( database_factory )
+        results = ( process_partition( task ) for task in tasks )
+    else:
+        pool = multiprocessing.Pool( processes, _init_worker, ( database_factory, ) )
+        results = pool.imap_unordered( process_partition, tasks )
+
+    try:
+        for result in results:
+            report.add( result )
+            state[ 'completed' ][ str( result[ 'index' ] ) ] = result
+            checkpoint and save_checkpoint( checkpoint, state )
+            progress and progress( report )
+    except BaseException:
+        # Partitions that are being processed are processed again when resuming
+        pool is not None and pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        report.written and clear_snapshots()
+
+    return report
+
+
+def ensure_expiry_index( collection ):
+    '''
+    Create a (sparse) index on `privileges.expires`, used by `sweep_expired_privileges`.
+
+    @param collection: a pymongo Collection, or a Document class
+    '''
+    get_collection( collection ).create_index( 'privileges.expires', sparse=True, background=True )
+
+
+def sweep_expired_privileges( collections, now=None, ensure_index=True ):
+    '''
+    Remove all privileges that have expired at `now` from documents in `collections`, using a single `$pull`
+    update per collection; documents aren't loaded.
+
+    @param collections: a list of pymongo Collections, or Document classes
+    @type collections: list
+    @param now: defaults to `datetime.utcnow()`
+    @type now: datetime
+    @param ensure_index: create the index on `privileges.expires` if it doesn't exist yet
+    @type ensure_index: bool
+    @return: the number of documents modified in each collection, keyed by collection name
+    @rtype: dict
+    '''
+    now = now or datetime.utcnow()
+    results = OrderedDict()
+
+    for collection in collections:
+        collection = get_collection( collection )
+        ensure_index and ensure_expiry_index( collection )
+        result = collection.update_many( { 'privileges.expires': { '$lte': now } },
+            { '$pull': { 'privileges': { 'expires': { '$lte': now } } } } )
+        results[ collection.name ] = result.modified_count
+
+    any( results.values() ) and clear_snapshots()
+    return results
+
+
+def main( argv=None ):
+    '''
+    Command line entry point for `compact_privileges`, and for verifying privileges with a `PermissionVerifier`.
+    '''
+    import argparse
+    import importlib
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser( description='Merge duplicate privileges, drop empty privileges and normalize principals, '
+        'or verify privileges against the permissions and roles of a Document class.' )
+    parser.add_argument( 'collections', nargs='+', help='the collections to compact' )
+    parser.add_argument( '--host', default='mongodb://localhost:27017' )
+    parser.add_argument( '--db', required=True )
+    parser.add_argument( '--batch-size', type=int, default=1000 )
+    parser.add_argument( '--dry-run', action='store_true', help='report changes without writing them' )
+    parser.add_argument( '--sweep-expired', action='store_true', help='remove expired privileges instead' )
+    parser.add_argument( '--processes', type=int, help='compact in parallel, using this number of worker processes' )
+    parser.add_argument( '--partitions', type=int, help='the number of `_id` ranges to partition each collection into' )
+    parser.add_argument( '--checkpoint', help='checkpoint file (one per collection) for resuming a parallel run' )
+    parser.add_argument( '--snapshot-store', help='the ACL snapshot store to clear after modifying privileges' )
+    parser.add_argument( '--verify', metavar='DOCUMENT', help='verify privileges against the permissions and roles '
+        'declared by a Document class (`package.module:Class`) instead of compacting them' )
+    parser.add_argument( '--permissions', nargs='*', default=[], help='additional known permissions for --verify' )
+    parser.add_argument( '--fix', action='store_true', help='remove unknown permissions and roles found by --verify' )
+    args = parser.parse_args( argv )
+
+    logging.basicConfig( level=logging.INFO )
+
+    if args.snapshot_store:
+        snapshot.set_snapshot_store( snapshot.SnapshotStore( args.snapshot_store ) )
+
+    db = MongoClient( args.host )[ args.db ]
+
+    if args.sweep_expired:
+        for name, modified in sweep_expired_privileges( [ db[ name ] for name in args.collections ] ).items():
+            print( '{}: removed expired privileges from {} documents'.format( name, modified ) )
+        return
+
+    if args.verify:
+        module_name, _, class_name = args.verify.partition( ':' )
+        document = getattr( importlib.import_module( module_name ), class_name )
+        processor = PermissionVerifier.for_document( document, args.permissions, fix=args.fix )
+    else:
+        processor = compact_privilege_list
+
+    if args.processes or args.checkpoint:
+        for name in args.collections:
+            checkpoint = args.checkpoint and ( args.checkpoint if len( args.collections ) == 1 else '{}.{}'.format( args.checkpoint, name ) )
+            report = rebuild_privileges( DatabaseFactory( args.host, args.db ), name, processor=processor,
+                partitions=args.partitions, processes=args.processes, batch_size=args.batch_size, dry_run=args.dry_run,
+                checkpoint=checkpoint, progress=lambda report: log.info( '{}: {}'.format( name, report ) ) )
+            print( '{}: {}'.format( name, report ) )
+        return
+
+    for name in args.collections:
+        report = process_privileges( db[ name ], processor, batch_size=args.batch_size, dry_run=args.dry_run,
+            progress=lambda report: log.info( '{}: {}'.format( name, report ) ) )
+        print( '{}: {}'.format( name, report ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,20 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from mongoengine import *
-import mongoengine_privileges
+from mongoengine import DateTimeField, EmbeddedDocument, ListField, ObjectIdField, StringField
+
+from .acl import get_privilege_key, normalize_user_id
 
 class Privilege( EmbeddedDocument ):
     '''
     A class that contains a mapping between a principal (a person or a group) and their permissions
-    for the Document it's embedded into.
+    for the Document it's embedded into. If `expires` is set, the Privilege only applies until then (in UTC).
     '''
 
     permissions = ListField( StringField() )
+    roles = ListField( StringField() )
+    denied = ListField( StringField() )
+    expires = DateTimeField()
     user = ObjectIdField()
     group = StringField()
 
@@ -26,6 +30,7 @@ class Privilege( EmbeddedDocument ):
             permissions = [ permissions ]
 
         self.permissions = permissions
+        self._invalidate_acl()
 
     def add( self, permissions ):
         """
@@ -39,6 +44,7 @@ class Privilege( EmbeddedDocument ):
             permissions = [ permissions ]
 
         self.permissions = list( set( self.permissions ).union( permissions ) )
+        self._invalidate_acl()
 
     def remove( self, permissions ):
         """
@@ -52,7 +58,147 @@ class Privilege( EmbeddedDocument ):
             permissions = [ permissions ]
 
         self.permissions = list( set( self.permissions ).difference( permissions ) )
+        self._invalidate_acl()
+
+    def add_roles( self, roles ):
+        """
+        Add roles (as defined in `meta['roles']` on the Document) to this Privilege
+
+        @param roles:
+        @type roles: string or list or tuple
+        @return:
+        """
+        if isinstance( roles, basestring ):
+            roles = [ roles ]
+
+        self.roles = list( set( self.roles ).union( roles ) )
+        self._invalidate_acl()
+
+    def remove_roles( self, roles ):
+        """
+        Remove roles from this Privilege
+
+        @param roles:
+        @type roles: string or list or tuple
+        @return:
+        """
+        if isinstance( roles, basestring ):
+            roles = [ roles ]
+
+        self.roles = list( set( self.roles ).difference( roles ) )
+        self._invalidate_acl()
+
+    def deny( self, permissions ):
+        """
+        Explicitly deny permissions. Denied permissions take precedence over allowed permissions.
+
+        @param permissions:
+        @type permissions: string or list or tuple
+        @return:
+        """
+        if isinstance( permissions, basestring ):
+            permissions = [ permissions ]
+
+        self.denied = list( set( self.denied ).union( permissions ) )
+        self._invalidate_acl()
+
+    def undeny( self, permissions ):
+        """
+        Remove explicitly denied permissions
+
+        @param permissions:
+        @type permissions: string or list or tuple
+        @return:
+        """
+        if isinstance( permissions, basestring ):
+            permissions = [ permissions ]
+
+        self.denied = list( set( self.denied ).difference( permissions ) )
+        self._invalidate_acl()
+
+    @property
+    def principal_key( self ):
+        """
+        The canonical key for this Privilege's principal (see `acl.get_principal_key`); computed once, and reset
+        when `user` or `group` is assigned.
+        """
+        key = self.__dict__.get( '_principal_key' )
+
+        if key is None:
+            key = self.__dict__[ '_principal_key' ] = get_privilege_key( self._data )
+
+        return key
+
+    def get( self, name, default=None ):
+        """
+        Get the value for field `name`, so Privileges can be evaluated the same way as raw privilege data.
+        """
+        return self._data.get( name, default )
+
+    def normalize( self ):
+        """
+        Normalize `user` to an ObjectId.
+        """
+        user = self._data.get( 'user' )
+
+        if user is not None:
+            normalized = normalize_user_id( user )
+            if normalized is not user:
+                self.user = normalized
+
+    def __setattr__( self, name, value ):
+        if name in ( 'user', 'group' ):
+            self.__dict__.pop( '_principal_key', None )
+
+        super( Privilege, self ).__setattr__( name, value )
+
+    def _invalidate_acl( self ):
+        """
+        Discard the cached ACL on the Document this Privilege is embedded into (if any).
+        """
+        instance = getattr( self, '_instance', None )
+        invalidate_acl = getattr( instance, 'invalidate_acl', None )
+        callable( invalidate_acl ) and invalidate_acl()
 
     def __unicode__( self ):
-        return unicode( 'user={}, group={}: {}'.format( self.user, self.group, self.permissions ) )
+        return unicode( 'user={}, group={}: {} {} denied={}'.format( self.user, self.group, self.permissions, self.roles, self.denied ) )
+
+
+class RawPrivileges( list ):
+    '''
+    A list of privileges as loaded from the database (SON), that hasn't been decoded into `Privilege`s yet.
+    '''
+    pass
+
+
+class PrivilegesField( ListField ):
+    '''
+    A ListField for `Privilege`s that defers decoding its value until it's first accessed. Until then, the raw
+    SON is kept in the Document's `_data`, where it can be read directly by `get_raw_privileges`.
+    '''
+
+    def __get__( self, instance, owner ):
+        if instance is not None:
+            value = instance._data.get( self.name )
+
+            if isinstance( value, RawPrivileges ):
+                instance._data[ self.name ] = super( PrivilegesField, self ).to_python( list( value ) )
+
+        return super( PrivilegesField, self ).__get__( instance, owner )
+
+    def to_python( self, value ):
+        if isinstance( value, list ) and value and isinstance( value[ 0 ], dict ):
+            return RawPrivileges( value )
+
+        return super( PrivilegesField, self ).to_python( value )
+
+    def to_mongo( self, value ):
+        if isinstance( value, RawPrivileges ):
+            return list( value )
+
+        return super( PrivilegesField, self ).to_mongo( value )
 
+    def validate( self, value ):
+        # Raw privileges come straight from the database, and haven't been modified since
+        if not isinstance( value, RawPrivileges ):
+            super( PrivilegesField, self ).validate( value )
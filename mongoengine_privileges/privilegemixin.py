@@ -1,21 +1,70 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import inspect
+from copy import deepcopy
+from datetime import datetime
 
-from pyramid.security import ( Allow, DENY_ALL, has_permission )
-from pyramid.request import Request
-
-from mongoengine import *
+from mongoengine import Document, EmbeddedDocumentField, ListField, ObjectIdField, OperationError, ReferenceField
 from mongoengine_relational import RelationManagerMixin
 from bson import DBRef, ObjectId
 
+from .acl import ( ACLCache, CompiledACL, compile_roles, expand_permissions, get_principal_key, get_privilege_key,
+    get_request_cache, get_request_state, get_version, normalize_user_id )
 from .exceptions import PermissionError
-from .privilege import Privilege
+from . import audit, events, shared, snapshot
+from .privilege import Privilege, PrivilegesField, RawPrivileges
 
 import mongoengine_privileges
 
 
+# Selects all privileges for a principal, regardless of when they expire; see `PrivilegeMixin.remove_permissions`
+ANY_EXPIRY = object()
+
+
+def is_same_expiry( expires, other ):
+    '''
+    Compare two expiry times at millisecond precision, since that's what MongoDB stores.
+
+    @param expires:
+    @type expires: datetime
+    @param other:
+    @type other: datetime
+    @return:
+    @rtype: bool
+    '''
+    if expires is None or other is None:
+        return expires is other
+
+    return expires.replace( microsecond=expires.microsecond // 1000 * 1000 ) == other.replace( microsecond=other.microsecond // 1000 * 1000 )
+
+
+def check_request( request ):
+    '''
+    Raise a ValueError if `request` isn't a `pyramid.request.Request`. Pyramid is imported on first use only.
+
+    @param request:
+    '''
+    from pyramid.request import Request
+
+    if not isinstance( request, Request ):
+        raise ValueError( 'request=`{}` should be an instance of `pyramid.request.Request`'.format( request ) )
+
+
+def requires_fields( *field_names ):
+    '''
+    Decorator for `may_*` methods that declares which fields (besides `privileges`) the method needs in order
+    to decide. Used by `may_by_id` and `may_by_ids` to determine which fields to load.
+
+    @param field_names:
+    @return:
+    '''
+    def decorator( method ):
+        method.required_fields = field_names
+        return method
+
+    return decorator
+
+
 class PrivilegeMixin( RelationManagerMixin ):
     '''
     A class that adds `Privileges` to a Document when inheriting from it.
@@ -27,7 +76,9 @@ class PrivilegeMixin( RelationManagerMixin ):
         'delete': 'delete'
     }
 
-    privileges = ListField( EmbeddedDocumentField( 'Privilege' ) )
+    privileges = PrivilegesField( EmbeddedDocumentField( 'Privilege' ) )
+    # A reference to a `SharedACL`, used instead of `privileges` (see `mongoengine_privileges.shared`)
+    shared_acl = ObjectIdField()
 
     def save( self, request=None, force_insert=False, validate=True, clean=True, write_concern=None,
             cascade=None, cascade_kwargs=None, _refs=None, **kwargs ):
@@ -39,19 +90,32 @@ class PrivilegeMixin( RelationManagerMixin ):
 
         if not request:
             raise ValueError( '`save` needs a `request` parameter (in order to properly invoke `may_*` and `on_change*` callbacks)' )
-        elif not isinstance( request, Request ):
-            raise ValueError( 'request=`{}` should be an instance of `pyramid.request.Request`'.format( request ) )
+
+        check_request( request )
 
         if self.pk is None:
             permission = self.get_permission_for( 'create' )
         else:
             permission = self.get_permission_for( 'update' )
 
+        # All permissions for this save are checked against a single snapshot of the user's principals and this
+        # Document's ACL; each permission is evaluated once
+        state = get_request_state( request )
+        cache = self._get_acl_cache( request )
+        decisions = {}
+
         # A document may be saved if:
         # - it's new,
         # - the required permission for this action has been explicitly set to an empty string (''),
         # - or the user has the appropriate permission
-        if self.may( request, permission ):
+        if self._check_permission( request, permission, state, cache, decisions ):
+            # Persist initial privileges along with a new Document, instead of in a second write
+            if self.pk is None:
+                self.apply_initial_privileges( request )
+
+            self.normalize_privileges()
+            self._reshare()
+
             # Run validation now, since we can pass it `request` so it can check permissions.
             if validate:
                 self.validate()
@@ -60,18 +124,91 @@ class PrivilegeMixin( RelationManagerMixin ):
                 kwargs.setdefault( 'validate', validate )
                 validate = False
 
-            return super( PrivilegeMixin, self ).save( request=request, force_insert=force_insert, validate=validate,
+            result = super( PrivilegeMixin, self ).save( request=request, force_insert=force_insert, validate=validate,
                 clean=clean, write_concern=write_concern, cascade=cascade, cascade_kwargs=cascade_kwargs, _refs=_refs, kwargs=kwargs )
+            self._record_privilege_changes( request )
+            self._update_request_cache( request )
+            self._update_snapshot()
+            audit.record( 'save', self, request, permission, True )
+            return result
         elif self.pk:
             #  Try to save individual fields (relations), since the user may have permission(s) to save these,
             # instead of the complete object.
             # `changed_fields` can also be empty; in that case, just continue (without an error). This may mean
             # that whatever change triggered the call to `save` has been taken care of already by business logic.
-            changed_fields = self.get_changed_fields()
+            changed_fields = tuple( self.get_changed_fields() or () )
             if changed_fields:
-                self.update( request, *changed_fields )
+                permissions = self.get_permissions_for_fields( *changed_fields )
+                self._check_permissions( request, changed_fields, permissions, state, cache, decisions )
+                self._update( request, changed_fields, permissions )
         else:
-            raise PermissionError( request, 'save', permission )
+            audit.record( 'save', self, request, permission, False )
+            raise PermissionError( request, 'save', permission, instance=self )
+
+    @classmethod
+    def insert_many( cls, request, docs ):
+        '''
+        Insert new Documents, using a single bulk insert. The current user needs permission to `create` each of
+        `docs`; initial privileges (see `apply_initial_privileges`) are applied before inserting. Note that
+        `on_change_*` callbacks are not invoked for the inserted Documents.
+
+        @param request:
+        @type request: Request
+        @param docs: new Documents (without a pk)
+        @type docs: list
+        @return: the inserted Documents
+        @rtype: list
+        '''
+        check_request( request )
+        docs = list( docs )
+        permission = cls.get_permission_for( 'create' )
+
+        for doc, allowed in zip( docs, cls.authorize_many( request, docs, permission ) ):
+            if not allowed:
+                audit.record( 'save', doc, request, permission, False )
+                raise PermissionError( request, 'save', permission, document_class=cls, objects=[ doc ] )
+
+        for doc in docs:
+            doc.apply_initial_privileges( request )
+            doc.normalize_privileges()
+            doc.validate()
+
+        if docs:
+            ids = cls.objects.insert( docs, load_bulk=False )
+
+            for doc, pk in zip( docs, ids ):
+                doc.pk = pk
+                doc._clear_changed_fields()
+                doc._created = False
+                doc._record_privilege_changes( request )
+                audit.record( 'save', doc, request, permission, True )
+
+        return docs
+
+    def apply_initial_privileges( self, request ):
+        '''
+        Add the privileges declared in `meta['initial_privileges']` to this (new) Document. It maps principals
+        (group names, or `creator` for `request.user`) to a (list of) permission(s):
+
+            meta = {
+                'initial_privileges': {
+                    'creator': [ 'update', 'update_name' ],
+                    'g:admins': 'update'
+                }
+            }
+
+        This method modifies the `privileges` field on the Document, but doesn't persist changes yet; `save` and
+        `insert_many` call it before inserting a Document.
+
+        @param request:
+        @type request: Request
+        '''
+        for principal, permissions in ( self._meta.get( 'initial_privileges' ) or {} ).items():
+            if principal == 'creator':
+                principal = getattr( request, 'user', None )
+
+            if principal is not None and permissions:
+                self.add_permissions( permissions, principal )
 
     def update( self, request, *args, **kwargs ):
         '''
@@ -84,34 +221,39 @@ class PrivilegeMixin( RelationManagerMixin ):
         @param args: a list of field names that should be updated
         @return:
         '''
-        if not isinstance( request, Request ):
-            raise ValueError( 'request=`{}` should be an instance of `pyramid.request.Request`'.format( request ) )
+        check_request( request )
 
-        permissions = set()
+        permissions = self.get_permissions_for_fields( *args )
+        self._check_permissions( request, args, permissions, get_request_state( request ), self._get_acl_cache( request ), {} )
+        return self._update( request, args, permissions, **kwargs )
 
-        if not args:
-            permissions.add( self.get_permission_for( 'update' ) )
-        else:
-            for field_name in args:
-                if not getattr( self, field_name, None ):
-                    AttributeError( 'Cannot resolve field={} on {}'.format( field_name, self ) )
-
-                # See if an explicit permission has been configured for `field_name`.
-                # An empty string or False mean no permission is required. `None` means no explicit permission has been
-                # defined; in that case, we'll want to check the default permission for update.
-                permission = self.get_permission_for( field_name )
+    def _check_permissions( self, request, field_names, permissions, state, cache, decisions ):
+        '''
+        Check all `permissions` required to update `field_names`, and raise a PermissionError for the first one
+        the user doesn't have. See `_check_permission`.
+        '''
+        # Check `permission`, and update if we're allowed to (if `permission` is `None`, that means it's allowed).
+        for permission in permissions:
+            if not self._check_permission( request, permission, state, cache, decisions ):
+                audit.record( 'update', self, request, permission, False )
+                raise PermissionError( request, field_names, permission, instance=self )
 
-                if permission is None:
-                    permission = self.get_permission_for( 'update' )
+    def _update( self, request, args, permissions, **kwargs ):
+        '''
+        Update `args` (field names) after `permissions` have been checked.
+        '''
+        if ( not args or 'privileges' in args ) and self._reshare() and args and 'shared_acl' not in args:
+            args += ( 'shared_acl', )
 
-                permissions.add( permission )
+        result = super( PrivilegeMixin, self ).update( request, *args, **kwargs )
+        audit.record( 'update', self, request, ', '.join( sorted( permission for permission in permissions if permission ) ), True )
 
-        # Check `permission`, and update if we're allowed to (if `permission` is `None`, that means it's allowed).
-        for permission in permissions:
-            if not self.may( request, permission ):
-                raise PermissionError( request, args, permission )
+        if not args or 'privileges' in args:
+            self._record_privilege_changes( request )
+            self._update_request_cache( request )
+            self._update_snapshot()
 
-        return super( PrivilegeMixin, self ).update( request, *args, **kwargs )
+        return result
 
     def update_privileges( self, request ):
         '''
@@ -121,7 +263,157 @@ class PrivilegeMixin( RelationManagerMixin ):
         @type request: Request
         @return:
         '''
-        super( PrivilegeMixin, self ).update( request, 'privileges' )
+        fields = ( 'privileges', 'shared_acl' ) if self._reshare() else ( 'privileges', )
+        super( PrivilegeMixin, self ).update( request, *fields )
+        self._record_privilege_changes( request )
+        self._update_request_cache( request )
+        self._update_snapshot()
+
+    def share_acl( self, request ):
+        '''
+        Move the privileges on this Document into a shared ACL (see `mongoengine_privileges.shared`), and persist
+        the reference right away. Other Documents can then be pointed at the same shared ACL using `shared_acl`.
+
+        @param request:
+        @type request: Request
+        @return: the id of the shared ACL
+        @rtype: ObjectId
+        '''
+        permission = self.get_permission_for( 'update' )
+
+        if not self.may( request, permission ):
+            audit.record( 'share', self, request, permission, False )
+            raise PermissionError( request, 'share', permission, instance=self )
+
+        self._unshare()
+        self.__dict__.pop( '_unshared_from', None )
+        self.normalize_privileges()
+        self.shared_acl = shared.share( self.get_raw_privileges() )
+        self.privileges = []
+        self.invalidate_acl()
+        super( PrivilegeMixin, self ).update( request, 'privileges', 'shared_acl' )
+        self._update_request_cache( request )
+        self._update_snapshot()
+        audit.record( 'share', self, request, permission, True )
+        return self.shared_acl
+
+    @classmethod
+    def share_acl_many( cls, request, queryset, privileges ):
+        '''
+        Point all Documents in `queryset` the current user is allowed to `update` at the shared ACL for
+        `privileges`, using a single update query. The permission check is pushed down to the database if possible
+        (see `delete_many`).
+
+        Documents that have already been loaded keep evaluating the privileges they were loaded with. Shared ACLs
+        created by other processes are matched once a privilege change event from those processes has been
+        received, or after at most `shared.find_ids_ttl` seconds (see `shared.find_ids`).
+
+        @param request:
+        @type request: Request
+        @param queryset:
+        @type queryset: QuerySet
+        @param privileges: privilege data (see `get_raw_privileges`)
+        @type privileges: list
+        @return: the ids of the Documents the user wasn't allowed to update
+        @rtype: list
+        '''
+        permission = cls.get_permission_for( 'update' )
+        id_field = cls._meta[ 'id_field' ]
+        candidates = list( queryset.clone().scalar( id_field ) )
+
+        if not candidates:
+            return []
+
+        query = cls.get_privileges_query( request, permission )
+
+        if query is not None:
+            permitted = set( queryset.clone().filter( __raw__=query ).scalar( id_field ) )
+        else:
+            docs = list( cls.objects( pk__in=candidates ).only( *cls.get_fields_for_permission( permission ) ) )
+            permitted = set( doc.pk for doc, allowed in zip( docs, cls.authorize_many( request, docs, permission ) ) if allowed )
+
+        if permitted:
+            acl_id = shared.share( privileges )
+            cls.objects( pk__in=list( permitted ) ).update( set__shared_acl=acl_id, set__privileges=[] )
+            cls._invalidate_snapshots( permitted )
+
+        denied = [ pk for pk in candidates if pk not in permitted ]
+
+        for pk in permitted:
+            audit.record( 'share', cls, request, permission, True, pk=pk )
+        for pk in denied:
+            audit.record( 'share', cls, request, permission, False, pk=pk )
+
+        return denied
+
+    def _unshare( self ):
+        '''
+        Copy the privileges of the shared ACL this Document references (if any) into `privileges`, so they can
+        be modified without affecting other Documents (copy-on-write). See `_reshare`.
+        '''
+        acl_id = self._data.get( 'shared_acl' )
+
+        if acl_id is not None:
+            entry = shared.get_entry( acl_id )
+            self.privileges = RawPrivileges( deepcopy( entry.privileges ) )
+            self.shared_acl = None
+            self._unshared_from = entry
+            self.invalidate_acl()
+
+    def _reshare( self ):
+        '''
+        If this Document was using a shared ACL before its privileges were modified, point it at the shared ACL
+        for its current privileges instead (which is the original one if they didn't actually change).
+
+        @return: whether `shared_acl` has to be persisted
+        @rtype: bool
+        '''
+        entry = self.__dict__.pop( '_unshared_from', None )
+
+        if entry is None:
+            return False
+
+        self.normalize_privileges()
+        privileges = [ shared.to_son( priv ) for priv in self.get_raw_privileges() ]
+
+        if privileges:
+            self.shared_acl = entry.id if shared.get_privileges_hash( privileges ) == entry.hash else shared.share( privileges )
+            self.privileges = []
+            self.invalidate_acl()
+
+        return True
+
+    def _snapshot_privileges( self ):
+        '''
+        Record the current state of `privileges` before modifying them (if that hasn't been done since they were
+        last persisted), so the changes can be published once they're persisted. Privileges from a shared ACL
+        are copied into this Document.
+        '''
+        if '_privileges_snapshot' not in self.__dict__:
+            self._privileges_snapshot = events.get_privilege_state( self.get_raw_privileges() )
+
+        self._unshare()
+
+    def _record_privilege_changes( self, request ):
+        '''
+        Add the changes made to `privileges` since `_snapshot_privileges` to the batch of changes for `request`
+        (see `mongoengine_privileges.events`). Without a request, the changes are published right away.
+
+        @param request:
+        @type request: Request
+        '''
+        snapshot = self.__dict__.pop( '_privileges_snapshot', None )
+
+        if snapshot is None:
+            return
+
+        batch = events.get_batch( request ) if request else events.ChangeBatch()
+        state = events.get_privilege_state( self.get_raw_privileges() )
+
+        for principal, added, removed in events.diff_privileges( snapshot, state ):
+            batch.add( events.PrivilegeChange( self.__class__.__name__, self.pk, principal, added, removed ) )
+
+        request or batch.flush()
 
     def delete( self, request, **write_concern ):
         '''
@@ -132,28 +424,334 @@ class PrivilegeMixin( RelationManagerMixin ):
         '''
         permission = self.get_permission_for( 'delete' )
         if self.may( request, permission ):
-            return super( PrivilegeMixin, self ).delete( request=request, write_concern=write_concern )
+            audit.record( 'delete', self, request, permission, True )
+            # The privileges as persisted, in order to publish their removal
+            state = self.__dict__.pop( '_privileges_snapshot', None )
+            if state is None:
+                state = events.get_privilege_state( self.get_raw_privileges() )
+
+            result = super( PrivilegeMixin, self ).delete( request=request, write_concern=write_concern )
+            self._invalidate_snapshots( [ self.pk ] )
+            self._record_removal( request, self.pk, state )
+            self.invalidate_acl()
+            return result
+        else:
+            audit.record( 'delete', self, request, permission, False )
+            raise PermissionError( request, 'delete', permission, instance=self )
+
+    @classmethod
+    def delete_many( cls, request, queryset ):
+        '''
+        Delete all Documents in `queryset` the current user is allowed to `delete`, using a single delete query.
+        If possible, the permission check is pushed down to the database as a filter on `privileges` (see
+        `get_privileges_query`); otherwise, the candidates are loaded and checked using `authorize_many`. When
+        pushed down for a class using shared ACLs, shared ACLs created by other processes are matched once a
+        privilege change event from those processes has been received, or after at most `shared.find_ids_ttl`
+        seconds (see `shared.find_ids`).
+
+        Relations (fields with a `related_name`) pointing at the deleted Documents are cleaned up in bulk as well.
+        Note that per-document `on_change_*` callbacks are not invoked for these related Documents. If a
+        required reference (such as `File.directory`) points at any of the Documents, nothing is deleted and an
+        `OperationError` is raised.
+
+        @param request:
+        @type request: Request
+        @param queryset:
+        @type queryset: QuerySet
+        @return: the ids of the Documents the user wasn't allowed to delete
+        @rtype: list
+        '''
+        check_request( request )
+
+        permission = cls.get_permission_for( 'delete' )
+        id_field = cls._meta[ 'id_field' ]
+        candidates = list( queryset.clone().scalar( id_field ) )
+
+        if not candidates:
+            return []
+
+        query = cls.get_privileges_query( request, permission )
+
+        if query is not None:
+            permitted = set( queryset.clone().filter( __raw__=query ).scalar( id_field ) )
+        else:
+            docs = cls.objects( pk__in=candidates ).only( *cls.get_fields_for_permission( permission ) )
+            docs = list( docs )
+            permitted = set( doc.pk for doc, allowed in zip( docs, cls.authorize_many( request, docs, permission ) ) if allowed )
+
+        denied = [ pk for pk in candidates if pk not in permitted ]
+
+        if permitted:
+            permitted = list( permitted )
+            cls._check_relations( permitted )
+            # Get the privileges of the deleted Documents, in order to publish their removal
+            sons = list( cls._get_collection().find( { '_id': { '$in': permitted } }, { 'privileges': 1, 'shared_acl': 1 } ) )
+
+            cls.objects( pk__in=permitted ).delete()
+            cls._invalidate_snapshots( permitted )
+            cls._clear_relations( permitted )
+
+            for son in sons:
+                privileges = shared.get_entry( son[ 'shared_acl' ] ).privileges if son.get( 'shared_acl' ) else son.get( 'privileges' ) or []
+                cls._record_removal( request, son[ '_id' ], events.get_privilege_state( privileges ) )
+
+        for pk in permitted:
+            audit.record( 'delete', cls, request, permission, True, pk=pk )
+        for pk in denied:
+            audit.record( 'delete', cls, request, permission, False, pk=pk )
+
+        return denied
+
+    @classmethod
+    def _record_removal( cls, request, pk, state ):
+        '''
+        Add the removal of all privileges of a deleted Document to the batch of changes for `request` (see
+        `mongoengine_privileges.events`).
+
+        @param request:
+        @type request: Request
+        @param pk:
+        @param state: the privileges of the Document, as returned by `events.get_privilege_state`
+        @type state: dict
+        '''
+        batch = events.get_batch( request ) if request else events.ChangeBatch()
+
+        for principal, added, removed in events.diff_privileges( state, {} ):
+            batch.add( events.PrivilegeChange( cls.__name__, pk, principal, added, removed ) )
+
+        request or batch.flush()
+
+    @classmethod
+    def _get_relations( cls ):
+        '''
+        Get the relations (fields with a `related_name`) of this Document class.
+
+        @return: a list of `( related class, related field name, related field )` tuples
+        @rtype: list
+        '''
+        relations = []
+
+        for field_name, field in cls._fields.items():
+            related_name = getattr( field, 'related_name', None )
+            reference_field = field.field if isinstance( field, ListField ) else field
+
+            if related_name and isinstance( reference_field, ReferenceField ):
+                related_cls = reference_field.document_type
+                relations.append( ( related_cls, related_name, related_cls._fields.get( related_name ) ) )
+
+        return relations
+
+    @classmethod
+    def _check_relations( cls, ids ):
+        '''
+        Raise an `OperationError` if a required reference on a related Document points at any of the Documents
+        identified by `ids`; clearing it would leave the related Document invalid.
+
+        @param ids:
+        @type ids: list
+        '''
+        for related_cls, related_name, related_field in cls._get_relations():
+            if related_field and related_field.required and not isinstance( related_field, ListField ):
+                if related_cls.objects( **{ '{}__in'.format( related_name ): ids } ).count():
+                    raise OperationError( 'Could not delete `{}` documents; `{}.{}` refers to them'.format(
+                        cls.__name__, related_cls.__name__, related_name ) )
+
+    @classmethod
+    def _clear_relations( cls, ids ):
+        '''
+        Remove references to the Documents identified by `ids` from related Documents, using a single update per
+        relation.
+
+        @param ids:
+        @type ids: list
+        '''
+        for related_cls, related_name, related_field in cls._get_relations():
+            related_docs = related_cls.objects( **{ '{}__in'.format( related_name ): ids } )
+
+            if isinstance( related_field, ListField ):
+                related_docs.update( **{ 'pull_all__{}'.format( related_name ): ids } )
+            elif related_field:
+                related_docs.update( **{ 'unset__{}'.format( related_name ): True } )
+
+    @classmethod
+    def get_privileges_query( cls, request, permission ):
+        '''
+        Get a raw query that matches the Documents on which the current user has been granted `permission`
+        through `privileges`. Returns `None` if `permission` can't be checked in the database: it's implemented
+        by a `may_*` method, the authorization policy isn't an `ACLAuthorizationPolicy`, or this Document class
+        defines a `__parent__` (from which ACLs could be inherited).
+
+        This mirrors the checks done by an `ACLAuthorizationPolicy` on `__acl__`.
+
+        @param request:
+        @type request: Request
+        @param permission:
+        @type permission: string
+        @return:
+        @rtype: dict
+        '''
+        if not permission:
+            return {}
+        elif callable( getattr( cls, 'may_{}'.format( permission ), None ) ):
+            return None
+        elif not get_request_state( request ).uses_acl or getattr( cls, '__parent__', None ) is not None:
+            return None
+
+        principals = list( get_request_state( request ).principals )
+        user_ids = [ ObjectId( principal ) for principal in principals if ObjectId.is_valid( principal ) ]
+        roles = [ role for role, permissions in cls.get_roles().items() if permission in permissions ]
+
+        principal_match = { '$or': [ { 'user': { '$in': user_ids } }, { 'group': { '$in': principals } } ] }
+        expiry_match = { '$or': [ { 'expires': None }, { 'expires': { '$gt': get_request_state( request ).now } } ] }
+
+        if roles:
+            permission_match = { '$or': [ { 'permissions': permission }, { 'roles': { '$in': roles } } ] }
+        else:
+            permission_match = { 'permissions': permission }
+
+        query = { '$and': [
+            { 'privileges': { '$elemMatch': { '$and': [ principal_match, expiry_match, permission_match ] } } },
+            { 'privileges': { '$not': { '$elemMatch': { '$and': [ principal_match, expiry_match, { 'denied': permission } ] } } } }
+        ] }
+
+        if cls._meta.get( 'shared_acl' ):
+            # Match Documents referencing a shared ACL that grants `permission` as well
+            state = get_request_state( request )
+            key = ( cls._class_name, permission, frozenset( state.principals ) )
+            query = { '$or': [ query, { 'shared_acl': { '$in': shared.find_ids( query, key, state.now ) } } ] }
+
+        return query
+
+    @classmethod
+    def get_principals_with_permission( cls, queryset, permission, now=None ):
+        '''
+        Find the principals that have been granted `permission` (directly, or through a role) on Documents in
+        `queryset`, using an aggregation on the database. Returns a dict of `principal: count`, where `principal`
+        is a user id (as a string) or group name, and `count` is the number of Documents the principal has
+        `permission` on; compare it to the size of `queryset` to find principals that have `permission` on all
+        Documents.
+
+        A principal that has been denied `permission` on a Document doesn't count for that Document. Permissions
+        granted to one principal that are denied to another (for example, a user and a group the user is a member
+        of) can't be resolved here; use `may` to check a specific user.
+
+        Users can be stored as an ObjectId, DBRef or string; the aggregation yields the privileges per Document
+        (sorted by Document), which are merged per principal here. Only the counts are kept in memory, so their
+        size depends on the number of principals rather than Documents. The whole of `queryset`'s filter is used;
+        querysets with a `skip` or `limit` aren't supported, and raise a `ValueError`.
+
+        @param queryset:
+        @type queryset: QuerySet
+        @param permission:
+        @type permission: string
+        @param now: privileges that have expired at `now` are ignored; defaults to `datetime.utcnow()`
+        @type now: datetime
+        @return:
+        @rtype: dict
+        '''
+        if queryset._skip or queryset._limit is not None:
+            raise ValueError( '`get_principals_with_permission` does not support querysets with a skip or limit' )
+
+        now = now or datetime.utcnow()
+        roles = [ role for role, permissions in cls.get_roles().items() if permission in permissions ]
+        pipeline = [ { '$match': queryset._query } ]
+
+        if cls._meta.get( 'shared_acl' ):
+            # Use the privileges from shared ACLs as well
+            pipeline += [
+                { '$lookup': { 'from': shared.SharedACL._get_collection_name(), 'localField': 'shared_acl', 'foreignField': '_id', 'as': '_shared_acl' } },
+                { '$project': { 'privileges': { '$concatArrays': [ { '$ifNull': [ '$privileges', [] ] },
+                    { '$ifNull': [ { '$arrayElemAt': [ '$_shared_acl.privileges', 0 ] }, [] ] } ] } } }
+            ]
         else:
-            raise PermissionError( request, 'delete', permission )
+            pipeline.append( { '$project': { 'privileges': 1 } } )
+
+        pipeline += [
+            { '$unwind': '$privileges' },
+            { '$match': { '$and': [
+                { '$or': [ { 'privileges.expires': None }, { 'privileges.expires': { '$gt': now } } ] },
+                { '$or': [ { 'privileges.permissions': permission }, { 'privileges.roles': { '$in': roles } }, { 'privileges.denied': permission } ] }
+            ] } },
+            # A principal can have multiple privileges on a Document; any of them can deny `permission`
+            { '$group': {
+                '_id': { 'document': '$_id', 'user': { '$ifNull': [ '$privileges.user', None ] }, 'group': { '$ifNull': [ '$privileges.group', None ] } },
+                'denied': { '$max': { '$in': [ permission, { '$ifNull': [ '$privileges.denied', [] ] } ] } }
+            } },
+            { '$sort': { '_id.document': 1 } }
+        ]
+
+        counts = {}
+        document, decisions = None, {}
+
+        def count( decisions ):
+            for principal, denied in decisions.items():
+                if not denied:
+                    counts[ principal ] = counts.get( principal, 0 ) + 1
+
+        for result in cls._get_collection().aggregate( pipeline, allowDiskUse=True ):
+            if result[ '_id' ][ 'document' ] != document:
+                count( decisions )
+                document, decisions = result[ '_id' ][ 'document' ], {}
+
+            # The same user can be stored in different ways; any privilege for the user can deny `permission`
+            principal = get_privilege_key( result[ '_id' ] )
+            decisions[ principal ] = decisions.get( principal, False ) or bool( result[ 'denied' ] )
+
+        count( decisions )
+        return counts
+
+    @classmethod
+    def get_principal_index( cls, docs, now=None ):
+        '''
+        Build an inverted index of the privileges on (loaded) `docs` in a single pass: for each permission,
+        the principals that have been granted it (and not denied it), and the pks of the Documents they have it on.
+        This is the in-memory counterpart of `get_principals_with_permission`.
+
+        @param docs:
+        @type docs: list
+        @param now: privileges that have expired at `now` are ignored; defaults to `datetime.utcnow()`
+        @type now: datetime
+        @return: a dict of `{ permission: { principal: set(pks) } }`
+        @rtype: dict
+        '''
+        now = now or datetime.utcnow()
+        docs = list( docs )
+        cls._load_shared_acls( docs )
+        index = {}
+
+        for doc in docs:
+            acl = doc.get_compiled_acl( now )
+
+            for permission, principals in acl.allowed.items():
+                denied = acl.denied.get( permission )
+                by_principal = index.setdefault( permission, {} )
+
+                for principal in ( principals - denied if denied else principals ):
+                    by_principal.setdefault( principal, set() ).add( doc.pk )
+
+        return index
 
     @property
     def __acl__( self ):
-        acl = []
+        from pyramid.security import Allow, Deny, DENY_ALL
 
-        for priv in self.privileges:
-            user = priv[ 'user' ]
-            principal = priv.group
+        denied = []
+        allowed = []
+
+        roles = self.get_roles()
+        now = datetime.utcnow()
+
+        for priv in self.get_raw_privileges():
+            principal = get_privilege_key( priv )
+            expires = priv.get( 'expires' )
 
-            if user:
-                if isinstance( user, ObjectId ):
-                    principal = user
-                elif isinstance( user, DBRef ):
-                    principal = user.id
-                elif isinstance( user, Document ):
-                    principal = user.pk
+            if principal and ( expires is None or expires > now ):
+                if priv.get( 'denied' ):
+                    denied.append( ( Deny, principal, priv[ 'denied' ] ) )
+                allowed.append( ( Allow, principal, expand_permissions( priv, roles ) ) )
 
-            if principal:
-                acl.append( ( Allow, str( principal ), priv.permissions ) )
+        # Explicitly denied permissions take precedence over allowed permissions (for any principal)
+        acl = denied + allowed
 
         # Everything that's not explicitly allowed is forbidden; add a final DENY_ALL
         acl.append( DENY_ALL )
@@ -162,13 +760,287 @@ class PrivilegeMixin( RelationManagerMixin ):
 
         return acl
 
-    def get_permission_for( self, name ):
+    def get_compiled_acl( self, now=None ):
+        '''
+        Get a `CompiledACL` for the current privileges on this Document. It's cached on the Document until
+        `privileges` is reassigned, privileges are added or removed, or `invalidate_acl` is called (which is done
+        by the methods that modify privileges, on both the Document and `Privilege`), until a privilege change
+        event for this Document is published, or until one of its privileges expires.
+
+        @param now: the current time (in UTC); defaults to `datetime.utcnow()`
+        @type now: datetime
+        @return:
+        @rtype: CompiledACL
+        '''
+        return self._compile_acl( self._get_acl_cache(), now or datetime.utcnow() )
+
+    def _compile_acl( self, cache, now ):
+        '''
+        Get the `CompiledACL` from `cache`, (re)compiling it if necessary.
+
+        @param cache:
+        @type cache: ACLCache
+        @param now:
+        @type now: datetime
+        @return:
+        @rtype: CompiledACL
+        '''
+        if cache.acl is not None and not cache.acl.is_valid_at( now ):
+            # A privilege has expired since the ACL was compiled (or it was compiled for a later time)
+            cache.reset()
+
+        if cache.acl is None:
+            cache.acl = CompiledACL( self.get_raw_privileges(), self.get_roles(), now=now )
+
+        return cache.acl
+
+    def _get_acl_cache( self, request=None ):
+        '''
+        For Documents referencing a shared ACL, the cache is shared by all Documents of the same class that
+        reference it. Otherwise, if a `request` is given, the cache is shared by all instances of this Document
+        used during the request (see `RequestCache`), unless this instance has unsaved changes to its privileges.
+
+        @param request:
+        @type request: pyramid.request.Request
+        @return:
+        @rtype: ACLCache
+        '''
+        acl_id = self._data.get( 'shared_acl' )
+
+        if acl_id is not None:
+            return shared.get_entry( acl_id ).get_acl_cache( self.__class__ )
+
+        request_cache = self._get_request_cache( request )
+
+        if request_cache is None:
+            return self._get_document_acl_cache()
+
+        key = ( self.__class__.__name__, self.pk )
+        cache = request_cache.get_acl_cache( key, get_version( *key ) )
+
+        if cache is None:
+            cache = self._get_document_acl_cache()
+            request_cache.set_acl_cache( key, cache )
+
+        return cache
+
+    def _get_document_acl_cache( self ):
+        '''
+        @return: the `ACLCache` for this instance
+        @rtype: ACLCache
+        '''
+        privileges = self._data.get( 'privileges' )
+        version = get_version( self.__class__.__name__, self.pk )
+        cache = self.__dict__.get( '_acl_cache' )
+
+        if cache is None or not cache.is_valid( privileges, version ):
+            cache = self._acl_cache = ACLCache( privileges, version )
+            store = snapshot.get_snapshot_store()
+
+            if store is not None and self.pk is not None and self._data.get( 'shared_acl' ) is None:
+                cache.snapshot_generation = store.get_generation( ( self.__class__.__name__, self.pk ) )
+
+        return cache
+
+    def _get_request_cache( self, request ):
+        '''
+        Get the `RequestCache` for `request`, if this Document can use it: it has been persisted, and its
+        privileges haven't been modified since.
+
+        @param request:
+        @type request: pyramid.request.Request
+        @return:
+        @rtype: RequestCache
+        '''
+        if request is None or self.pk is None or self.has_modified_privileges():
+            return None
+
+        return get_request_cache( request )
+
+    def _update_request_cache( self, request ):
+        '''
+        Store the authorization state for this Document in the `RequestCache` for `request` after its privileges
+        have been persisted, so other instances of this Document used during the request see the changes.
+
+        @param request:
+        @type request: pyramid.request.Request
+        '''
+        request_cache = get_request_cache( request ) if request is not None and self.pk is not None else None
+
+        if request_cache is not None:
+            request_cache.set_acl_cache( ( self.__class__.__name__, self.pk ), self._get_acl_cache() )
+
+    def _update_snapshot( self ):
+        '''
+        Replace the snapshot of this Document's ACL in the `SnapshotStore` (if any) after its privileges have been
+        persisted, so other processes see the changes. See `mongoengine_privileges.snapshot`.
+        '''
+        store = snapshot.get_snapshot_store()
+
+        if store is None or self.pk is None:
+            return
+
+        key = ( self.__class__.__name__, self.pk )
+
+        if self._data.get( 'shared_acl' ) is None:
+            store.put( key, self.get_compiled_acl() )
+        else:
+            store.invalidate( key )
+
+    @classmethod
+    def _invalidate_snapshots( cls, ids ):
+        '''
+        Remove the snapshots for the Documents identified by `ids` from the `SnapshotStore` (if any), after they've
+        been modified or deleted in bulk.
+
+        @param ids:
+        @type ids: iterable
+        '''
+        store = snapshot.get_snapshot_store()
+
+        for pk in ( ids if store is not None else () ):
+            store.invalidate( ( cls.__name__, pk ) )
+
+    def _evaluate_acl( self, cache, state, permission ):
+        '''
+        Evaluate `permission` against this Document's ACL, using the snapshot in the `SnapshotStore` if there is
+        one. Otherwise, the ACL is compiled, and published to the store unless the snapshot has been replaced or
+        invalidated since `cache` was created (in which case this instance may have outdated privileges).
+
+        @param cache:
+        @type cache: ACLCache
+        @param state:
+        @type state: RequestState
+        @param permission:
+        @type permission: string
+        @return:
+        @rtype: bool
+        '''
+        store = snapshot.get_snapshot_store()
+
+        if store is None or cache.snapshot_generation is None or self.has_modified_privileges():
+            return self._compile_acl( cache, state.now ).permits( state.principals, permission )
+
+        key = ( self.__class__.__name__, self.pk )
+        result = store.permits( key, state.principals, permission, state.now )
+
+        if result is None:
+            acl = self._compile_acl( cache, state.now )
+            store.put( key, acl, cache.snapshot_generation )
+            cache.snapshot_generation = None
+            result = acl.permits( state.principals, permission )
+
+        return result
+
+    def has_modified_privileges( self ):
+        '''
+        Check whether this Document's privileges (or its `shared_acl`) have been modified since it was loaded or
+        last persisted.
+
+        @return:
+        @rtype: bool
+        '''
+        if '_privileges_snapshot' in self.__dict__ or '_unshared_from' in self.__dict__:
+            return True
+
+        return any( field == 'shared_acl' or field.split( '.' )[ 0 ] == 'privileges' for field in getattr( self, '_changed_fields', None ) or () )
+
+    def invalidate_acl( self ):
+        '''
+        Discard the cached `CompiledACL` (and cached denials) for this Document.
+        '''
+        self.__dict__.pop( '_acl_cache', None )
+
+    @classmethod
+    def get_roles( cls ):
+        '''
+        Get the roles defined in `meta['roles']`, as a lookup table of `role: frozenset(permissions)`. Roles are
+        compiled once for each Document class.
+
+        @return:
+        @rtype: dict
+        '''
+        roles = cls.__dict__.get( '_compiled_roles' )
+
+        if roles is None:
+            roles = compile_roles( cls._meta.get( 'roles' ) )
+            setattr( cls, '_compiled_roles', roles )
+
+        return roles
+
+    def get_raw_privileges( self ):
+        '''
+        Get the privileges on this Document, without decoding (lazily loaded) privileges into `Privilege`
+        objects. Items are either raw dicts or `Privilege`s, both of which can be read using `get( field_name )`.
+
+        If this Document references a shared ACL, its privileges are returned instead of `privileges`.
+
+        @return:
+        @rtype: list
+        '''
+        acl_id = self._data.get( 'shared_acl' )
+
+        if acl_id is not None:
+            return shared.get_entry( acl_id ).privileges
+
+        return self._data.get( 'privileges' ) or []
+
+    def normalize_privileges( self ):
+        '''
+        Normalize the principals for all (decoded) privileges on this Document; see `Privilege.normalize`.
+        Raw privileges are left as is, since they haven't been modified since they were loaded.
+        '''
+        privileges = self._data.get( 'privileges' )
+
+        if privileges and not isinstance( privileges, RawPrivileges ):
+            for priv in privileges:
+                priv.normalize()
+
+    def get_permissions_for_fields( self, *field_names ):
+        '''
+        Get the set of permissions required to update `field_names`. If no `field_names` are given, this is the
+        permission required to `update` the document as a whole.
+
+        Field names are resolved against the document's field definitions, not against their values, so
+        `ReferenceField`s (and lists of them) are never dereferenced just to determine the required permissions.
+
+        @param field_names: a list of field names that should be updated
+        @return:
+        @rtype: set
+        '''
+        permissions = set()
+
+        if not field_names:
+            permissions.add( self.get_permission_for( 'update' ) )
+        else:
+            for field_name in field_names:
+                # Changes to embedded documents and list items (as reported by `get_changed_fields`) are paths,
+                # such as `privileges.0.permissions`; permissions are configured for their top-level field
+                field_name = field_name.split( '.' )[ 0 ]
+
+                if field_name not in self._fields:
+                    raise AttributeError( 'Cannot resolve field={} on {}'.format( field_name, self ) )
+
+                # See if an explicit permission has been configured for `field_name`.
+                # An empty string or False mean no permission is required. `None` means no explicit permission has been
+                # defined; in that case, we'll want to check the default permission for update.
+                permission = self.get_permission_for( field_name )
+
+                if permission is None:
+                    permission = self.get_permission_for( 'update' )
+
+                permissions.add( permission )
+
+        return permissions
+
+    @classmethod
+    def get_permission_for( cls, name ):
         '''
         @param name: the name of the field for which to look up the appropriate permission
         @return:
         @rtype: string
         '''
-        permissions = self._meta.get( 'permissions', self.default_permissions )
+        permissions = cls._meta.get( 'permissions', cls.default_permissions )
         return permissions.get( name, None )
 
     def may( self, request, permission ):
@@ -187,19 +1059,260 @@ class PrivilegeMixin( RelationManagerMixin ):
         @return:
         @rtype: bool
         '''
+        return self._check_permission( request, permission )
+
+    def _check_permission( self, request, permission, state=None, cache=None, decisions=None ):
+        '''
+        Implementation of `may`. Checks that are part of a single operation can pass in a `RequestState` and
+        `ACLCache` to evaluate against, and a dict of `decisions` made so far, so no permission is evaluated twice.
+
+        @param request:
+        @type request: pyramid.request.Request
+        @param permission:
+        @type permission: string
+        @param state:
+        @type state: RequestState
+        @param cache:
+        @type cache: ACLCache
+        @param decisions:
+        @type decisions: dict
+        @return:
+        @rtype: bool
+        '''
         # Empty/false permissions may pass
         if not permission:
             return True
+        elif decisions is not None and permission in decisions:
+            return decisions[ permission ]
 
         method = getattr( self, 'may_{}'.format( permission ), None )
 
         if callable( method ):
             result = method( request )
         else:
-            result = has_permission( permission, self, request )
-
+            state = state or get_request_state( request )
+
+            # Evaluate our own ACL directly if that's what the authorization policy would do anyway. Only these
+            # decisions are cached; those made by another policy (or through `__parent__`) depend on more than
+            # this Document's privileges.
+            if state.uses_acl and getattr( self, '__parent__', None ) is None:
+                cache = cache or self._get_acl_cache( request )
+                request_cache = self._get_request_cache( request )
+                key = ( self.__class__.__name__, self.pk )
+                # Decisions are cached for the rest of the request
+                result = request_cache.get_decision( key, state.principals, permission ) if request_cache else None
+
+                if result is None:
+                    # Denials are cached until privileges change, or a privilege expires. Only denials made by a
+                    # compiled ACL are cached, since its validity is known.
+                    if cache.is_denied( state.principals, permission, state.now ):
+                        result = False
+                    else:
+                        result = self._evaluate_acl( cache, state, permission )
+
+                    if not result and cache.acl is not None and cache.acl.is_valid_at( state.now ):
+                        cache.add_denied( state.principals, permission )
+
+                    request_cache and request_cache.set_decision( key, state.principals, permission, result )
+            else:
+                from pyramid.security import has_permission
+                result = has_permission( permission, self, request )
+
+        if decisions is not None:
+            decisions[ permission ] = result
+
+        audit.record( 'may', self, request, permission, result )
         return result
 
+    @classmethod
+    def get_fields_for_permission( cls, permission ):
+        '''
+        Get the names of the fields that need to be loaded in order to check `permission`; these are `privileges`,
+        plus the fields declared by the `may_*` method for `permission` (if any) using `requires_fields`.
+
+        @param permission:
+        @type permission: string
+        @return:
+        @rtype: set
+        '''
+        fields = { 'privileges' }
+
+        if cls._meta.get( 'shared_acl' ):
+            fields.add( 'shared_acl' )
+
+        if permission:
+            method = getattr( cls, 'may_{}'.format( permission ), None )
+            fields.update( getattr( method, 'required_fields', () ) )
+
+        return fields
+
+    @classmethod
+    def may_by_id( cls, request, pk, permission ):
+        '''
+        Check if the current user is allowed to execute `permission` on the Document identified by `pk`,
+        without loading the complete Document. See `may_by_ids`.
+
+        @param request: the Request object
+        @type request: pyramid.request.Request
+        @param pk:
+        @param permission:
+        @type permission: string
+        @return: False if the Document doesn't exist
+        @rtype: bool
+        '''
+        return cls.may_by_ids( request, [ pk ], permission )[ pk ]
+
+    @classmethod
+    def may_by_ids( cls, request, pks, permission ):
+        '''
+        Check if the current user is allowed to execute `permission` on each of the Documents identified by `pks`.
+        Only `privileges` (and the fields required by the `may_*` method for `permission`) are fetched, using
+        a single query.
+
+        @param request: the Request object
+        @type request: pyramid.request.Request
+        @param pks:
+        @type pks: list
+        @param permission:
+        @type permission: string
+        @return: a dict of `pk: bool`, keyed by the given `pks`. Documents that don't exist are not permitted.
+        @rtype: dict
+        '''
+        id_field = cls._fields[ cls._meta[ 'id_field' ] ]
+        ids = dict( ( pk, id_field.to_python( pk ) ) for pk in pks )
+        results = {}
+
+        if ids:
+            docs = cls.objects( pk__in=list( set( ids.values() ) ) ).only( *cls.get_fields_for_permission( permission ) )
+
+            docs = list( docs )
+            results = dict( zip( ( doc.pk for doc in docs ), cls.authorize_many( request, docs, permission ) ) )
+
+            # Documents that don't exist are denied as well
+            for pk in set( ids.values() ).difference( results ):
+                audit.record( 'may', cls, request, permission, False, pk=pk )
+
+        return dict( ( pk, results.get( ids[ pk ], False ) ) for pk in pks )
+
+    @classmethod
+    def get_declared_permissions( cls ):
+        '''
+        Get the permissions that are required for the actions and fields configured in `meta['permissions']`
+        (or `default_permissions`).
+
+        @return:
+        @rtype: frozenset
+        '''
+        permissions = cls.__dict__.get( '_declared_permissions' )
+
+        if permissions is None:
+            permissions = frozenset( permission for permission in cls._meta.get( 'permissions', cls.default_permissions ).values() if permission )
+            setattr( cls, '_declared_permissions', permissions )
+
+        return permissions
+
+    def effective_permissions( self, request, as_dict=False ):
+        '''
+        Get all permissions the current user has on this Document, in a single pass over the ACL. Each `may_*`
+        method for a declared permission (see `get_declared_permissions`) is invoked once.
+
+        @param request: the Request object
+        @type request: pyramid.request.Request
+        @param as_dict: return a dict of `permission: bool` (including declared permissions that are not granted)
+            instead of a frozenset of granted permissions
+        @type as_dict: bool
+        @return:
+        @rtype: frozenset or dict
+        '''
+        return self.effective_permissions_many( request, [ self ], as_dict=as_dict )[ 0 ]
+
+    @classmethod
+    def effective_permissions_many( cls, request, docs, as_dict=False ):
+        '''
+        Get all permissions the current user has on each of `docs`; see `effective_permissions`. Permissions
+        implemented by `may_*` methods are evaluated using `authorize_many`, so batch hooks are used if available.
+
+        @param request: the Request object
+        @type request: pyramid.request.Request
+        @param docs:
+        @type docs: list
+        @param as_dict:
+        @type as_dict: bool
+        @return: a frozenset (or dict) for each of `docs`
+        @rtype: list
+        '''
+        docs = list( docs )
+        cls._load_shared_acls( docs )
+        state = get_request_state( request )
+        declared = cls.get_declared_permissions()
+        methods = frozenset( permission for permission in declared if callable( getattr( cls, 'may_{}'.format( permission ), None ) ) )
+        results = []
+
+        for doc in docs:
+            if state.uses_acl and getattr( doc, '__parent__', None ) is None:
+                granted = doc._compile_acl( doc._get_acl_cache( request ), state.now ).get_permissions( state.principals )
+                result = dict( ( permission, permission in granted ) for permission in declared.union( granted ) )
+            else:
+                from pyramid.security import has_permission
+                result = dict( ( permission, bool( has_permission( permission, doc, request ) ) ) for permission in declared - methods )
+
+            results.append( result )
+
+        for permission in methods:
+            for result, allowed in zip( results, cls.authorize_many( request, docs, permission ) ):
+                result[ permission ] = allowed
+
+        if not as_dict:
+            results = [ frozenset( permission for permission, allowed in result.items() if allowed ) for result in results ]
+
+        return results
+
+    @classmethod
+    def authorize_many( cls, request, docs, permission ):
+        '''
+        Check if the current user is allowed to execute `permission` on each of `docs`.
+
+        If `permission` is implemented by a `may_*` method, a batch-aware class-level hook named `may_*_many` can be
+        implemented as well. It's called once for all `docs` with the following signature: ( request, docs ), and
+        should return a bool for each of `docs` (in the same order). If it's not available, `may` is called for
+        each document instead.
+
+        @param request: the Request object
+        @type request: pyramid.request.Request
+        @param docs:
+        @type docs: list
+        @param permission:
+        @type permission: string
+        @return: a bool for each of `docs`
+        @rtype: list
+        '''
+        docs = list( docs )
+
+        if permission and docs:
+            method = getattr( cls, 'may_{}_many'.format( permission ), None )
+
+            if callable( method ):
+                results = [ bool( result ) for result in method( request, docs ) ]
+
+                for doc, result in zip( docs, results ):
+                    audit.record( 'may', doc, request, permission, result )
+
+                return results
+
+        cls._load_shared_acls( docs )
+        return [ doc.may( request, permission ) for doc in docs ]
+
+    @classmethod
+    def _load_shared_acls( cls, docs ):
+        '''
+        Load the shared ACLs referenced by `docs` (that aren't cached yet) using a single query.
+
+        @param docs:
+        @type docs: list
+        '''
+        if cls._meta.get( 'shared_acl' ):
+            shared.load_entries( doc._data.get( 'shared_acl' ) for doc in docs )
+
     def may_create( self, request ):
         '''
         Default implementation for `may_create`, so `create` will be allowed by default.
@@ -209,43 +1322,123 @@ class PrivilegeMixin( RelationManagerMixin ):
         '''
         return mongoengine_privileges.may_create_default
 
-    def grant( self, request, permissions, principal ):
+    def grant( self, request, permissions, principal, roles=None, expires=None ):
         '''
-        Add permissions for the given principal, and persists the updated
-        privileges right away. The permission check for updating the Document
-        is performed before actually removing the permissions.
+        Add permissions (and optionally roles) for the given principal, and
+        persists the updated privileges right away. The permission check for
+        updating the Document is performed before actually removing the permissions.
 
         @param permissions:
         @type permissions: string or list or tuple
         @param principal:
         @param request:
+        @param roles:
+        @type roles: string or list or tuple
+        @param expires: grant the permissions until `expires` (in UTC) only
+        @type expires: datetime
         @return:
         '''
         permission = self.get_permission_for( 'update' )
 
-        if self.may( request, permission ):
-            self.add_permissions( permissions, principal )
+        allowed = self.may( request, permission )
+        audit.record( 'grant', self, request, permission, allowed )
+
+        if allowed:
+            self.add_permissions( permissions, principal, expires=expires )
+            roles and self.add_roles( roles, principal, expires=expires )
             return self.update_privileges( request )
 
-    def revoke( self, request, permissions, principal ):
+    def revoke( self, request, permissions, principal, roles=None, expires=ANY_EXPIRY ):
         '''
-        Remove permissions for the given principal, and persists the updated
-        privileges right away. The permission check for updating the Document
-        is performed before actually removing the permissions, so `revoke` can
-        be used to remove the privilege required for `update`.
+        Remove permissions (and optionally roles) for the given principal, and
+        persists the updated privileges right away. The permission check for
+        updating the Document is performed before actually removing the
+        permissions, so `revoke` can be used to remove the privilege required
+        for `update`.
 
         @param permissions:
         @type permissions: string or list or tuple
         @param principal:
+        @param roles:
+        @type roles: string or list or tuple
+        @param expires: only revoke from the Privilege that expires at `expires` (`None` for the permanent
+            Privilege); by default, permissions are revoked from all of the principal's Privileges
+        @type expires: datetime
         @return:
         '''
         permission = self.get_permission_for( 'update' )
 
-        if self.may( request, permission ):
-            self.remove_permissions( permissions, principal )
+        allowed = self.may( request, permission )
+        audit.record( 'revoke', self, request, permission, allowed )
+
+        if allowed:
+            self.remove_permissions( permissions, principal, expires=expires )
+            roles and self.remove_roles( roles, principal, expires=expires )
+            return self.update_privileges( request )
+
+    def deny( self, request, permissions, principal, expires=None ):
+        '''
+        Explicitly deny permissions for the given principal, and persists the
+        updated privileges right away. Denied permissions take precedence over
+        permissions granted to any principal (for example, to a group the
+        user is a member of), including temporary ones.
+
+        @param permissions:
+        @type permissions: string or list or tuple
+        @param principal:
+        @param request:
+        @param expires: deny the permissions until `expires` (in UTC) only
+        @type expires: datetime
+        @return:
+        '''
+        permission = self.get_permission_for( 'update' )
+
+        allowed = self.may( request, permission )
+        audit.record( 'deny', self, request, permission, allowed )
+
+        if allowed:
+            self.add_denied_permissions( permissions, principal, expires=expires )
             return self.update_privileges( request )
 
-    def set_permissions( self, permissions, principal ):
+    def add_denied_permissions( self, permissions, principal, expires=None ):
+        '''
+        Explicitly deny permissions for a `principal`. This method modifies
+        the `privileges` field on the Document, but doesn't persist changes yet.
+
+        @type permissions: string or list or tuple
+        @type principal: User or string or Privilege
+        @param expires: the expiry time (in UTC) of the denial; `None` to deny the permissions permanently
+        @type expires: datetime
+        @return:
+        @rtype: Privilege
+        '''
+        self._snapshot_privileges()
+        privilege = self.get_privilege( principal, create=True, expires=expires )
+        privilege.deny( permissions )
+        self.invalidate_acl()
+        return privilege
+
+    def remove_denied_permissions( self, permissions, principal, expires=ANY_EXPIRY ):
+        '''
+        Remove explicitly denied permissions for a `principal`. This method
+        modifies the `privileges` field on the Document, but doesn't persist
+        changes yet.
+
+        @type permissions: string or list or tuple
+        @type principal: User or string or Privilege
+        @param expires: only modify the Privilege that expires at `expires`; see `remove_permissions`
+        @type expires: datetime
+        @return: the modified Privileges
+        @rtype: list
+        '''
+        self._snapshot_privileges()
+        privileges = self._get_privileges_for( principal, expires )
+        for privilege in privileges:
+            privilege.undeny( permissions )
+        self.invalidate_acl()
+        return privileges
+
+    def set_permissions( self, permissions, principal, expires=None ):
         '''
         Set permissions, as a (list of) strings, for the given `user`.
         This replaces any previous `permissions` that might be present for
@@ -256,14 +1449,18 @@ class PrivilegeMixin( RelationManagerMixin ):
         @type permissions: string or list or tuple
         @param principal:
         @type principal: User or string or Privilege
+        @param expires: the expiry time (in UTC) of the granted privilege; `None` to grant it permanently
+        @type expires: datetime
         @return:
         @rtype: Privilege
         '''
-        privilege = self.get_privilege( principal, create=True )
+        self._snapshot_privileges()
+        privilege = self.get_privilege( principal, create=True, expires=expires )
         privilege.set( permissions )
+        self.invalidate_acl()
         return privilege
 
-    def add_permissions( self, permissions, principal ):
+    def add_permissions( self, permissions, principal, expires=None ):
         '''
         Add permissions for a `principal`, as a (list of) strings. This method
         modifies the `privileges` field on the Document, but doesn't persist
@@ -271,14 +1468,18 @@ class PrivilegeMixin( RelationManagerMixin ):
 
         @type permissions: string or list or tuple
         @type principal: User or string or Privilege
+        @param expires: the expiry time (in UTC) of the granted privilege; `None` to grant it permanently
+        @type expires: datetime
         @return:
         @rtype: Privilege
         '''
-        privilege = self.get_privilege( principal, create=True )
+        self._snapshot_privileges()
+        privilege = self.get_privilege( principal, create=True, expires=expires )
         privilege.add( permissions )
+        self.invalidate_acl()
         return privilege
 
-    def remove_permissions( self, permissions, principal ):
+    def remove_permissions( self, permissions, principal, expires=ANY_EXPIRY ):
         '''
         Remove permissions for a `principal`, as a (list of) strings. This
         method modifies the `privileges` field on the Document, but doesn't
@@ -288,62 +1489,157 @@ class PrivilegeMixin( RelationManagerMixin ):
         @type permissions: string or list or tuple
         @param principal:
         @type principal: User or string or Privilege
+        @param expires: only modify the Privilege that expires at `expires` (`None` for the permanent
+            Privilege); by default, all of the principal's Privileges are modified
+        @type expires: datetime
+        @return: the modified Privileges
+        @rtype: list
+        '''
+        self._snapshot_privileges()
+        privileges = self._get_privileges_for( principal, expires )
+        for privilege in privileges:
+            privilege.remove( permissions )
+        self.invalidate_acl()
+        return privileges
+
+    def add_roles( self, roles, principal, expires=None ):
+        '''
+        Add roles (as defined in `meta['roles']`) for a `principal`. This
+        method modifies the `privileges` field on the Document, but doesn't
+        persist changes yet.
+
+        @type roles: string or list or tuple
+        @type principal: User or string or Privilege
+        @param expires: the expiry time (in UTC) of the granted privilege; `None` to grant it permanently
+        @type expires: datetime
         @return:
         @rtype: Privilege
         '''
-        privilege = self.get_privilege( principal )
-        privilege and privilege.remove( permissions )
+        self._snapshot_privileges()
+        privilege = self.get_privilege( principal, create=True, expires=expires )
+        privilege.add_roles( roles )
+        self.invalidate_acl()
         return privilege
 
-    def get_privilege( self, principal, create=False ):
+    def remove_roles( self, roles, principal, expires=ANY_EXPIRY ):
+        '''
+        Remove roles for a `principal`. This method modifies the `privileges`
+        field on the Document, but doesn't persist changes yet.
+
+        @type roles: string or list or tuple
+        @type principal: User or string or Privilege
+        @param expires: only modify the Privilege that expires at `expires`; see `remove_permissions`
+        @type expires: datetime
+        @return: the modified Privileges
+        @rtype: list
+        '''
+        self._snapshot_privileges()
+        privileges = self._get_privileges_for( principal, expires )
+        for privilege in privileges:
+            privilege.remove_roles( roles )
+        self.invalidate_acl()
+        return privileges
+
+    def get_privilege( self, principal, create=False, expires=None ):
         '''
         Get the Privilege object on this Document for a given `principal`,
         which can be either a `User` or a group name. If it doesn't exist yet,
         creates a new Privilege and adds it to `self.privileges`.
 
+        A principal can have a (permanent) Privilege, and Privileges that
+        expire at different times; `expires` selects which one is returned.
+
         This method modifies the `privileges` field on the Document, but
         doesn't persist changes yet.
 
+        If this Document references a shared ACL, its privileges are copied into
+        the Document (see `_unshare`) only if `create` is set; otherwise, the
+        Privilege returned is a copy of the one in the shared ACL, and modifying
+        it has no effect.
 
         @param principal:
         @type principal: User or string or Privilege
+        @param create:
+        @type create: bool
+        @param expires: the expiry time of the Privilege to get (or create); `None` for the permanent Privilege
+        @type expires: datetime
         @return:
         @rtype: Privilege
         '''
         if isinstance( principal, Privilege ):
             return principal
 
+        key = get_principal_key( principal )
+
+        if create:
+            # The Privilege returned will be modified; copy the privileges from a shared ACL
+            self._unshare()
+        elif self._data.get( 'shared_acl' ) is not None:
+            for son in shared.get_entry( self._data[ 'shared_acl' ] ).privileges:
+                if get_privilege_key( son ) == key and is_same_expiry( son.get( 'expires' ), expires ):
+                    return Privilege._from_son( deepcopy( son ) )
+
+            return None
+
         privilege = None
 
         for priv in self.privileges:
             # Get the correct privilege.
-            if priv.group == principal or ( isinstance( principal, Document ) and principal.pk and principal.pk == priv[ 'user' ] ):
+            if priv.principal_key == key and is_same_expiry( priv.expires, expires ):
                 privilege = priv
                 break
 
         if not privilege and create:
-            user = principal.pk if isinstance( principal, Document ) else None
             group = principal if isinstance( principal, basestring ) else None
+            user_id = normalize_user_id( principal ) if not group else None
 
-            if not user and not group:
+            if not user_id and not group:
                 raise AttributeError( 'Either a user or group is needed to create a `Privilege`' )
 
-            privilege = Privilege( user=user, group=group )
+            privilege = Privilege( user=user_id, group=group, expires=expires )
             self.privileges.append( privilege )
 
         return privilege
 
-    def remove_privilege( self, principal ):
+    def _get_privileges_for( self, principal, expires=ANY_EXPIRY ):
+        '''
+        Get the Privileges on this Document for `principal` that expire at `expires` (all of them by default), in
+        order to modify them.
+
+        @param principal:
+        @type principal: User or string or Privilege
+        @param expires:
+        @type expires: datetime
+        @return:
+        @rtype: list
+        '''
+        if isinstance( principal, Privilege ):
+            return [ principal ]
+
+        self._unshare()
+        key = get_principal_key( principal )
+
+        return [ priv for priv in self.privileges
+            if priv.principal_key == key and ( expires is ANY_EXPIRY or is_same_expiry( priv.expires, expires ) ) ]
+
+    def remove_privilege( self, principal, expires=ANY_EXPIRY ):
         '''
         Remove all `permissions` (the complete `privilege`) from this Document
         for the given `principal`. This method modifies the `privileges` field
         on the Document, but doesn't persist changes yet.
 
         @param principal: User or string or Privilege
+        @param expires: only remove the Privilege that expires at `expires` (`None` for the permanent
+            Privilege); by default, all of the principal's Privileges are removed
+        @type expires: datetime
         @return:
         '''
-        privilege = self.get_privilege( principal )
-        privilege and self.privileges.remove( privilege )
+        self._snapshot_privileges()
+
+        for privilege in self._get_privileges_for( principal, expires ):
+            self.privileges.remove( privilege )
+
+        self.invalidate_acl()
 
     def clear_privileges( self ):
         '''
@@ -352,4 +1648,5 @@ class PrivilegeMixin( RelationManagerMixin ):
         doesn't persist changes yet.
         @return:
         '''
+        self._snapshot_privileges()
         self.privileges = []
@@ -0,0 +1,267 @@
+'''
+Shared ACLs.
+
+Instead of embedding a copy of the same `privileges` in many Documents (for example, every `File` in a shared
+folder), a `PrivilegeMixin` Document can reference a `SharedACL` through its `shared_acl` field. Shared ACLs are
+immutable and deduplicated by a hash of their contents, so their id identifies a specific version; they're
+cached in-process by id, and loaded once for any number of Documents that reference them.
+
+Modifying the privileges of a Document that references a shared ACL copies them into the Document first
+(copy-on-write); when the Document is persisted, it's pointed at the shared ACL for its new privileges.
+Re-sharing a set of Documents is a single update of their `shared_acl` references; see
+`PrivilegeMixin.share_acl_many`.
+
+Document classes that use shared ACLs should set `meta['shared_acl'] = True`, so permission checks that are
+pushed down to the database (and partial loads for permission checks) take `shared_acl` into account.
+
+Since shared ACLs are immutable, they never have to be invalidated, and any process can cache them without
+coordination. The tradeoff is that a change to a shared ACL (for example, adding a member to a folder) isn't made
+in place: it yields a new shared ACL, and every Document referencing the old one has to be re-pointed using
+`share_acl_many`. That is a single (multi-document) update, but it does write to each of those Documents.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+from mongoengine import Document, EmbeddedDocumentField, ListField, StringField
+
+from . import events
+from .acl import ACLCache, get_privilege_key, normalize_user_id
+from .privilege import Privilege
+
+log = logging.getLogger( __name__ )
+
+
+class SharedACL( Document ):
+    '''
+    A list of privileges shared by any number of `PrivilegeMixin` Documents.
+    '''
+    privileges = ListField( EmbeddedDocumentField( Privilege ) )
+    hash = StringField( required=True )
+
+    meta = {
+        'collection': 'shared_acl',
+        'indexes': [ { 'fields': [ 'hash' ], 'unique': True } ]
+    }
+
+
+class SharedACLEntry( object ):
+    '''
+    A shared ACL as cached in-process: its raw privileges, and an `ACLCache` for each Document class using it
+    (since roles are defined per class).
+    '''
+
+    __slots__ = ( 'id', 'privileges', 'hash', 'acl_caches' )
+
+    def __init__( self, acl_id, privileges, digest ):
+        self.id = acl_id
+        self.privileges = privileges
+        self.hash = digest
+        self.acl_caches = {}
+
+    def get_acl_cache( self, cls ):
+        '''
+        @param cls: the Document class evaluating this ACL
+        @return:
+        @rtype: ACLCache
+        '''
+        cache = self.acl_caches.get( cls )
+
+        if cache is None:
+            cache = self.acl_caches[ cls ] = ACLCache( self.privileges, self.id )
+
+        return cache
+
+
+# Shared ACLs loaded in this process, keyed by id. Since they're immutable, entries never go stale.
+_entries = {}
+max_entries = 10000
+
+# Results of `find_ids`, keyed by the caller's key, as `( ids, valid until )`. They're cleared by privilege change
+# events (see `invalidate`); shared ACLs created by other processes without one are picked up after at most
+# `find_ids_ttl` seconds.
+_found_ids = {}
+find_ids_ttl = 60
+
+
+def get_collection():
+    return SharedACL._get_collection()
+
+
+def to_son( privilege ):
+    '''
+    Get the raw data for `privilege`, with its principal normalized.
+
+    @param privilege: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+    @return:
+    @rtype: dict
+    '''
+    son = dict( privilege ) if isinstance( privilege, dict ) else dict( privilege.to_mongo() )
+
+    if son.get( 'user' ) is not None:
+        son[ 'user' ] = normalize_user_id( son[ 'user' ] )
+
+    return dict( ( key, value ) for key, value in son.items() if value not in ( None, [] ) )
+
+
+def get_privileges_hash( privileges ):
+    '''
+    Get a hash for the contents of `privileges`, independent of the order of privileges (and of the
+    permissions, roles and denied permissions in each).
+
+    @param privileges: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+    @type privileges: list
+    @return:
+    @rtype: string
+    '''
+    canonical = sorted( [
+        get_privilege_key( priv ),
+        priv.get( 'expires' ).isoformat() if priv.get( 'expires' ) else '',
+        sorted( priv.get( 'permissions' ) or () ),
+        sorted( priv.get( 'roles' ) or () ),
+        sorted( priv.get( 'denied' ) or () )
+    ] for priv in privileges )
+
+    return hashlib.sha1( json.dumps( canonical ).encode( 'utf-8' ) ).hexdigest()
+
+
+def share( privileges ):
+    '''
+    Get the id of the shared ACL containing `privileges`, creating it if it doesn't exist yet.
+
+    @param privileges: privilege data (see `PrivilegeMixin.get_raw_privileges`)
+    @type privileges: list
+    @return:
+    @rtype: ObjectId
+    '''
+    from pymongo import ReturnDocument
+    from pymongo.errors import DuplicateKeyError
+
+    privileges = [ to_son( priv ) for priv in privileges ]
+    digest = get_privileges_hash( privileges )
+
+    try:
+        son = get_collection().find_one_and_update( { 'hash': digest }, { '$setOnInsert': { 'privileges': privileges } },
+            projection={ '_id': 1 }, upsert=True, return_document=ReturnDocument.AFTER )
+    except DuplicateKeyError:
+        # Inserted concurrently
+        son = get_collection().find_one( { 'hash': digest }, { '_id': 1 } )
+
+    if son[ '_id' ] not in _entries:
+        # A new shared ACL may match queries cached by `find_ids`
+        _found_ids.clear()
+
+    _add_entry( SharedACLEntry( son[ '_id' ], privileges, digest ) )
+    return son[ '_id' ]
+
+
+def get_entry( acl_id ):
+    '''
+    Get the cached `SharedACLEntry` for `acl_id`, loading it if necessary. A shared ACL that doesn't exist
+    has no privileges.
+
+    @param acl_id:
+    @type acl_id: ObjectId
+    @return:
+    @rtype: SharedACLEntry
+    '''
+    entry = _entries.get( acl_id )
+
+    if entry is None:
+        load_entries( [ acl_id ] )
+        entry = _entries.get( acl_id )
+
+    if entry is None:
+        log.warning( 'Shared ACL `{}` does not exist'.format( acl_id ) )
+        entry = SharedACLEntry( acl_id, [], None )
+
+    return entry
+
+
+def load_entries( acl_ids ):
+    '''
+    Load all shared ACLs in `acl_ids` that aren't cached yet, using a single query.
+
+    @param acl_ids:
+    @type acl_ids: iterable
+    '''
+    missing = list( set( acl_id for acl_id in acl_ids if acl_id is not None and acl_id not in _entries ) )
+
+    if missing:
+        for son in get_collection().find( { '_id': { '$in': missing } }, { 'privileges': 1, 'hash': 1 } ):
+            _add_entry( SharedACLEntry( son[ '_id' ], son.get( 'privileges' ) or [], son.get( 'hash' ) ) )
+
+
+def find_ids( query, key=None, now=None ):
+    '''
+    Get the ids of the shared ACLs matching `query` (a query on `privileges`).
+
+    If a `key` (identifying `query`, apart from `now`) is given, the result is cached in-process until the first
+    privilege in the matching shared ACLs expires, for at most `find_ids_ttl` seconds.
+
+    @param query:
+    @type query: dict
+    @param key:
+    @type key: hashable
+    @param now: the time `query` checks expiry against; defaults to `datetime.utcnow()`
+    @type now: datetime
+    @return:
+    @rtype: list
+    '''
+    if key is None:
+        return [ son[ '_id' ] for son in get_collection().find( query, { '_id': 1 } ) ]
+
+    now = now or datetime.utcnow()
+    found = _found_ids.get( key )
+
+    if found is not None and now < found[ 1 ]:
+        return found[ 0 ]
+
+    ids, valid_until = [], now + timedelta( seconds=find_ids_ttl )
+
+    for son in get_collection().find( query, { '_id': 1, 'privileges.expires': 1 } ):
+        ids.append( son[ '_id' ] )
+
+        for priv in son.get( 'privileges' ) or ():
+            if priv.get( 'expires' ) and now < priv[ 'expires' ] < valid_until:
+                valid_until = priv[ 'expires' ]
+
+    if len( _found_ids ) >= max_entries:
+        _found_ids.clear()
+
+    _found_ids[ key ] = ( ids, valid_until )
+    return ids
+
+
+def _add_entry( entry ):
+    if len( _entries ) >= max_entries:
+        _entries.clear()
+
+    _entries[ entry.id ] = entry
+
+
+def clear():
+    '''
+    Clear the in-process cache of shared ACLs.
+    '''
+    _entries.clear()
+    _found_ids.clear()
+
+
+def invalidate( events ):
+    '''
+    Subscriber for privilege change events (see `mongoengine_privileges.events`); clears the results cached by
+    `find_ids`, since a Document may have been pointed at a shared ACL that was created elsewhere.
+
+    @param events:
+    @type events: list
+    '''
+    _found_ids.clear()
+
+
+events.subscribe( invalidate, immediate=True )
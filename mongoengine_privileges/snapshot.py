@@ -0,0 +1,408 @@
+'''
+Compiled ACL snapshots, shared between processes.
+
+A `CompiledACL` is encoded into a compact binary snapshot: sorted tables of principals and permissions (with
+an index of offsets, so names are looked up by binary search), followed by an allowed and a denied permission
+bitmask for each principal. Snapshots are stored in the slots of a memory-mapped file (a `SnapshotStore`), and
+evaluated in place by every process that maps it; nothing is decoded or cached per process, so pre-forked
+workers don't each have to build and keep their own copy of the ACLs for hot Documents.
+
+    from mongoengine_privileges import snapshot
+    snapshot.set_snapshot_store( snapshot.SnapshotStore( '/dev/shm/myapp.acl' ) )
+
+Each slot has a generation, which is odd while the slot is being written; readers retry (or fall back to
+compiling the ACL themselves) if it changes while they read. Slots are read with `struct.unpack_from` on the
+mapped file itself (rather than through memoryviews), which works on Python 2 as well.
+
+`PrivilegeMixin` replaces a Document's snapshot when its privileges are persisted (by `save`, `update`,
+`update_privileges` and thus `grant`, `revoke` and `deny`). Snapshots published by readers are only stored if
+the slot's generation hasn't changed since the Document's ACL was first used, so a stale ACL can't overwrite a
+newer one. `delete_many` invalidates the snapshots of deleted Documents, and the `maintenance` functions clear
+the store after modifying privileges (from the command line, pass `--snapshot-store`).
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import hashlib
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from datetime import datetime
+
+EPOCH = datetime( 1970, 1, 1 )
+
+# File header: magic, number of slots, slot size
+FILE_HEADER = struct.Struct( str( '<4sII' ) )
+FILE_MAGIC = b'MPAF'
+FILE_HEADER_SIZE = 64
+
+# magic, version, compiled at and valid until (in microseconds since the epoch, or -1), number of principals,
+# number of permissions, offset of the bitmasks
+HEADER = struct.Struct( str( '<4sQqqHHI' ) )
+MAGIC = b'MPA2'
+# The offset of a name (relative to the start of the snapshot), followed by its length
+NAME = struct.Struct( str( '<IH' ) )
+WORD = struct.Struct( str( '<Q' ) )
+
+_store = None
+
+
+def set_snapshot_store( store ):
+    '''
+    Set the `SnapshotStore` used by `PrivilegeMixin`. Pass `None` to disable snapshots.
+    '''
+    global _store
+    _store = store
+
+
+def get_snapshot_store():
+    return _store
+
+
+def to_timestamp( value ):
+    return int( ( value - EPOCH ).total_seconds() * 1000000 ) if value is not None else -1
+
+
+def to_bytes( name ):
+    return name if isinstance( name, bytes ) else name.encode( 'utf-8' )
+
+
+def encode( acl, version=0 ):
+    '''
+    Encode a `CompiledACL` into a snapshot.
+
+    @param acl:
+    @type acl: CompiledACL
+    @param version:
+    @type version: int
+    @return:
+    @rtype: bytes
+    '''
+    # Names are sorted by their encoded form, which is the order they're compared in by `ACLSnapshot`
+    principals = sorted( set( acl.allowed_by_principal ).union( acl.denied_by_principal ), key=to_bytes )
+    permissions = sorted( set( acl.allowed ).union( acl.denied ), key=to_bytes )
+    bits = dict( ( permission, index ) for index, permission in enumerate( permissions ) )
+    words = ( len( permissions ) + 63 ) // 64
+    mask = struct.Struct( str( '<{}Q'.format( words ) ) )
+
+    names = [ to_bytes( name ) for name in principals + permissions ]
+    offset = HEADER.size + NAME.size * len( names )
+    index, data = [], []
+
+    for name in names:
+        index.append( NAME.pack( offset, len( name ) ) )
+        data.append( name )
+        offset += len( name )
+
+    parts = [ HEADER.pack( MAGIC, version, to_timestamp( acl.compiled_at ), to_timestamp( acl.valid_until ),
+        len( principals ), len( permissions ), offset ) ] + index + data
+
+    for principal in principals:
+        for by_principal in ( acl.allowed_by_principal, acl.denied_by_principal ):
+            value = 0
+            for permission in by_principal.get( principal, () ):
+                value |= 1 << bits[ permission ]
+            parts.append( mask.pack( *[ ( value >> ( 64 * word ) ) & 0xFFFFFFFFFFFFFFFF for word in range( words ) ] ) )
+
+    return b''.join( parts )
+
+
+class ACLSnapshot( object ):
+    '''
+    Evaluates an encoded `CompiledACL` in place: principals and permissions are looked up in `buffer` by binary
+    search, and bitmasks are read from `buffer` when evaluating a permission. Only the header is decoded.
+    '''
+
+    __slots__ = ( 'buffer', 'offset', 'version', 'compiled_at', 'valid_until', 'principal_count', 'permission_count',
+        'words', 'masks_offset' )
+
+    def __init__( self, buffer, offset=0 ):
+        '''
+        @param buffer: an encoded snapshot (see `encode`), or a buffer (such as an `mmap`) containing one
+        @param offset: the position of the snapshot in `buffer`
+        @type offset: int
+        '''
+        self.buffer = buffer
+        self.offset = offset
+        ( magic, self.version, self.compiled_at, self.valid_until, self.principal_count, self.permission_count,
+            masks_offset ) = HEADER.unpack_from( buffer, offset )
+
+        if magic != MAGIC:
+            raise ValueError( 'Not an ACL snapshot' )
+
+        self.words = ( self.permission_count + 63 ) // 64
+        self.masks_offset = offset + masks_offset
+
+    def is_valid_at( self, now ):
+        '''
+        Check whether none of the privileges in this snapshot have expired at `now`. Whether the snapshot is
+        current is determined by the generation of its slot (see `SnapshotStore`), not by the time it was compiled.
+        '''
+        return self.valid_until < 0 or to_timestamp( now ) < self.valid_until
+
+    def _get_name( self, index ):
+        position, length = NAME.unpack_from( self.buffer, self.offset + HEADER.size + index * NAME.size )
+        start = self.offset + position
+        return self.buffer[ start : start + length ]
+
+    def _find( self, name, first, count ):
+        '''
+        Find `name` in the (sorted) names `first` up to `first + count`.
+
+        @return: its index relative to `first`, or `None`
+        @rtype: int
+        '''
+        name = to_bytes( name )
+        low, high = 0, count
+
+        while low < high:
+            middle = ( low + high ) // 2
+            current = self._get_name( first + middle )
+
+            if current == name:
+                return middle
+            elif current < name:
+                low = middle + 1
+            else:
+                high = middle
+
+        return None
+
+    def get_principal_index( self, principal ):
+        return self._find( principal, 0, self.principal_count )
+
+    def get_permission_bit( self, permission ):
+        return self._find( permission, self.principal_count, self.permission_count )
+
+    def _has_bit( self, principal_index, denied, bit ):
+        word, offset = divmod( bit, 64 )
+        position = self.masks_offset + ( ( principal_index * 2 + denied ) * self.words + word ) * WORD.size
+        return bool( WORD.unpack_from( self.buffer, position )[ 0 ] & ( 1 << offset ) )
+
+    def permits( self, principals, permission ):
+        '''
+        Same as `CompiledACL.permits`.
+
+        @param principals:
+        @type principals: frozenset
+        @param permission:
+        @type permission: string
+        @return:
+        @rtype: bool
+        '''
+        bit = self.get_permission_bit( permission )
+
+        if bit is None:
+            return False
+
+        allowed = False
+
+        for principal in principals:
+            index = self.get_principal_index( principal )
+
+            if index is not None:
+                if self._has_bit( index, 1, bit ):
+                    return False
+                allowed = allowed or self._has_bit( index, 0, bit )
+
+        return allowed
+
+    def get_permissions( self, principals ):
+        '''
+        Same as `CompiledACL.get_permissions`.
+
+        @param principals:
+        @type principals: frozenset
+        @return:
+        @rtype: frozenset
+        '''
+        indexes = [ index for index in ( self.get_principal_index( principal ) for principal in principals ) if index is not None ]
+        return frozenset( self._get_name( self.principal_count + bit ).decode( 'utf-8' ) for bit in range( self.permission_count )
+            if any( self._has_bit( index, 0, bit ) for index in indexes ) and not any( self._has_bit( index, 1, bit ) for index in indexes ) )
+
+
+class SnapshotStore( object ):
+    '''
+    Stores ACL snapshots in a fixed number of slots in a memory-mapped file, keyed by `( class name, pk )`.
+    A key maps to a single slot; when keys collide, the most recently stored snapshot wins.
+
+    The number of slots and their size are stored in the file when it's created; processes opening an existing
+    file use those.
+    '''
+
+    # generation, key digest, data length
+    SLOT_HEADER = struct.Struct( str( '<Q16sI' ) )
+
+    def __init__( self, path, slots=4096, slot_size=4096 ):
+        '''
+        @param path: the file to map; it's created if it doesn't exist
+        @type path: string
+        @param slots: the number of slots in a new file
+        @type slots: int
+        @param slot_size: the maximum size of a slot (including its header) in a new file; larger snapshots are
+            not stored
+        @type slot_size: int
+        '''
+        self.path = path
+        self.fd = os.open( path, os.O_RDWR | os.O_CREAT, 0o600 )
+
+        with self._lock():
+            if os.fstat( self.fd ).st_size < FILE_HEADER_SIZE:
+                os.ftruncate( self.fd, FILE_HEADER_SIZE + slots * slot_size )
+                os.write( self.fd, FILE_HEADER.pack( FILE_MAGIC, slots, slot_size ) )
+
+            os.lseek( self.fd, 0, os.SEEK_SET )
+            magic, self.slots, self.slot_size = FILE_HEADER.unpack( os.read( self.fd, FILE_HEADER.size ) )
+
+        if magic != FILE_MAGIC:
+            os.close( self.fd )
+            raise ValueError( '`{}` is not an ACL snapshot store'.format( path ) )
+
+        self.mmap = mmap.mmap( self.fd, FILE_HEADER_SIZE + self.slots * self.slot_size )
+        self.pid = os.getpid()
+
+    def close( self ):
+        self.mmap.close()
+        os.close( self.fd )
+
+    def get_slot( self, key ):
+        '''
+        @return: the slot index and key digest for `key`
+        @rtype: tuple
+        '''
+        digest = hashlib.md5( '{}:{}'.format( *key ).encode( 'utf-8' ) ).digest()
+        return struct.unpack_from( str( '<I' ), digest )[ 0 ] % self.slots, digest
+
+    def get_offset( self, index ):
+        return FILE_HEADER_SIZE + index * self.slot_size
+
+    def get_generation( self, key ):
+        '''
+        @return: the current generation of the slot for `key`
+        @rtype: int
+        '''
+        index, digest = self.get_slot( key )
+        return self.SLOT_HEADER.unpack_from( self.mmap, self.get_offset( index ) )[ 0 ]
+
+    def evaluate( self, key, func, now=None ):
+        '''
+        Call `func` with the `ACLSnapshot` stored for `key`, and return its result.
+
+        @param key:
+        @type key: tuple
+        @param func:
+        @param now: the snapshot must be valid at `now`; defaults to `datetime.utcnow()`
+        @type now: datetime
+        @return: the result, or `None` if there's no (valid) snapshot for `key`
+        '''
+        index, digest = self.get_slot( key )
+        offset = self.get_offset( index )
+
+        # Retry if the slot is written concurrently
+        for attempt in range( 3 ):
+            generation, slot_digest, length = self.SLOT_HEADER.unpack_from( self.mmap, offset )
+
+            if generation % 2:
+                continue
+            elif slot_digest != digest or not length:
+                return None
+
+            try:
+                snapshot = ACLSnapshot( self.mmap, offset + self.SLOT_HEADER.size )
+                result = func( snapshot ) if snapshot.is_valid_at( now or datetime.utcnow() ) else None
+            except ( ValueError, struct.error, UnicodeDecodeError ):
+                # Read while it was being overwritten
+                result = None
+
+            if self.SLOT_HEADER.unpack_from( self.mmap, offset )[ 0 ] == generation:
+                return result
+
+        return None
+
+    def permits( self, key, principals, permission, now=None ):
+        '''
+        @return: whether `principals` have `permission` according to the snapshot for `key`, or `None` if there's
+            no (valid) snapshot
+        @rtype: bool
+        '''
+        return self.evaluate( key, lambda snapshot: snapshot.permits( principals, permission ), now )
+
+    def put( self, key, acl, generation=None ):
+        '''
+        Store a snapshot of `acl` for `key`.
+
+        @param key:
+        @type key: tuple
+        @param acl:
+        @type acl: CompiledACL
+        @param generation: only store the snapshot if the slot is still at this generation (see `get_generation`)
+        @type generation: int
+        @return: whether the snapshot has been stored
+        @rtype: bool
+        '''
+        index, digest = self.get_slot( key )
+
+        with self._lock():
+            current = self.get_generation( key )
+
+            if generation is not None and current != generation:
+                return False
+
+            data = encode( acl, version=current + 2 )
+
+            if self.SLOT_HEADER.size + len( data ) > self.slot_size:
+                self._write( index, current, b'', b'' )
+                return False
+
+            self._write( index, current, digest, data )
+            return True
+
+    def invalidate( self, key ):
+        '''
+        Remove the snapshot for `key`.
+        '''
+        index, digest = self.get_slot( key )
+
+        with self._lock():
+            current, slot_digest, length = self.SLOT_HEADER.unpack_from( self.mmap, self.get_offset( index ) )
+
+            if slot_digest == digest:
+                self._write( index, current, b'', b'' )
+
+    def clear( self ):
+        '''
+        Remove all snapshots.
+        '''
+        with self._lock():
+            for index in range( self.slots ):
+                current, slot_digest, length = self.SLOT_HEADER.unpack_from( self.mmap, self.get_offset( index ) )
+
+                if length:
+                    self._write( index, current, b'', b'' )
+
+    def _write( self, index, generation, digest, data ):
+        offset = self.get_offset( index )
+        # An odd generation marks the slot as being written
+        self.SLOT_HEADER.pack_into( self.mmap, offset, generation + 1, digest.ljust( 16, b'\0' ), len( data ) )
+        start = offset + self.SLOT_HEADER.size
+        self.mmap[ start : start + len( data ) ] = data
+        self.SLOT_HEADER.pack_into( self.mmap, offset, generation + 2, digest.ljust( 16, b'\0' ), len( data ) )
+
+    @contextmanager
+    def _lock( self ):
+        import fcntl
+
+        # Locks are held by open files, which are shared with forked processes; reopen the file after a fork
+        if getattr( self, 'pid', None ) not in ( None, os.getpid() ):
+            os.close( self.fd )
+            self.fd = os.open( self.path, os.O_RDWR )
+            self.pid = os.getpid()
+
+        fcntl.flock( self.fd, fcntl.LOCK_EX )
+
+        try:
+            yield
+        finally:
+            fcntl.flock( self.fd, fcntl.LOCK_UN )
@@ -24,7 +24,12 @@ setup(
     zip_safe=False,
     requires=requires,
     install_requires=requires,
-    tests_require=requires,
+    tests_require=requires + [ 'mongomock' ],
+    entry_points={
+        'console_scripts': [
+            'mongoengine-privileges-compact = mongoengine_privileges.maintenance:main',
+        ]
+    },
     classifiers = [
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -0,0 +1,103 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from mongoengine_privileges.audit import AuditLogger
+
+
+class ListSink( object ):
+    def __init__( self, event=None ):
+        self.records = []
+        self.batches = 0
+        self.event = event
+
+    def write( self, records ):
+        self.event and self.event.wait()
+        self.batches += 1
+        self.records.extend( records )
+
+
+class Doc( object ):
+    pk = 1
+
+
+class AuditLoggerTestCase( unittest.TestCase ):
+
+    def test_batching( self ):
+        sink = ListSink()
+        logger = AuditLogger( sink, batch_size=10, flush_interval=0.05 )
+
+        for i in range( 25 ):
+            logger.record( 'may', Doc(), None, 'view', i % 2 )
+
+        logger.flush()
+        self.assertEqual( len( sink.records ), 25 )
+        self.assertLess( sink.batches, 25 )
+        self.assertEqual( sink.records[ 0 ][ 'document' ], 'Doc' )
+        self.assertEqual( sum( 1 for item in sink.records if item[ 'allowed' ] ), 12 )
+
+    def test_back_pressure( self ):
+        # The sink blocks, so the queue fills up; further records are dropped instead of blocking
+        event = threading.Event()
+        sink = ListSink( event )
+        logger = AuditLogger( sink, max_queue_size=5, batch_size=1, flush_interval=0.01 )
+
+        for i in range( 20 ):
+            logger.record( 'may', Doc(), None, 'view', True )
+
+        self.assertGreater( logger.dropped, 0 )
+        event.set()
+        logger.flush()
+        self.assertEqual( len( sink.records ) + logger.dropped, 20 )
+
+    def test_sampling( self ):
+        sink = ListSink()
+        logger = AuditLogger( sink, allowed_sample_rate=0.0, flush_interval=0.01 )
+
+        logger.record( 'may', Doc(), None, 'view', True )
+        logger.record( 'may', Doc(), None, 'view', False )
+        logger.flush()
+
+        self.assertEqual( [ item[ 'allowed' ] for item in sink.records ], [ False ] )
+
+    def test_flush_at_exit( self ):
+        # Records that are still queued when the interpreter exits are written
+        directory = tempfile.mkdtemp()
+        path = os.path.join( directory, 'audit.log' )
+        script = '\n'.join( [
+            'from mongoengine_privileges.audit import AuditLogger, FileSink',
+            'logger = AuditLogger( FileSink( {!r} ), batch_size=1000, flush_interval=0.5 )'.format( path ),
+            'for i in range( 10 ): logger.record( "may", logger, None, "view", True, pk=i )'
+        ] )
+
+        try:
+            env = dict( os.environ, PYTHONPATH=os.pathsep.join( sys.path ) )
+            subprocess.check_call( [ sys.executable, '-c', script ], env=env )
+
+            with open( path ) as f:
+                self.assertEqual( len( f.readlines() ), 10 )
+        finally:
+            shutil.rmtree( directory )
+
+    def test_counters( self ):
+        # Counters are updated by the writer thread and by threads recording decisions
+        sink = ListSink()
+        logger = AuditLogger( sink, max_queue_size=1, batch_size=1, flush_interval=0.01 )
+        threads = [ threading.Thread( target=lambda: [ logger.record( 'may', Doc(), None, 'view', True ) for i in range( 200 ) ] )
+            for i in range( 4 ) ]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        logger.flush()
+        self.assertEqual( logger.written, len( sink.records ) )
+        self.assertEqual( logger.written + logger.dropped, 800 )
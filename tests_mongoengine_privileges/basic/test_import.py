@@ -0,0 +1,32 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+
+from tests_mongoengine_privileges.benchmarks.bench_import import get_imported_modules
+
+
+class ImportTestCase( unittest.TestCase ):
+
+    def test_core_imports_without_pyramid( self ):
+        modules = get_imported_modules( 'import mongoengine_privileges, mongoengine_privileges.acl, mongoengine_privileges.events' )
+
+        self.assertIn( 'mongoengine_privileges.acl', modules )
+        self.assertFalse( [ module for module in modules if module.split( '.' )[ 0 ] in ( 'pyramid', 'mongoengine_relational' ) ] )
+
+    def test_lazy_mixin( self ):
+        modules = get_imported_modules( 'import mongoengine_privileges\nmongoengine_privileges.PrivilegeMixin\n'
+            'from mongoengine_privileges import requires_fields' )
+
+        self.assertIn( 'mongoengine_privileges.privilegemixin', modules )
+        self.assertIn( 'mongoengine_relational', modules )
+
+    def test_lazy_submodule( self ):
+        modules = get_imported_modules( 'import mongoengine_privileges\nmongoengine_privileges.privilegemixin.PrivilegeMixin' )
+        self.assertIn( 'mongoengine_privileges.privilegemixin', modules )
+
+    def test_subscriber_registered( self ):
+        # Our own caches are invalidated by events received before `PrivilegeMixin` is imported as well
+        modules = get_imported_modules( 'import mongoengine_privileges\nfrom mongoengine_privileges import acl, events\n'
+            'assert acl.invalidate in events._immediate_subscribers' )
+        self.assertNotIn( 'mongoengine_privileges.privilegemixin', modules )
@@ -0,0 +1,231 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from bson import DBRef, ObjectId, SON
+
+from mongoengine_privileges.acl import CompiledACL
+from mongoengine_privileges.maintenance import ( PermissionVerifier, compact_privilege_list, compact_privileges,
+    get_id_ranges, get_privileges_filter, load_checkpoint, process_privileges, rebuild_privileges, save_checkpoint,
+    sweep_expired_privileges )
+from mongoengine_privileges.snapshot import SnapshotStore, set_snapshot_store
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+_database = {}
+
+
+def get_database():
+    '''
+    A (picklable) connection factory for `rebuild_privileges`. Worker processes that are forked get a copy of
+    the in-memory database; their writes aren't visible to the parent process.
+    '''
+    if 'db' not in _database:
+        _database[ 'db' ] = mongomock.MongoClient().db
+
+    return _database[ 'db' ]
+
+
+class Interrupted( Exception ):
+    pass
+
+
+def interrupt( report ):
+    raise Interrupted()
+
+
+class CompactionTestCase( unittest.TestCase ):
+
+    def setUp( self ):
+        self.user_id = ObjectId()
+
+    def test_compact_privilege_list( self ):
+        stats = {}
+        privileges = [
+            { 'user': self.user_id, 'permissions': [ 'view' ] },
+            { 'group': 'g:admins', 'permissions': [ 'update' ] },
+            { 'user': DBRef( 'person', self.user_id ), 'permissions': [ 'view', 'update' ] },
+            { 'user': str( self.user_id ), 'permissions': [], 'roles': [ 'editor' ] },
+            { 'group': 'g:empty', 'permissions': [] },
+        ]
+
+        compacted = compact_privilege_list( privileges, stats )
+
+        self.assertEqual( compacted, [
+            { 'user': self.user_id, 'permissions': [ 'view', 'update' ], 'roles': [ 'editor' ] },
+            { 'group': 'g:admins', 'permissions': [ 'update' ] },
+        ] )
+        self.assertEqual( stats, { 'merged': 2, 'dropped': 1, 'normalized': 2 } )
+
+        # Compacting is idempotent
+        self.assertEqual( compact_privilege_list( compacted ), compacted )
+
+    @unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+    def test_compact_privileges( self ):
+        collection = mongomock.MongoClient().db.directory
+        collection.insert_many( [
+            { 'name': 'clean', 'privileges': [ { 'user': self.user_id, 'permissions': [ 'view' ] } ] },
+            { 'name': 'duplicates', 'privileges': [
+                { 'user': self.user_id, 'permissions': [ 'view' ] },
+                { 'user': self.user_id, 'permissions': [ 'update' ] }
+            ] },
+            { 'name': 'empty', 'privileges': [ { 'group': 'g:all', 'permissions': [] } ] },
+        ] )
+
+        reports = []
+        report = compact_privileges( collection, batch_size=2, dry_run=True, progress=reports.append )
+        self.assertEqual( ( report.scanned, report.modified, report.written, report.batches ), ( 3, 2, 0, 2 ) )
+        self.assertEqual( len( reports ), 2 )
+        self.assertEqual( len( collection.find_one( { 'name': 'duplicates' } )[ 'privileges' ] ), 2 )
+
+        report = compact_privileges( collection, batch_size=2 )
+        self.assertEqual( ( report.modified, report.written ), ( 2, 2 ) )
+        self.assertEqual( collection.find_one( { 'name': 'duplicates' } )[ 'privileges' ],
+            [ { 'user': self.user_id, 'permissions': [ 'view', 'update' ] } ] )
+        self.assertEqual( collection.find_one( { 'name': 'empty' } )[ 'privileges' ], [] )
+
+        report = compact_privileges( collection )
+        self.assertEqual( report.modified, 0 )
+
+    @unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+    def test_concurrent_modification( self ):
+        collection = mongomock.MongoClient().db.directory
+        doc_id = collection.insert_one( { 'privileges': [
+            SON( [ ( 'user', self.user_id ), ( 'permissions', [ 'view' ] ) ] ),
+            SON( [ ( 'user', self.user_id ), ( 'permissions', [ 'update' ] ) ] )
+        ] } ).inserted_id
+
+        # Privileges are matched regardless of the order of their keys
+        privileges = [ { 'permissions': [ 'view' ], 'user': self.user_id }, { 'permissions': [ 'update' ], 'user': self.user_id } ]
+        self.assertEqual( collection.count_documents( get_privileges_filter( doc_id, privileges ) ), 1 )
+        self.assertEqual( collection.count_documents( get_privileges_filter( doc_id, privileges[ : 1 ] ) ), 0 )
+        self.assertEqual( collection.count_documents( get_privileges_filter( doc_id, [ dict( privileges[ 0 ], roles=[ 'editor' ] ), privileges[ 1 ] ] ) ), 0 )
+
+        def processor( privileges, stats ):
+            # Modified while being processed
+            collection.replace_one( { '_id': doc_id }, { 'privileges': [ dict( privileges[ 0 ], roles=[ 'editor' ] ), privileges[ 1 ] ] } )
+            return compact_privilege_list( privileges, stats )
+
+        report = process_privileges( collection, processor )
+        self.assertEqual( ( report.modified, report.written, report.conflicts ), ( 1, 0, 1 ) )
+        self.assertEqual( len( collection.find_one( { '_id': doc_id } )[ 'privileges' ] ), 2 )
+
+    @unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+    def test_sweep_expired_privileges( self ):
+        now = datetime.utcnow()
+        collection = mongomock.MongoClient().db.file
+        collection.insert_many( [
+            { 'name': 'shared', 'privileges': [
+                { 'user': self.user_id, 'permissions': [ 'update' ] },
+                { 'group': 'g:guests', 'permissions': [ 'view' ], 'expires': now - timedelta( hours=1 ) },
+                { 'group': 'g:friends', 'permissions': [ 'view' ], 'expires': now + timedelta( hours=1 ) },
+            ] },
+            { 'name': 'private', 'privileges': [ { 'user': self.user_id, 'permissions': [ 'update' ] } ] },
+        ] )
+
+        # ACL snapshots are cleared, since they may contain swept privileges
+        path = tempfile.mkdtemp()
+        store = SnapshotStore( os.path.join( path, 'acl' ), slots=16, slot_size=1024 )
+        store.put( ( 'File', 'shared' ), CompiledACL( [ { 'group': 'g:guests', 'permissions': [ 'view' ] } ] ) )
+        set_snapshot_store( store )
+
+        try:
+            self.assertEqual( sweep_expired_privileges( [ collection ], now=now ), { 'file': 1 } )
+            self.assertEqual( [ priv.get( 'group' ) for priv in collection.find_one( { 'name': 'shared' } )[ 'privileges' ] ],
+                [ None, 'g:friends' ] )
+            self.assertIsNone( store.permits( ( 'File', 'shared' ), frozenset( [ 'g:guests' ] ), 'view' ) )
+            self.assertEqual( sweep_expired_privileges( [ collection ], now=now ), { 'file': 0 } )
+        finally:
+            set_snapshot_store( None )
+            store.close()
+            shutil.rmtree( path )
+
+    def test_permission_verifier( self ):
+        stats = {}
+        verifier = PermissionVerifier( [ 'view', 'update' ], [ 'editor' ], fix=True )
+        privileges = [ { 'user': self.user_id, 'permissions': [ 'view', 'publish' ], 'roles': [ 'editor', 'owner' ], 'denied': [ 'delete' ] } ]
+
+        self.assertEqual( verifier( privileges, stats ), [ { 'user': self.user_id, 'permissions': [ 'view' ], 'roles': [ 'editor' ], 'denied': [] } ] )
+        self.assertEqual( stats, { 'unknown_permissions': 2, 'unknown_roles': 1 } )
+        self.assertIs( PermissionVerifier( [ 'view' ] )( privileges, {} )[ 0 ], privileges[ 0 ] )
+
+    @unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+    def test_rebuild_privileges( self ):
+        db = get_database()
+        db.file.delete_many( {} )
+        db.file.insert_many( [ { 'name': str( i ), 'privileges': [
+            { 'user': self.user_id, 'permissions': [ 'view' ] },
+            { 'user': self.user_id, 'permissions': [ 'update' ] }
+        ] } for i in range( 20 ) ] )
+
+        ranges = get_id_ranges( db.file, 4 )
+        self.assertEqual( len( ranges ), 4 )
+        self.assertEqual( ( ranges[ 0 ][ 0 ], ranges[ -1 ][ 1 ] ), ( None, None ) )
+
+        path = tempfile.mkdtemp()
+        checkpoint = os.path.join( path, 'file.checkpoint' )
+
+        try:
+            # Partitions are processed inline with a single process
+            report = rebuild_privileges( get_database, 'file', partitions=4, processes=1, batch_size=3, checkpoint=checkpoint )
+            self.assertEqual( ( report.completed, report.scanned, report.modified, report.written ), ( 4, 20, 20, 20 ) )
+            self.assertEqual( report.stats[ 'merged' ], 20 )
+            self.assertEqual( list( report.get_worker_rates().keys() ), [ os.getpid() ] )
+            self.assertEqual( len( db.file.find_one()[ 'privileges' ] ), 1 )
+
+            # Resuming skips the partitions that have been completed
+            state = load_checkpoint( checkpoint )
+            del state[ 'completed' ][ '2' ]
+            save_checkpoint( checkpoint, state )
+
+            report = rebuild_privileges( get_database, 'file', processes=1, checkpoint=checkpoint )
+            self.assertEqual( ( report.completed, report.skipped, report.modified ), ( 1, 3, 0 ) )
+            self.assertGreater( report.scanned, 0 )
+
+            with self.assertRaises( ValueError ):
+                rebuild_privileges( get_database, 'directory', processes=1, checkpoint=checkpoint )
+        finally:
+            shutil.rmtree( path )
+
+    @unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+    @unittest.skipIf( getattr( multiprocessing, 'get_start_method', lambda: 'fork' )() != 'fork', 'requires forked workers' )
+    def test_rebuild_privileges_processes( self ):
+        db = get_database()
+        db.file.delete_many( {} )
+        db.file.insert_many( [ { 'name': str( i ), 'privileges': [
+            { 'user': self.user_id, 'permissions': [ 'view', 'publish' ] }
+        ] } for i in range( 20 ) ] )
+
+        verifier = PermissionVerifier( [ 'view' ], fix=True )
+        path = tempfile.mkdtemp()
+        checkpoint = os.path.join( path, 'file.checkpoint' )
+
+        try:
+            # Interrupted after the first partition; the checkpoint holds the completed partition
+            with self.assertRaises( Interrupted ):
+                rebuild_privileges( get_database, 'file', processor=verifier, partitions=4, processes=2,
+                    batch_size=3, checkpoint=checkpoint, progress=interrupt )
+
+            completed = load_checkpoint( checkpoint )[ 'completed' ]
+            self.assertEqual( len( completed ), 1 )
+
+            # Resuming processes the remaining partitions in the worker processes
+            report = rebuild_privileges( get_database, 'file', processor=verifier, processes=2, batch_size=3, checkpoint=checkpoint )
+            self.assertEqual( ( report.completed, report.skipped ), ( 3, 1 ) )
+            self.assertEqual( report.scanned + sum( result[ 'scanned' ] for result in completed.values() ), 20 )
+            self.assertEqual( report.modified, report.scanned )
+            self.assertEqual( report.stats[ 'unknown_permissions' ], report.scanned )
+            self.assertNotIn( os.getpid(), report.get_worker_rates() )
+            self.assertEqual( len( load_checkpoint( checkpoint )[ 'completed' ] ), 4 )
+        finally:
+            shutil.rmtree( path )
@@ -1,20 +1,36 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
+from datetime import datetime, timedelta
 
-from tests_mongoengine_privileges.utils import FauxSave, Struct, get_object_id, get_mock_request
+from tests_mongoengine_privileges.utils import FauxSave, Struct, DatabaseCallCounter, get_object_id, get_mock_request
 
 from pyramid import testing
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid.authentication import SessionAuthenticationPolicy
 from pyramid.response import Response
 from pyramid.request import Request
+from pyramid.interfaces import IAuthenticationPolicy
+from pyramid.security import Deny
 
 from mongoengine import *
 import mongoengine
 from mongoengine_relational import *
+from bson import DBRef, ObjectId
 from mongoengine_privileges import *
+from mongoengine_privileges.privilege import RawPrivileges
+from mongoengine_privileges import acl, audit, events, snapshot
+from mongoengine_privileges.acl import get_request_state
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
 
 
 class SimplePrivilegedDocument( PrivilegeMixin, Document ):
@@ -28,13 +44,12 @@ class PrivilegedDocument( PrivilegeMixin, Document ):
         'permissions': {
             'create': 'create',
             'update': 'update'
+        },
+        'initial_privileges': {
+            'creator': [ 'view', 'update' ]
         }
     }
 
-    def on_change_pk( self, request, new_value, prev_value, updated_fields ):
-        print( ('pk updated; current={}, previous={}').format( new_value, prev_value ) )
-        self.set_permissions( [ 'view', 'update' ], request.user )
-
     def may_create( self, request ):
         return True
 
@@ -58,27 +73,34 @@ class Directory( PrivilegeMixin, Document ):
             'files': 'update_files',
             'name': 'update_name',
             'delete': ''
+        },
+        'initial_privileges': {
+            'creator': [ 'update', 'update_name' ]
         }
     }
 
     may_update_files_called = 0
     on_change_called = 0
     may_delete_called = 0
+    may_update_files_many_called = 0
 
+    @requires_fields( 'files' )
     def may_update_files( self, request ):
         print( 'may_update_files_called called for `{}`'.format( self ) )
         self.may_update_files_called += 1
         return True
 
+    @classmethod
+    def may_update_files_many( cls, request, docs ):
+        cls.may_update_files_many_called += 1
+        return [ doc.name != 'Locked' for doc in docs ]
+
     def may_create( self, request ):
         return True
 
     def may_delete( self, request ):
         return True
 
-    def on_change_pk( self, request, pk, noop, **kwargs ):
-        self.set_permissions( [ 'update', 'update_name' ], request.user )
-
     def on_change( self, request, changed_fields, updated_fields ):
         self.on_change_called += 1
 
@@ -96,6 +118,20 @@ class File( PrivilegeMixin, Document ):
     
     
 
+class Project( PrivilegeMixin, Document ):
+    name = StringField()
+
+    meta = {
+        'roles': {
+            'viewer': 'view',
+            'editor': [ 'view', 'update', 'update_name' ]
+        }
+    }
+
+    def may_create( self, request ):
+        return True
+
+
 class PrivilegeTestCase( unittest.TestCase ):
 
     def setUp( self ):
@@ -107,6 +143,9 @@ class PrivilegeTestCase( unittest.TestCase ):
         d.p1 = Person( id=user_id, name='p1', email='p1@progressivecompany.com', groups=[ 'g:deliverable1' ] )
         self.request = get_mock_request( d.p1 )
 
+        # Class level counter; reset it so assertions don't depend on the order tests run in
+        Directory.may_update_files_many_called = 0
+
     def tearDown( self ):
         testing.tearDown()
 
@@ -280,6 +319,563 @@ class PrivilegeTestCase( unittest.TestCase ):
         self.assertEqual( dir.on_change_called, 7 )
         self.assertEqual( dir.may_update_files_called, 3 )
 
+    def test_no_dereferencing( self ):
+        # Load a directory with references to files that are not in the database
+        file_ids = [ get_object_id() for i in range( 10 ) ]
+        dir = Directory._from_son( {
+            '_id': get_object_id(),
+            'name': 'Code',
+            'files': [ DBRef( 'file', file_id ) for file_id in file_ids ],
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'update_name' ] } ]
+        } )
+
+        with DatabaseCallCounter( Directory, File ) as counter:
+            self.assertTrue( dir.__acl__ )
+            self.assertEqual( dir.get_permissions_for_fields( 'files', 'name' ), { 'update_files', 'update_name' } )
+            self.assertTrue( dir.may( self.request, 'update_name' ) )
+            self.assertFalse( dir.may( self.request, 'update' ) )
+            self.assertTrue( dir.get_privilege( self.request.user ) )
+
+            with self.assertRaises( AttributeError ):
+                dir.get_permissions_for_fields( 'bogus' )
+
+        self.assertEqual( counter.count, 0 )
+
+        # Saving and updating keeps privileges raw, and doesn't dereference either. `Document.save` and
+        # `Document.update` don't persist here, so validation and serialization are invoked explicitly.
+        other = Directory._from_son( {
+            '_id': get_object_id(),
+            'name': 'Docs',
+            'files': [ DBRef( 'file', file_id ) for file_id in file_ids ],
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'update' ] } ]
+        } )
+
+        with DatabaseCallCounter( Directory, File ) as counter:
+            other.name = 'Other'
+            other.save( self.request )
+            other.validate()
+            self.assertEqual( other.to_mongo()[ 'privileges' ], [ { 'user': self.request.user.pk, 'permissions': [ 'update' ] } ] )
+
+            dir.name = 'Other'
+            dir.save( self.request )
+            dir.update( self.request, 'name' )
+            dir.validate()
+            self.assertEqual( dir.to_mongo()[ 'privileges' ], [ { 'user': self.request.user.pk, 'permissions': [ 'update_name' ] } ] )
+
+        self.assertEqual( counter.count, 0 )
+        self.assertIsInstance( other._data[ 'privileges' ], RawPrivileges )
+        self.assertIsInstance( dir._data[ 'privileges' ], RawPrivileges )
+
+    def test_nested_changes( self ):
+        dir = Directory._from_son( {
+            '_id': get_object_id(),
+            'name': 'Code',
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'update_name' ] } ]
+        } )
+
+        # Paths of nested changes resolve to the permission for their top-level field
+        self.assertEqual( dir.get_permissions_for_fields( 'files.0', 'name' ), { 'update_files', 'update_name' } )
+        self.assertEqual( dir.get_permissions_for_fields( 'privileges.0.permissions' ), { 'update' } )
+
+        with self.assertRaises( AttributeError ):
+            dir.get_permissions_for_fields( 'bogus.0' )
+
+        # Saving a nested change falls back to updating the changed fields
+        dir.get_changed_fields = lambda: [ 'files.0' ]
+        dir.save( self.request )
+        self.assertEqual( dir.may_update_files_called, 1 )
+
+    def test_lazy_privileges( self ):
+        son = {
+            '_id': get_object_id(),
+            'name': 'Code',
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'update' ] } ]
+        }
+        dir = Directory._from_son( son )
+
+        # Privileges are kept as SON until accessed, but can be evaluated nonetheless
+        self.assertIsInstance( dir._data[ 'privileges' ], RawPrivileges )
+        self.assertTrue( dir.may( self.request, 'update' ) )
+        self.assertIsInstance( dir._data[ 'privileges' ], RawPrivileges )
+        self.assertEqual( dir.to_mongo()[ 'privileges' ], son[ 'privileges' ] )
+
+        self.assertIsInstance( dir.privileges[ 0 ], Privilege )
+        self.assertEqual( dir.privileges[ 0 ].permissions, [ 'update' ] )
+
+    def test_authorize_many( self ):
+        dirs = [ Directory( name='Code' ), Directory( name='Locked' ) ]
+        for dir in dirs:
+            dir.save( self.request )
+
+        # `update_files` has a batch hook, which is called once for all documents
+        self.assertEqual( Directory.authorize_many( self.request, dirs, 'update_files' ), [ True, False ] )
+        self.assertEqual( Directory.may_update_files_many_called, 1 )
+        self.assertEqual( sum( dir.may_update_files_called for dir in dirs ), 0 )
+
+        # `update` doesn't; it falls back to `may` for each document
+        self.assertEqual( Directory.authorize_many( self.request, dirs, 'update' ), [ True, True ] )
+        self.assertEqual( Directory.authorize_many( self.request, dirs, 'bogus' ), [ False, False ] )
+        self.assertEqual( Directory.authorize_many( self.request, [], 'update_files' ), [] )
+
+    def test_roles( self ):
+        roles = Project.get_roles()
+        self.assertEqual( roles[ 'viewer' ], frozenset( [ 'view' ] ) )
+        self.assertEqual( roles[ 'editor' ], frozenset( [ 'view', 'update', 'update_name' ] ) )
+        self.assertIs( Project.get_roles(), roles )
+
+        project = Project( name='p' )
+        project.save( self.request )
+        project.add_roles( 'editor', self.request.user )
+
+        self.assertTrue( project.may( self.request, 'update_name' ) )
+        self.assertFalse( project.may( self.request, 'delete' ) )
+
+        # A privilege referencing a single role uses the precompiled permissions
+        self.assertIs( project.__acl__[ 0 ][ 2 ], roles[ 'editor' ] )
+
+        # Explicit permissions are combined with role permissions
+        project.add_permissions( 'delete', self.request.user )
+        self.assertTrue( project.may( self.request, 'delete' ) )
+
+        project.revoke( self.request, [], self.request.user, roles='editor' )
+        self.assertFalse( project.may( self.request, 'update_name' ) )
+        self.assertTrue( project.may( self.request, 'delete' ) )
+
+        query = Project.get_privileges_query( self.request, 'update' )
+        self.assertIn( { 'roles': { '$in': [ 'editor' ] } }, query[ '$and' ][ 0 ][ 'privileges' ][ '$elemMatch' ][ '$and' ][ 1 ][ '$or' ] )
+
+    def test_privilege_events( self ):
+        transport = events.InMemoryTransport()
+        events.set_publisher( transport )
+
+        try:
+            dir = Directory( name='Code' )
+            dir.save( self.request )
+
+            # Changes are batched until the request finishes, but our own ACL caches are invalidated right away
+            self.assertEqual( transport.events, [] )
+            version = acl.get_version( 'Directory', dir.pk )
+            self.assertGreater( version, acl._floor )
+            events.flush( self.request )
+
+            self.assertEqual( transport.events, [ events.PrivilegeChange( 'Directory', dir.pk, str( self.request.user.pk ),
+                frozenset( [ 'update', 'update_name' ] ), frozenset() ) ] )
+            self.assertEqual( acl.get_version( 'Directory', dir.pk ), version )
+
+            # Other requests see a change as soon as it's persisted
+            p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+            request_p2 = get_mock_request( p2 )
+            self.assertFalse( Directory._from_son( dir.to_mongo() ).may( request_p2, 'view' ) )
+
+            # Changes for the same principal are coalesced; granting and revoking a permission cancels out
+            dir.grant( self.request, [ 'update_files', 'view' ], p2 )
+            self.assertTrue( Directory._from_son( dir.to_mongo() ).may( request_p2, 'view' ) )
+            dir.revoke( self.request, 'update_files', p2 )
+            dir.remove_permissions( 'update_name', self.request.user )
+            dir.update_privileges( self.request )
+            events.flush( self.request )
+
+            self.assertEqual( len( transport.events ), 3 )
+            self.assertIn( events.PrivilegeChange( 'Directory', dir.pk, str( p2.pk ), frozenset( [ 'view' ] ), frozenset() ), transport.events )
+            self.assertIn( events.PrivilegeChange( 'Directory', dir.pk, str( self.request.user.pk ), frozenset(), frozenset( [ 'update_name' ] ) ), transport.events )
+        finally:
+            events.set_publisher( None )
+
+    def test_version_bound( self ):
+        max_versions, acl.max_versions = acl.max_versions, 2
+
+        try:
+            dir = Directory( name='Code' )
+            dir.save( self.request )
+            cache = dir._get_acl_cache( self.request )
+            self.assertIs( dir._get_acl_cache( self.request ), cache )
+
+            # Once the table of versions is full, it's cleared; versions never repeat, and caches of Documents
+            # that don't have an entry are invalidated
+            version = acl.get_version( 'Directory', dir.pk )
+            for i in range( 3 ):
+                acl.invalidate( [ events.PrivilegeChange( 'Directory', get_object_id(), 'g:team', frozenset( [ 'view' ] ), frozenset() ) ] )
+
+            self.assertLessEqual( len( acl._versions ), 2 )
+            self.assertGreater( acl.get_version( 'Directory', dir.pk ), version )
+            self.assertIsNot( dir._get_acl_cache( self.request ), cache )
+        finally:
+            acl.max_versions = max_versions
+
+    def test_effective_permissions( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+        dir.may_update_files_called = 0
+
+        self.assertEqual( Directory.get_declared_permissions(), frozenset( [ 'create', 'update', 'update_files', 'update_name' ] ) )
+        self.assertEqual( dir.effective_permissions( self.request ), frozenset( [ 'create', 'update', 'update_files', 'update_name' ] ) )
+
+        # Permissions granted through the ACL are included as well
+        dir.add_permissions( 'view', self.request.user )
+        permissions = dir.effective_permissions( self.request, as_dict=True )
+        self.assertTrue( permissions[ 'view' ] )
+        self.assertTrue( permissions[ 'update_files' ] )
+
+        # `update_files` has a batch hook, so `may_update_files` isn't called at all
+        self.assertEqual( dir.may_update_files_called, 0 )
+
+        p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+        request_p2 = get_mock_request( p2 )
+        locked = Directory( name='Locked' )
+        locked.save( self.request )
+
+        results = Directory.effective_permissions_many( request_p2, [ dir, locked ], as_dict=True )
+        self.assertEqual( results[ 0 ], { 'create': True, 'update': False, 'update_files': True, 'update_name': False } )
+        self.assertEqual( results[ 1 ][ 'update_files' ], False )
+
+    def test_denied_cache( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+
+        self.assertFalse( dir.may( self.request, 'view' ) )
+        self.assertFalse( dir.may( self.request, 'view' ) )
+        self.assertEqual( len( dir._get_acl_cache().denied ), 1 )
+
+        # Denials are forgotten when privileges change
+        dir.add_permissions( 'view', self.request.user )
+        self.assertEqual( len( dir._get_acl_cache().denied ), 0 )
+        self.assertTrue( dir.may( self.request, 'view' ) )
+
+        # Or when a change for this document is published
+        self.assertFalse( dir.may( self.request, 'delete_all' ) )
+        events.publish( [ events.PrivilegeChange( 'Directory', dir.pk, 'g:other', frozenset( [ 'view' ] ), frozenset() ) ] )
+        self.assertEqual( len( dir._get_acl_cache().denied ), 0 )
+
+    def test_request_cache( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+        dir._clear_changed_fields()
+
+        # Another instance of the same document (fetched through a relation, for example) shares the ACL and
+        # decisions made during this request
+        other = Directory._from_son( dir.to_mongo() )
+        self.assertTrue( dir.may( self.request, 'update' ) )
+        self.assertIs( other._get_acl_cache( self.request ), dir._get_acl_cache( self.request ) )
+        self.assertTrue( acl.get_request_cache( self.request ).get_decision( ( 'Directory', dir.pk ),
+            get_request_state( self.request ).principals, 'update' ) )
+
+        # Persisted changes are visible to other instances right away
+        self.assertFalse( other.may( self.request, 'view' ) )
+        dir.grant( self.request, 'view', self.request.user )
+        self.assertTrue( other.may( self.request, 'view' ) )
+
+        # Unsaved changes are not
+        dir.add_permissions( 'update_files', 'g:deliverable1' )
+        self.assertIsNot( dir._get_acl_cache( self.request ), other._get_acl_cache( self.request ) )
+
+    def test_other_policy_decisions( self ):
+        from pyramid.interfaces import IAuthorizationPolicy
+
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+        dir._clear_changed_fields()
+
+        # Decisions made by an authorization policy other than the ACL policy are not cached
+        request = get_mock_request( self.request.user )
+        policy = request.registry.queryUtility( IAuthenticationPolicy )
+        request.registry.registerUtility( policy, IAuthorizationPolicy )
+
+        policy.permissive = False
+        self.assertFalse( dir.may( request, 'update' ) )
+        policy.permissive = True
+        self.assertTrue( dir.may( request, 'update' ) )
+        self.assertFalse( dir._get_acl_cache( request ).denied )
+
+    def test_snapshot_store( self ):
+        directory = tempfile.mkdtemp()
+        store = snapshot.SnapshotStore( os.path.join( directory, 'acl' ), slots=64 )
+        snapshot.set_snapshot_store( store )
+
+        try:
+            # Persisting privileges publishes a snapshot of the ACL
+            dir = Directory( name='Code' )
+            dir.save( self.request )
+            dir._clear_changed_fields()
+            key = ( 'Directory', dir.pk )
+            self.assertTrue( store.permits( key, get_request_state( self.request ).principals, 'update' ) )
+
+            # Other instances (in other processes, or requests) evaluate the snapshot instead of compiling the ACL
+            request = get_mock_request( self.request.user )
+            other = Directory._from_son( dir.to_mongo() )
+            self.assertTrue( other.may( request, 'update' ) )
+            self.assertIsNone( other._get_acl_cache().acl )
+
+            dir.grant( self.request, 'view', 'g:team' )
+            self.assertTrue( store.permits( key, frozenset( [ 'g:team' ] ), 'view' ) )
+
+            # An instance loaded before the snapshot changed doesn't publish its (outdated) ACL
+            store.invalidate( key )
+            self.assertFalse( other.may( request, 'view' ) )
+            self.assertIsNone( store.permits( key, frozenset( [ 'g:team' ] ), 'view' ) )
+        finally:
+            snapshot.set_snapshot_store( None )
+            store.close()
+            shutil.rmtree( directory )
+
+    def test_delete( self ):
+        directory = tempfile.mkdtemp()
+        store = snapshot.SnapshotStore( os.path.join( directory, 'acl' ), slots=64 )
+        snapshot.set_snapshot_store( store )
+        transport = events.InMemoryTransport()
+        events.set_publisher( transport )
+
+        try:
+            dir = Directory( name='Code' )
+            dir.save( self.request )
+            dir._clear_changed_fields()
+            events.flush( self.request )
+            key = ( 'Directory', dir.pk )
+            self.assertTrue( store.permits( key, get_request_state( self.request ).principals, 'update' ) )
+            version = acl.get_version( 'Directory', dir.pk )
+
+            # Deleting publishes the removal of the Document's privileges, and removes its snapshot
+            del transport.events[ : ]
+            dir.delete( self.request )
+            events.flush( self.request )
+
+            self.assertEqual( transport.events, [ events.PrivilegeChange( 'Directory', dir.pk, str( self.request.user.pk ),
+                frozenset(), frozenset( [ 'update', 'update_name' ] ) ) ] )
+            self.assertIsNone( store.permits( key, get_request_state( self.request ).principals, 'update' ) )
+            self.assertGreater( acl.get_version( 'Directory', dir.pk ), version )
+        finally:
+            events.set_publisher( None )
+            snapshot.set_snapshot_store( None )
+            store.close()
+            shutil.rmtree( directory )
+
+    def test_get_principal_index( self ):
+        projects = [ Project( id=get_object_id(), name=str( i ) ) for i in range( 3 ) ]
+        user_id = str( self.request.user.pk )
+
+        for project in projects:
+            project.add_roles( 'viewer', 'g:team' )
+        projects[ 0 ].add_roles( 'editor', self.request.user )
+        projects[ 1 ].add_permissions( 'update', self.request.user )
+        projects[ 2 ].add_denied_permissions( 'view', 'g:team' )
+
+        index = Project.get_principal_index( projects )
+        self.assertEqual( index[ 'view' ], { 'g:team': { projects[ 0 ].pk, projects[ 1 ].pk }, user_id: { projects[ 0 ].pk } } )
+        self.assertEqual( index[ 'update' ], { user_id: { projects[ 0 ].pk, projects[ 1 ].pk } } )
+
+    def test_deny( self ):
+        group = 'g:deliverable1'
+        request = get_mock_request( self.request.user )
+        request.registry.queryUtility( IAuthenticationPolicy ).groupids = ( group, )
+
+        project = Project( name='p' )
+        project.save( request )
+        project.add_roles( 'editor', group )
+        self.assertTrue( project.may( request, 'update_name' ) )
+
+        # A permission denied to the user overrides the permission allowed for the group
+        project.add_denied_permissions( 'update_name', request.user )
+        self.assertFalse( project.may( request, 'update_name' ) )
+        self.assertTrue( project.may( request, 'update' ) )
+        self.assertEqual( project.effective_permissions( request ), frozenset( [ 'create', 'update', 'view' ] ) )
+        self.assertEqual( project.__acl__[ 0 ], ( Deny, str( request.user.pk ), [ 'update_name' ] ) )
+
+        project.remove_denied_permissions( 'update_name', request.user )
+        self.assertTrue( project.may( request, 'update_name' ) )
+
+    def test_compiled_acl_equivalence( self ):
+        # The compiled ACL should give the same results as `ACLAuthorizationPolicy` on `__acl__`
+        rng = random.Random( 42 )
+        policy = ACLAuthorizationPolicy()
+        principals = [ str( get_object_id() ) for i in range( 4 ) ] + [ 'g:a', 'g:b', 'g:c' ]
+        permissions = [ 'view', 'update', 'update_name', 'delete' ]
+
+        for i in range( 50 ):
+            project = Project( name='p' )
+
+            for principal in rng.sample( principals, rng.randint( 0, len( principals ) ) ):
+                privilege = Privilege( group=principal )
+                privilege.add( rng.sample( permissions, rng.randint( 0, 2 ) ) )
+                privilege.add_roles( rng.sample( [ 'viewer', 'editor' ], rng.randint( 0, 1 ) ) )
+                privilege.deny( rng.sample( permissions, rng.randint( 0, 1 ) ) )
+                project.privileges.append( privilege )
+
+            acl = project.get_compiled_acl()
+
+            for j in range( 10 ):
+                effective = frozenset( rng.sample( principals, rng.randint( 0, 3 ) ) )
+                expected = frozenset( permission for permission in permissions if policy.permits( project, effective, permission ) )
+                self.assertEqual( acl.get_permissions( effective ) & frozenset( permissions ), expected )
+
+                for permission in permissions:
+                    self.assertEqual( acl.permits( effective, permission ), bool( policy.permits( project, effective, permission ) ) )
+
+    def test_expiring_denial( self ):
+        user = self.request.user
+        expires = datetime.utcnow() + timedelta( minutes=1 )
+        project = Project._from_son( { '_id': get_object_id(), 'name': 'Code', 'privileges': [
+            { 'user': user.pk, 'roles': [ 'viewer' ] },
+            { 'user': user.pk, 'denied': [ 'view' ], 'expires': expires }
+        ] } )
+
+        self.assertFalse( project.may( self.request, 'view' ) )
+        self.assertFalse( project.may( get_mock_request( user ), 'view' ) )
+
+        # The cached denial is lifted once the Deny has expired, for the same (cached) instance
+        request = get_mock_request( user )
+        get_request_state( request ).now = expires + timedelta( seconds=1 )
+        self.assertTrue( project.may( request, 'view' ) )
+
+    def test_expiring_privileges( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+
+        p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+        request_p2 = get_mock_request( p2 )
+
+        # Temporary privileges are kept apart from permanent ones
+        expires = datetime.utcnow() + timedelta( hours=24 )
+        dir.grant( self.request, 'view', p2, expires=expires )
+        dir.grant( self.request, 'update_name', p2 )
+        self.assertEqual( len( dir.privileges ), 3 )
+        self.assertTrue( dir.may( request_p2, 'view' ) )
+        self.assertEqual( dir.get_compiled_acl().valid_until, expires )
+
+        # Once expired, the privilege is ignored
+        self.assertFalse( dir.get_compiled_acl( expires ).permits( request_p2._privileges_state.principals, 'view' ) )
+        self.assertTrue( dir.get_compiled_acl( expires ).permits( request_p2._privileges_state.principals, 'update_name' ) )
+        self.assertIsNone( dir.get_compiled_acl( expires ).valid_until )
+
+        dir.get_privilege( p2, expires=expires ).expires = datetime.utcnow() - timedelta( seconds=1 )
+        self.assertNotIn( str( p2.pk ), [ ace[ 1 ] for ace in dir.__acl__ if 'view' in ace[ 2 ] ] )
+
+        # Expiry times are matched at millisecond precision, as stored by MongoDB
+        expires = datetime.utcnow().replace( microsecond=123456 ) + timedelta( hours=1 )
+        dir.grant( self.request, [ 'view', 'update_files' ], p2, expires=expires )
+        self.assertIs( dir.get_privilege( p2, expires=expires.replace( microsecond=123000 ) ), dir.get_privilege( p2, expires=expires ) )
+
+        # Revoking applies to all of a principal's privileges, unless restricted to a single expiry time
+        dir.revoke( self.request, 'view', p2, expires=None )
+        self.assertIn( 'view', dir.get_privilege( p2, expires=expires ).permissions )
+        dir.revoke( self.request, 'view', p2 )
+        self.assertNotIn( 'view', dir.get_privilege( p2, expires=expires ).permissions )
+
+        dir.remove_privilege( p2 )
+        self.assertEqual( [ priv for priv in dir.privileges if priv.principal_key == str( p2.pk ) ], [] )
+
+    def test_canonical_principals( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+
+        p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+        request_p2 = get_mock_request( p2 )
+
+        # A user can be identified by its Document, id or DBRef; all map onto the same privilege
+        dir.grant( self.request, 'view', p2 )
+        self.assertIs( dir.get_privilege( p2.pk ), dir.get_privilege( p2 ) )
+        self.assertIs( dir.get_privilege( DBRef( 'person', p2.pk ) ), dir.get_privilege( p2 ) )
+        self.assertEqual( dir.get_privilege( p2 ).principal_key, str( p2.pk ) )
+
+        # Stored values that aren't ObjectIds are normalized on save
+        privilege = Privilege( user=DBRef( 'person', p2.pk ), permissions=[ 'update_name' ] )
+        dir.privileges.append( privilege )
+        self.assertEqual( privilege.principal_key, str( p2.pk ) )
+        dir.save( self.request )
+        self.assertIsInstance( privilege.user, ObjectId )
+        self.assertTrue( dir.may( request_p2, 'update_name' ) )
+
+        # The cached key follows changes to the principal
+        privilege.group = 'editors'
+        privilege.user = None
+        self.assertEqual( privilege.principal_key, 'editors' )
+
+    def test_initial_privileges( self ):
+        dir = Directory( name='Code' )
+        self.assertFalse( dir.privileges )
+
+        # The creator's privileges are applied before the insert, so they're persisted along with it
+        dir.save( self.request )
+        self.assertSetEqual( set( dir.get_privilege( self.request.user ).permissions ), { 'update', 'update_name' } )
+        self.assertNotIn( '_privileges_snapshot', dir.__dict__ )
+
+        # Existing documents are left alone
+        dir.remove_permissions( 'update_name', self.request.user )
+        dir.save( self.request )
+        self.assertSetEqual( set( dir.get_privilege( self.request.user ).permissions ), { 'update' } )
+
+    def test_audit( self ):
+        records = []
+        sink = Struct( write=records.extend )
+        logger = audit.AuditLogger( sink, flush_interval=0.01 )
+        audit.set_audit_logger( logger )
+
+        try:
+            dir = Directory( name='Code' )
+            dir.save( self.request )
+
+            p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+            request_p2 = get_mock_request( p2 )
+
+            with self.assertRaises( PermissionError ):
+                dir.name = 'Other'
+                dir.update( request_p2, 'name' )
+
+            logger.flush()
+        finally:
+            audit.set_audit_logger( None )
+
+        actions = [ ( item[ 'action' ], item[ 'permission' ], item[ 'allowed' ] ) for item in records ]
+        self.assertIn( ( 'save', 'create', True ), actions )
+        self.assertIn( ( 'may', 'update_name', False ), actions )
+        self.assertIn( ( 'update', 'update_name', False ), actions )
+        self.assertTrue( all( item[ 'document' ] == 'Directory' for item in records ) )
+
+    def test_save_fallback( self ):
+        dir = Directory( name='Code' )
+        dir.save( self.request )
+
+        p2 = Person( id=get_object_id(), name='p2', email='p2@progressivecompany.com' )
+        request_p2 = get_mock_request( p2 )
+        dir.grant( self.request, 'update_name', p2 )
+
+        records = []
+        logger = audit.AuditLogger( Struct( write=records.extend ), flush_interval=0.01 )
+        audit.set_audit_logger( logger )
+
+        try:
+            # `p2` can't update `dir` as a whole, but may update its name; each permission is checked once
+            dir.name = 'Other'
+            dir.save( request_p2 )
+
+            # Without permission for all changed fields, nothing is saved
+            p3 = Person( id=get_object_id(), name='p3', email='p3@progressivecompany.com' )
+            with self.assertRaises( PermissionError ):
+                dir.name = 'Forbidden'
+                dir.save( get_mock_request( p3 ) )
+
+            logger.flush()
+        finally:
+            audit.set_audit_logger( None )
+
+        decisions = [ ( item[ 'action' ], item[ 'permission' ], item[ 'allowed' ] ) for item in records if item[ 'user' ] == p2.pk ]
+        self.assertEqual( decisions, [ ( 'may', 'update', False ), ( 'may', 'update_name', True ), ( 'update', 'update_name', True ) ] )
+
+    def test_get_fields_for_permission( self ):
+        self.assertSetEqual( Directory.get_fields_for_permission( 'update' ), { 'privileges' } )
+        self.assertSetEqual( Directory.get_fields_for_permission( 'update_files' ), { 'privileges', 'files' } )
+        self.assertSetEqual( Directory.get_fields_for_permission( '' ), { 'privileges' } )
+
+    def test_get_privileges_query( self ):
+        # No permission required; everything matches
+        self.assertEqual( Directory.get_privileges_query( self.request, Directory.get_permission_for( 'delete' ) ), {} )
+
+        # Implemented by a method; can't be pushed down to the database
+        self.assertIsNone( Directory.get_privileges_query( self.request, 'update_files' ) )
+
+        query = File.get_privileges_query( self.request, File.get_permission_for( 'delete' ) )
+        match = query[ '$and' ][ 0 ][ 'privileges' ][ '$elemMatch' ]
+        self.assertEqual( match[ 'permissions' ], 'delete' )
+        self.assertIn( { 'user': { '$in': [ self.request.user.pk ] } }, match[ '$or' ] )
+
     def test_save( self ):
         pass
 
@@ -292,3 +888,176 @@ class PrivilegeTestCase( unittest.TestCase ):
     def test_revoke( self ):
         pass
 
+
+@unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+class DatabaseTestCase( unittest.TestCase ):
+
+    @classmethod
+    def setUpClass( cls ):
+        mongoengine.connect( 'mongoengine_privileges_test', host='mongomock://localhost' )
+
+    @classmethod
+    def tearDownClass( cls ):
+        mongoengine.connection.disconnect()
+
+    def setUp( self ):
+        p1 = Person( id=get_object_id(), name='p1', email='p1@progressivecompany.com' )
+        self.request = get_mock_request( p1 )
+        Directory.may_update_files_many_called = 0
+
+    def tearDown( self ):
+        testing.tearDown()
+
+    def test_insert_many( self ):
+        dirs = Directory.insert_many( self.request, [ Directory( name='Code' ), Directory( name='Docs' ) ] )
+
+        self.assertTrue( all( dir.pk for dir in dirs ) )
+        self.assertTrue( all( dir.may( self.request, 'update_name' ) for dir in dirs ) )
+
+        stored = Directory._get_collection().find_one( { '_id': dirs[ 0 ].pk } )
+        self.assertEqual( stored[ 'privileges' ][ 0 ][ 'user' ], self.request.user.pk )
+
+        forbidden = SimplePrivilegedDocument( name='Forbidden' )
+        with self.assertRaises( PermissionError ) as context:
+            SimplePrivilegedDocument.insert_many( self.request, [ forbidden ] )
+
+        self.assertEqual( context.exception.objects, [ forbidden ] )
+        self.assertIn( 'SimplePrivilegedDocument.save', str( context.exception ) )
+
+    def test_get_principals_with_permission( self ):
+        dirs = Directory.insert_many( self.request, [ Directory( name='Code' ), Directory( name='Docs' ) ] )
+        collection = Directory._get_collection()
+        collection.update_one( { '_id': dirs[ 0 ].pk }, { '$push': { 'privileges': { 'group': 'g:team', 'permissions': [ 'update_name' ] } } } )
+        collection.update_one( { '_id': dirs[ 1 ].pk }, { '$push': { 'privileges': { 'group': 'g:team', 'denied': [ 'update_name' ] } } } )
+
+        queryset = Directory.objects( pk__in=[ dir.pk for dir in dirs ] )
+        self.assertEqual( Directory.get_principals_with_permission( queryset, 'update_name' ),
+            { str( self.request.user.pk ): 2, 'g:team': 1 } )
+        self.assertEqual( Directory.get_principals_with_permission( queryset, 'view' ), {} )
+
+        # Users stored as a string or DBRef are counted as the same principal; a denial for any of them applies
+        user = self.request.user
+        collection.update_one( { '_id': dirs[ 0 ].pk }, { '$push': { 'privileges': { 'user': str( user.pk ), 'denied': [ 'update_name' ] } } } )
+        collection.update_one( { '_id': dirs[ 1 ].pk }, { '$push': { 'privileges': { 'user': DBRef( 'person', user.pk ), 'permissions': [ 'update_name' ] } } } )
+        self.assertEqual( Directory.get_principals_with_permission( queryset, 'update_name' ),
+            { str( user.pk ): 1, 'g:team': 1 } )
+
+        with self.assertRaises( ValueError ):
+            Directory.get_principals_with_permission( queryset.limit( 1 ), 'update_name' )
+
+    def test_may_by_ids( self ):
+        user = self.request.user
+        ids = [ get_object_id() for i in range( 3 ) ]
+        missing = get_object_id()
+        Project._get_collection().insert_many( [
+            { '_id': ids[ 0 ], 'name': 'viewer', 'privileges': [ { 'user': user.pk, 'roles': [ 'viewer' ] } ] },
+            { '_id': ids[ 1 ], 'name': 'denied', 'privileges': [ { 'user': user.pk, 'roles': [ 'viewer' ] },
+                { 'user': user.pk, 'denied': [ 'view' ] } ] },
+            { '_id': ids[ 2 ], 'name': 'other', 'privileges': [ { 'group': 'g:team', 'permissions': [ 'view' ] } ] }
+        ] )
+
+        # Documents that don't exist are not permitted
+        self.assertEqual( Project.may_by_ids( self.request, ids + [ missing ], 'view' ),
+            { ids[ 0 ]: True, ids[ 1 ]: False, ids[ 2 ]: False, missing: False } )
+
+        # Results are keyed by the given pks
+        self.assertEqual( Project.may_by_ids( self.request, [ str( ids[ 0 ] ) ], 'view' ), { str( ids[ 0 ] ): True } )
+        self.assertEqual( Project.may_by_ids( self.request, [], 'view' ), {} )
+
+        self.assertTrue( Project.may_by_id( self.request, ids[ 0 ], 'view' ) )
+        self.assertFalse( Project.may_by_id( self.request, ids[ 1 ], 'view' ) )
+        self.assertFalse( Project.may_by_id( self.request, missing, 'view' ) )
+
+        Project.objects.delete()
+
+    def test_may_by_ids_methods( self ):
+        # Permissions implemented by a `may_*` method are checked by that method, even if privileges grant them
+        doc_id = get_object_id()
+        PrivilegedDocument._get_collection().insert_one( { '_id': doc_id, 'name': 'doc',
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'update' ] } ] } )
+        self.assertEqual( PrivilegedDocument.may_by_ids( self.request, [ doc_id ], 'update' ), { doc_id: False } )
+        self.assertTrue( PrivilegedDocument.may_by_id( self.request, doc_id, 'create' ) )
+
+        # A `may_*_many` hook is called once for all Documents
+        dirs = Directory.insert_many( self.request, [ Directory( name='Code' ), Directory( name='Docs' ) ] )
+        self.assertEqual( Directory.may_by_ids( self.request, [ dir.pk for dir in dirs ], 'update_files' ),
+            dict( ( dir.pk, True ) for dir in dirs ) )
+        self.assertEqual( Directory.may_update_files_many_called, 1 )
+
+        PrivilegedDocument.objects.delete()
+
+    def test_delete_many( self ):
+        user = self.request.user
+        ids = [ get_object_id() for i in range( 4 ) ]
+        Project._get_collection().insert_many( [
+            { '_id': ids[ 0 ], 'name': 'owned', 'privileges': [ { 'user': user.pk, 'permissions': [ 'delete' ] } ] },
+            { '_id': ids[ 1 ], 'name': 'edited', 'privileges': [ { 'user': user.pk, 'roles': [ 'editor' ] } ] },
+            { '_id': ids[ 2 ], 'name': 'team', 'privileges': [ { 'group': 'g:team', 'permissions': [ 'delete' ] } ] },
+            { '_id': ids[ 3 ], 'name': 'denied', 'privileges': [ { 'user': user.pk, 'permissions': [ 'delete' ] },
+                { 'user': user.pk, 'denied': [ 'delete' ] } ] }
+        ] )
+
+        transport = events.InMemoryTransport()
+        events.set_publisher( transport )
+        records = []
+        logger = audit.AuditLogger( Struct( write=records.extend ), flush_interval=0.01 )
+        audit.set_audit_logger( logger )
+
+        try:
+            denied = Project.delete_many( self.request, Project.objects( pk__in=ids ) )
+            events.flush( self.request )
+            logger.flush()
+        finally:
+            events.set_publisher( None )
+            audit.set_audit_logger( None )
+
+        self.assertSetEqual( set( denied ), set( ids[ 1: ] ) )
+        self.assertSetEqual( set( Project.objects.scalar( 'id' ) ), set( ids[ 1: ] ) )
+
+        self.assertEqual( transport.events, [ events.PrivilegeChange( 'Project', ids[ 0 ], str( user.pk ), frozenset(), frozenset( [ 'delete' ] ) ) ] )
+
+        decisions = set( ( item[ 'pk' ], item[ 'allowed' ] ) for item in records if item[ 'action' ] == 'delete' )
+        self.assertSetEqual( decisions, { ( ids[ 0 ], True ), ( ids[ 1 ], False ), ( ids[ 2 ], False ), ( ids[ 3 ], False ) } )
+
+        Project.objects.delete()
+
+    def test_delete_many_fallback( self ):
+        from pyramid.interfaces import IAuthorizationPolicy
+
+        ids = [ get_object_id() for i in range( 2 ) ]
+        Project._get_collection().insert_many( [ { '_id': pk, 'name': 'project' } for pk in ids ] )
+
+        # Decisions by authorization policies other than the ACL policy can't be pushed down to the database
+        request = get_mock_request( self.request.user )
+        policy = request.registry.queryUtility( IAuthenticationPolicy )
+        request.registry.registerUtility( policy, IAuthorizationPolicy )
+        self.assertIsNone( Project.get_privileges_query( request, 'delete' ) )
+
+        policy.permissive = False
+        self.assertSetEqual( set( Project.delete_many( request, Project.objects( pk__in=ids ) ) ), set( ids ) )
+        self.assertEqual( Project.objects( pk__in=ids ).count(), 2 )
+
+        policy.permissive = True
+        self.assertEqual( Project.delete_many( request, Project.objects( pk__in=ids ) ), [] )
+        self.assertEqual( Project.objects( pk__in=ids ).count(), 0 )
+
+    def test_delete_many_relations( self ):
+        dirs = Directory.insert_many( self.request, [ Directory( name='Code' ), Directory( name='Docs' ) ] )
+        file_id = get_object_id()
+        File._get_collection().insert_one( { '_id': file_id, 'name': 'readme', 'directory': dirs[ 0 ].pk,
+            'privileges': [ { 'user': self.request.user.pk, 'permissions': [ 'delete' ] } ] } )
+        Directory._get_collection().update_one( { '_id': dirs[ 0 ].pk }, { '$set': { 'files': [ file_id ] } } )
+
+        # `File.directory` is required; deleting a Directory that still has files is refused
+        with self.assertRaises( OperationError ):
+            Directory.delete_many( self.request, Directory.objects( pk__in=[ dir.pk for dir in dirs ] ) )
+
+        self.assertEqual( Directory.objects( pk__in=[ dir.pk for dir in dirs ] ).count(), 2 )
+        self.assertEqual( File.objects( pk=file_id ).count(), 1 )
+
+        # Deleting the File removes it from `Directory.files`
+        self.assertEqual( File.delete_many( self.request, File.objects( pk=file_id ) ), [] )
+        self.assertEqual( Directory._get_collection().find_one( { '_id': dirs[ 0 ].pk } )[ 'files' ], [] )
+
+        self.assertEqual( Directory.delete_many( self.request, Directory.objects( pk__in=[ dir.pk for dir in dirs ] ) ), [] )
+        self.assertEqual( Directory.objects( pk__in=[ dir.pk for dir in dirs ] ).count(), 0 )
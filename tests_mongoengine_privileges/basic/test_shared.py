@@ -0,0 +1,170 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import unittest
+from datetime import datetime, timedelta
+
+from tests_mongoengine_privileges.utils import Struct, get_object_id, get_mock_request
+
+from pyramid import testing
+
+from mongoengine import *
+import mongoengine
+from mongoengine_privileges import *
+from mongoengine_privileges import audit, events, shared
+from mongoengine_privileges.acl import get_request_state
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+class SharedFile( PrivilegeMixin, Document ):
+    name = StringField()
+
+    meta = {
+        'shared_acl': True
+    }
+
+
+class Member( PrivilegeMixin, Document ):
+    name = StringField()
+
+
+@unittest.skipIf( mongomock is None, 'mongomock is not installed' )
+class SharedACLTestCase( unittest.TestCase ):
+
+    @classmethod
+    def setUpClass( cls ):
+        mongoengine.connect( 'mongoengine_privileges_test', host='mongomock://localhost' )
+
+    @classmethod
+    def tearDownClass( cls ):
+        mongoengine.connection.disconnect()
+
+    def setUp( self ):
+        shared.get_collection().delete_many( {} )
+        shared.clear()
+
+        self.p1 = Member( id=get_object_id(), name='p1' )
+        self.p2 = Member( id=get_object_id(), name='p2' )
+        self.request = get_mock_request( self.p1 )
+        self.privileges = [
+            { 'user': self.p1.pk, 'permissions': [ 'view', 'update' ] },
+            { 'group': 'g:team', 'permissions': [ 'view' ] }
+        ]
+
+    def tearDown( self ):
+        testing.tearDown()
+
+    def test_share( self ):
+        acl_id = shared.share( self.privileges )
+
+        # Identical ACLs are deduplicated, regardless of their order
+        self.assertEqual( shared.share( list( reversed( self.privileges ) ) ), acl_id )
+        self.assertEqual( shared.get_collection().count_documents( {} ), 1 )
+        self.assertNotEqual( shared.share( self.privileges[ : 1 ] ), acl_id )
+
+    def test_shared_acl( self ):
+        acl_id = shared.share( self.privileges )
+        shared.clear()
+
+        files = [ SharedFile( id=get_object_id(), name=str( i ), shared_acl=acl_id ) for i in range( 3 ) ]
+
+        # The shared ACL is loaded (and compiled) once for all files
+        self.assertEqual( SharedFile.authorize_many( self.request, files, 'update' ), [ True, True, True ] )
+        self.assertIs( files[ 0 ].get_compiled_acl(), files[ 1 ].get_compiled_acl() )
+        self.assertEqual( len( files[ 0 ].get_raw_privileges() ), 2 )
+        self.assertEqual( SharedFile.get_fields_for_permission( 'update' ), { 'privileges', 'shared_acl' } )
+
+    def test_copy_on_write( self ):
+        acl_id = shared.share( self.privileges )
+        file, other = SharedFile( id=get_object_id(), name='a', shared_acl=acl_id ), SharedFile( id=get_object_id(), name='b', shared_acl=acl_id )
+        request_p2 = get_mock_request( self.p2 )
+
+        # Modifying privileges copies them into the file; other files aren't affected
+        file.add_permissions( 'update', self.p2 )
+        self.assertIsNone( file.shared_acl )
+        self.assertEqual( len( file.privileges ), 3 )
+        self.assertTrue( file.may( request_p2, 'update' ) )
+        self.assertFalse( other.may( request_p2, 'update' ) )
+
+        # Once persisted, the file references a shared ACL for its new privileges
+        self.assertTrue( file._reshare() )
+        self.assertNotIn( file.shared_acl, ( None, acl_id ) )
+        self.assertEqual( file.privileges, [] )
+        self.assertTrue( file.may( request_p2, 'update' ) )
+
+        # Without actual changes, the original shared ACL is used
+        other.add_permissions( 'view', self.p1 )
+        other._reshare()
+        self.assertEqual( other.shared_acl, acl_id )
+
+    def test_get_privilege( self ):
+        acl_id = shared.share( self.privileges )
+        file = SharedFile( id=get_object_id(), name='a', shared_acl=acl_id )
+
+        # Reading a privilege doesn't copy the shared ACL into the file
+        self.assertSetEqual( set( file.get_privilege( self.p1 ).permissions ), { 'view', 'update' } )
+        self.assertIsNone( file.get_privilege( self.p2 ) )
+        self.assertEqual( file.shared_acl, acl_id )
+        self.assertEqual( file.privileges, [] )
+
+        file.get_privilege( self.p2, create=True )
+        self.assertIsNone( file.shared_acl )
+        self.assertEqual( len( file.privileges ), 3 )
+
+    def test_find_ids( self ):
+        acl_id = shared.share( self.privileges )
+        query = SharedFile.get_privileges_query( self.request, 'update' )
+        self.assertEqual( query[ '$or' ][ 1 ], { 'shared_acl': { '$in': [ acl_id ] } } )
+
+        # The lookup of matching shared ACLs is cached, until a shared ACL is created
+        shared.get_collection().delete_many( {} )
+        self.assertEqual( SharedFile.get_privileges_query( self.request, 'update' ), query )
+
+        other_id = shared.share( self.privileges[ : 1 ] )
+        query = SharedFile.get_privileges_query( self.request, 'update' )
+        self.assertEqual( query[ '$or' ][ 1 ], { 'shared_acl': { '$in': [ other_id ] } } )
+
+        # A privilege change event (from this process or another) clears the cached lookups as well
+        shared.get_collection().delete_many( {} )
+        events.publish( [ events.PrivilegeChange( 'SharedFile', get_object_id(), 'g:other', frozenset( [ 'update' ] ), frozenset() ) ] )
+        query = SharedFile.get_privileges_query( self.request, 'update' )
+        self.assertEqual( query[ '$or' ][ 1 ], { 'shared_acl': { '$in': [] } } )
+
+    def test_share_acl_many( self ):
+        ids = [ get_object_id(), get_object_id() ]
+        SharedFile._get_collection().insert_many( [
+            { '_id': ids[ 0 ], 'name': 'a', 'privileges': [ { 'user': self.p1.pk, 'permissions': [ 'update' ] } ] },
+            { '_id': ids[ 1 ], 'name': 'b', 'privileges': [ { 'user': self.p2.pk, 'permissions': [ 'update' ] } ] }
+        ] )
+
+        records = []
+        logger = audit.AuditLogger( Struct( write=records.extend ), flush_interval=0.01 )
+        audit.set_audit_logger( logger )
+
+        try:
+            self.assertEqual( SharedFile.share_acl_many( self.request, SharedFile.objects( pk__in=ids ), self.privileges ), [ ids[ 1 ] ] )
+            logger.flush()
+        finally:
+            audit.set_audit_logger( None )
+
+        self.assertIsNotNone( SharedFile.objects.get( pk=ids[ 0 ] ).shared_acl )
+        self.assertIsNone( SharedFile.objects.get( pk=ids[ 1 ] ).shared_acl )
+        self.assertSetEqual( set( ( item[ 'action' ], item[ 'pk' ], item[ 'allowed' ] ) for item in records ),
+            { ( 'share', ids[ 0 ], True ), ( 'share', ids[ 1 ], False ) } )
+
+    def test_expiring_denial( self ):
+        expires = datetime.utcnow() + timedelta( minutes=1 )
+        acl_id = shared.share( self.privileges + [ { 'user': self.p1.pk, 'denied': [ 'view' ], 'expires': expires } ] )
+        files = [ SharedFile( id=get_object_id(), name=str( i ), shared_acl=acl_id ) for i in range( 2 ) ]
+
+        self.assertFalse( files[ 0 ].may( self.request, 'view' ) )
+
+        # The denial is cached on the shared entry, until the Deny expires
+        request = get_mock_request( self.p1 )
+        get_request_state( request ).now = expires + timedelta( seconds=1 )
+        self.assertTrue( files[ 1 ].may( request, 'view' ) )
+        self.assertTrue( files[ 0 ].may( request, 'view' ) )
@@ -0,0 +1,94 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from mongoengine_privileges.acl import CompiledACL
+from mongoengine_privileges.snapshot import ACLSnapshot, SnapshotStore, encode
+
+
+class SnapshotTestCase( unittest.TestCase ):
+
+    def setUp( self ):
+        self.now = datetime.utcnow()
+        self.acl = CompiledACL( [
+            { 'user': 'u1', 'permissions': [ 'view', 'update' ] },
+            { 'group': 'g:team', 'permissions': [ 'view' ] + [ 'p{}'.format( i ) for i in range( 70 ) ] },
+            { 'group': 'g:guests', 'denied': [ 'update', 'p65' ] },
+            { 'user': 'u2', 'permissions': [ 'delete' ], 'expires': self.now + timedelta( hours=1 ) }
+        ], now=self.now )
+        self.directory = tempfile.mkdtemp()
+        self.store = SnapshotStore( os.path.join( self.directory, 'acl' ), slots=16, slot_size=1024 )
+
+    def tearDown( self ):
+        self.store.close()
+        shutil.rmtree( self.directory )
+
+    def test_encode( self ):
+        snapshot = ACLSnapshot( encode( self.acl, version=3 ) )
+        self.assertEqual( snapshot.version, 3 )
+
+        # Evaluates the same as the compiled ACL, including permissions beyond the first word of a bitmask
+        for principals in ( { 'u1' }, { 'u1', 'g:guests' }, { 'g:team' }, { 'g:team', 'g:guests' }, { 'u2' }, { 'u3' } ):
+            principals = frozenset( principals )
+            self.assertEqual( snapshot.get_permissions( principals ), self.acl.get_permissions( principals ) )
+
+            for permission in ( 'view', 'update', 'delete', 'p1', 'p65', 'unknown' ):
+                self.assertEqual( snapshot.permits( principals, permission ), self.acl.permits( principals, permission ) )
+
+        self.assertTrue( snapshot.is_valid_at( self.now ) )
+        self.assertFalse( snapshot.is_valid_at( self.now + timedelta( hours=2 ) ) )
+
+    def test_lookup( self ):
+        # Names are found by binary search in the encoded tables, including non-ASCII names
+        groups = [ 'g:{}'.format( i ) for i in range( 50 ) ] + [ 'g:\u00e9quipe' ]
+        acl = CompiledACL( [ { 'group': group, 'permissions': [ 'view', 'p{}'.format( i ) ] } for i, group in enumerate( groups ) ], now=self.now )
+        snapshot = ACLSnapshot( b'padding' + encode( acl ), offset=7 )
+
+        for i, group in enumerate( groups ):
+            self.assertIsNotNone( snapshot.get_principal_index( group ) )
+            self.assertTrue( snapshot.permits( frozenset( [ group ] ), 'p{}'.format( i ) ) )
+            self.assertEqual( snapshot.get_permissions( frozenset( [ group ] ) ), acl.get_permissions( frozenset( [ group ] ) ) )
+
+        self.assertIsNone( snapshot.get_principal_index( 'g:unknown' ) )
+        self.assertIsNone( snapshot.get_permission_bit( 'unknown' ) )
+        self.assertFalse( snapshot.permits( frozenset( [ 'g:0' ] ), 'p1' ) )
+
+    def test_store( self ):
+        key, principals = ( 'Doc', 'a' ), frozenset( [ 'u1' ] )
+        self.assertIsNone( self.store.permits( key, principals, 'view' ) )
+
+        generation = self.store.get_generation( key )
+        self.assertTrue( self.store.put( key, self.acl, generation ) )
+        self.assertTrue( self.store.permits( key, principals, 'view', self.now ) )
+        self.assertFalse( self.store.permits( key, principals, 'delete', self.now ) )
+
+        # Requests that started before the snapshot was published can use it as well
+        self.assertTrue( self.store.permits( key, principals, 'view', self.now - timedelta( milliseconds=5 ) ) )
+
+        # A snapshot based on an outdated generation isn't stored
+        self.assertFalse( self.store.put( key, self.acl, generation ) )
+
+        # Visible to other processes mapping the same file (which use the number of slots and slot size it was
+        # created with)
+        other = SnapshotStore( self.store.path, slots=8, slot_size=256 )
+        self.assertEqual( ( other.slots, other.slot_size ), ( 16, 1024 ) )
+        self.assertTrue( other.permits( key, principals, 'view', self.now ) )
+        self.assertIsNone( other.permits( key, principals, 'view', self.now + timedelta( hours=2 ) ) )
+
+        self.store.invalidate( key )
+        self.assertIsNone( other.permits( key, principals, 'view', self.now ) )
+
+        self.store.put( key, self.acl )
+        other.clear()
+        self.assertIsNone( self.store.permits( key, principals, 'view', self.now ) )
+        other.close()
+
+        # Snapshots that don't fit in a slot aren't stored
+        small = SnapshotStore( os.path.join( self.directory, 'small' ), slots=16, slot_size=64 )
+        self.assertFalse( small.put( key, self.acl ) )
+        small.close()
@@ -0,0 +1,69 @@
+'''
+Measure the import time of `mongoengine_privileges` (and what it pulls in), using `python -X importtime`.
+
+Run as `python -m tests_mongoengine_privileges.benchmarks.bench_import`.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import subprocess
+import sys
+
+import mongoengine_privileges
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( mongoengine_privileges.__file__ ) ) )
+
+
+def get_import_times( statement ):
+    '''
+    Run `statement` in a fresh interpreter with `-X importtime`.
+
+    @param statement:
+    @type statement: string
+    @return: a dict of `module: ( self, cumulative )` import times, in microseconds
+    @rtype: dict
+    '''
+    output = subprocess.check_output( [ sys.executable, '-X', 'importtime', '-c', statement ],
+        stderr=subprocess.STDOUT, cwd=ROOT ).decode( 'utf-8' )
+    times = {}
+
+    for line in output.splitlines():
+        if line.startswith( 'import time:' ) and '|' in line:
+            own, cumulative, module = [ part.strip() for part in line[ len( 'import time:' ): ].split( '|' ) ]
+            if own.isdigit():
+                times[ module ] = ( int( own ), int( cumulative ) )
+
+    return times
+
+
+def get_imported_modules( statement ):
+    '''
+    Run `statement` in a fresh interpreter, and list the modules it has imported. Unlike `get_import_times`,
+    this works on Python 2 as well.
+
+    @param statement:
+    @type statement: string
+    @return:
+    @rtype: set
+    '''
+    script = '{}\nimport sys\nprint( "\\n".join( name for name, module in sys.modules.items() if module is not None ) )'.format( statement )
+    output = subprocess.check_output( [ sys.executable, '-c', script ], stderr=subprocess.STDOUT, cwd=ROOT ).decode( 'utf-8' )
+    return set( output.split() )
+
+
+def run():
+    for statement in ( 'import mongoengine_privileges',
+            'import mongoengine_privileges.acl, mongoengine_privileges.events',
+            'from mongoengine_privileges import PrivilegeMixin' ):
+        times = get_import_times( statement )
+        top_level = dict( ( module, cumulative ) for module, ( own, cumulative ) in times.items() if '.' not in module )
+        print( '{}: {:.1f} ms total'.format( statement, sum( own for own, cumulative in times.values() ) / 1000.0 ) )
+
+        for module, cumulative in sorted( top_level.items(), key=lambda item: -item[ 1 ] )[ :5 ]:
+            print( '    {:<32}{:>8.1f} ms'.format( module, cumulative / 1000.0 ) )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,50 @@
+'''
+Compare load times for documents with large ACLs, with `privileges` decoded eagerly (a plain `ListField`)
+and lazily (a `PrivilegesField`).
+
+Run as `python -m tests_mongoengine_privileges.benchmarks.bench_lazy_privileges`.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import timeit
+
+from bson import ObjectId
+from mongoengine import Document, StringField, ListField, EmbeddedDocumentField
+
+from mongoengine_privileges.privilege import Privilege, PrivilegesField
+
+
+class EagerDocument( Document ):
+    name = StringField()
+    privileges = ListField( EmbeddedDocumentField( Privilege ) )
+
+
+class LazyDocument( Document ):
+    name = StringField()
+    privileges = PrivilegesField( EmbeddedDocumentField( Privilege ) )
+
+
+def get_son( acl_size ):
+    privileges = [ { 'user': ObjectId(), 'permissions': [ 'view', 'update', 'update_name' ] } for i in range( acl_size ) ]
+    return { '_id': ObjectId(), 'name': 'doc', 'privileges': privileges }
+
+
+def run( acl_size=500, number=200 ):
+    son = get_son( acl_size )
+
+    timings = [
+        ( 'eager', lambda: EagerDocument._from_son( son ) ),
+        ( 'lazy', lambda: LazyDocument._from_son( son ) ),
+        ( 'lazy + access', lambda: LazyDocument._from_son( son ).privileges ),
+    ]
+
+    for name, func in timings:
+        duration = min( timeit.repeat( func, number=number, repeat=3 ) )
+        print( '{:<16}{:>10.3f} ms/load (acl_size={})'.format( name, duration / number * 1000, acl_size ) )
+
+
+if __name__ == '__main__':
+    for acl_size in ( 10, 100, 1000 ):
+        run( acl_size )
@@ -0,0 +1,97 @@
+'''
+Compare the overhead of `save` when the user isn't allowed to `update` a document as a whole, but is allowed to
+update the changed fields: checking `update` and then calling `update` for the changed fields (two
+authorization passes), versus a single authorization pass in `save`. Writes are faked using `FauxSave`.
+
+The page is loaded as if from the database (without modified privileges). The request state, the request's
+decision cache and the page's ACL cache (including cached denials) are discarded before every save, and between
+the two passes, so each pass evaluates the ACL from scratch as it did before these caches existed. Otherwise,
+both variants would mostly measure cache hits.
+
+Run as `python -m tests_mongoengine_privileges.benchmarks.bench_save_fallback`.
+'''
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import timeit
+
+from mongoengine import Document, StringField
+
+from mongoengine_privileges import PrivilegeMixin
+from tests_mongoengine_privileges.utils import FauxSave, get_object_id, get_mock_request
+
+
+class Page( PrivilegeMixin, Document ):
+    name = StringField()
+    title = StringField()
+
+    meta = {
+        'permissions': {
+            'update': 'update',
+            'name': 'update_name',
+            'title': 'update_title'
+        }
+    }
+
+
+class Editor( PrivilegeMixin, Document ):
+    name = StringField()
+
+
+def get_page( request, acl_size ):
+    page = Page( id=get_object_id(), name='page', title='Page' )
+    page.add_permissions( [ 'update_name', 'update_title' ], request.user )
+
+    for i in range( acl_size ):
+        page.add_permissions( 'view', 'g:{}'.format( i ) )
+
+    # Load it as a persisted Document, so it uses the request cache like Documents loaded from the database
+    return Page._from_son( page.to_mongo() )
+
+
+def reset_caches( page, request ):
+    '''
+    Discard the authorization state cached for `request` and `page`.
+    '''
+    request._privileges_state = None
+
+    if getattr( request.cache, '_privileges_cache', None ) is not None:
+        request.cache._privileges_cache = None
+
+    page.invalidate_acl()
+
+
+def two_passes( page, request ):
+    page.name = 'a' if page.name == 'b' else 'b'
+
+    # `save` before using a single authorization pass: nothing was shared between the passes
+    reset_caches( page, request )
+
+    if not page.may( request, 'update' ):
+        reset_caches( page, request )
+        page.update( request, *page.get_changed_fields() )
+
+
+def single_pass( page, request ):
+    page.name = 'a' if page.name == 'b' else 'b'
+    reset_caches( page, request )
+    page.save( request )
+
+
+def run( acl_size=10, number=2000 ):
+    request = get_mock_request( Editor( id=get_object_id(), name='editor' ) )
+    page = get_page( request, acl_size )
+
+    durations = {}
+
+    for name, func in ( ( 'two passes', two_passes ), ( 'single pass', single_pass ) ):
+        durations[ name ] = min( timeit.repeat( lambda: func( page, request ), number=number, repeat=3 ) )
+        print( '{:<16}{:>10.3f} us/save (acl_size={})'.format( name, durations[ name ] / number * 1000000, acl_size ) )
+
+    print( '{:<16}{:>10.2f}x'.format( 'ratio', durations[ 'two passes' ] / durations[ 'single pass' ] ) )
+
+
+if __name__ == '__main__':
+    for acl_size in ( 10, 100 ):
+        run( acl_size )
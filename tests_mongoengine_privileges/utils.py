@@ -75,6 +75,47 @@ class FauxSave( object ):
         return '{} ({}@{})'.format( name, self.pk, id( self ) )
 
 
+class DatabaseCallCounter( object ):
+    '''
+    A context manager that counts (and blocks) database round trips made on behalf of the given Document classes,
+    by replacing their `_get_db` and `_get_collection` class methods. Useful to assert that no documents are
+    dereferenced as a side effect of some operation.
+    '''
+
+    def __init__( self, *document_classes ):
+        self.document_classes = document_classes
+        self.calls = []
+        self._originals = []
+
+    def __enter__( self ):
+        for cls in self.document_classes:
+            for name in ( '_get_db', '_get_collection' ):
+                self._originals.append( ( cls, name, cls.__dict__.get( name ) ) )
+                setattr( cls, name, classmethod( self._get_recorder( name ) ) )
+
+        return self
+
+    def __exit__( self, *exc_info ):
+        for cls, name, original in reversed( self._originals ):
+            if original is None:
+                delattr( cls, name )
+            else:
+                setattr( cls, name, original )
+
+        self._originals = []
+
+    def _get_recorder( self, name ):
+        def record( cls, *args, **kwargs ):
+            self.calls.append( ( cls.__name__, name ) )
+            raise AssertionError( 'Unexpected database access for {} through `{}`'.format( cls.__name__, name ) )
+
+        return record
+
+    @property
+    def count( self ):
+        return len( self.calls )
+
+
 class Struct( object ):
     def __init__( self, **entries ):
         self.__dict__.update( entries )